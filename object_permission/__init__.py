@@ -51,6 +51,22 @@ set_default('OBJECT_PERMISSION_EXTRA_DEFAULT_PERMISSIONS', ['view'])
 set_default('OBJECT_PERMISSION_BUILTIN_TEMPLATETAGS', True)
 set_default('OBJECT_PERMISSION_AUTODISCOVER', True)
 set_default('OBJECT_PERMISSION_HANDLER_MODULE_NAME', 'ophandler')
+set_default('OBJECT_PERMISSION_USER_CACHE', False)
+set_default('OBJECT_PERMISSION_CACHE', None)
+set_default('OBJECT_PERMISSION_CACHE_TIMEOUT', 300)
+set_default('OBJECT_PERMISSION_NEGATIVE_FILTER', False)
+set_default('OBJECT_PERMISSION_NEGATIVE_FILTER_TIMEOUT', 60)
+set_default(
+    'OBJECT_PERMISSION_STORAGE_CLASS',
+    'object_permission.storages.M2MObjectPermStorage')
+set_default('OBJECT_PERMISSION_TYPED_OBJECT_ID', False)
+set_default('OBJECT_PERMISSION_CHECK_POOL_SIZE', 4)
+set_default('OBJECT_PERMISSION_HANDLER_REGISTRY_SIZE', 10000)
+set_default('OBJECT_PERMISSION_HANDLER_STATE', True)
+set_default('OBJECT_PERMISSION_HANDLER_QUEUE', None)
+set_default('OBJECT_PERMISSION_HANDLER_QUEUE_RETRIES', 3)
+set_default('OBJECT_PERMISSION_HANDLER_QUEUE_RETRY_DELAY', 1)
+set_default('OBJECT_PERMISSION_HANDLER_QUEUE_POOL_SIZE', 1)
 
 # Load site (this must be after the default settings has complete)
 from sites import site
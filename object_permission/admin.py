@@ -26,12 +26,16 @@ License:
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
 from django.contrib import admin
 from models import UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission
+from models import CharUserObjectPermission, CharGroupObjectPermission, CharAnonymousObjectPermission
+from models import BigIntegerUserObjectPermission, BigIntegerGroupObjectPermission, BigIntegerAnonymousObjectPermission
+from registry import registry
+from storages import get_storage
 
 class ObjectPermissionAdmin(admin.ModelAdmin):
     def _get_permissions(self, obj):
         permissions = []
-        for permission in obj.permissions.all():
-            permissions.append(permission.codename)
+        for perm_id in get_storage().get_row_permission_ids(obj):
+            permissions.append(registry.get_codename(perm_id))
         if not permissions:
             return "-"
         return "<br />".join(permissions)
@@ -52,3 +56,9 @@ class AnonymousObjectPermissionAdmin(ObjectPermissionAdmin):
 admin.site.register(UserObjectPermission, UserObjectPermissionAdmin)
 admin.site.register(GroupObjectPermission, GroupObjectPermissionAdmin)
 admin.site.register(AnonymousObjectPermission, AnonymousObjectPermissionAdmin)
+admin.site.register(CharUserObjectPermission, UserObjectPermissionAdmin)
+admin.site.register(CharGroupObjectPermission, GroupObjectPermissionAdmin)
+admin.site.register(CharAnonymousObjectPermission, AnonymousObjectPermissionAdmin)
+admin.site.register(BigIntegerUserObjectPermission, UserObjectPermissionAdmin)
+admin.site.register(BigIntegerGroupObjectPermission, GroupObjectPermissionAdmin)
+admin.site.register(BigIntegerAnonymousObjectPermission, AnonymousObjectPermissionAdmin)
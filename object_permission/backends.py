@@ -31,17 +31,30 @@ License:
     limitations under the License.
 """
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.conf import settings
 from django.db.models import Model
 from django.contrib.contenttypes.models import ContentType
 
-from models import UserObjectPermission
-from models import GroupObjectPermission
-from models import AnonymousObjectPermission
-
 from utils import get_perm_codename
+from registry import registry
+from storages import get_storage
+from cache import get_cache_key
+from cache import get_version
+from cache import get_user_cache
+from cache import set_user_cache
+from cache import get_last_version
+from cache import get_last_cache
+from cache import set_last_cache
+from cache import get_shared_cache
+from cache import get_shared_cache_entry
+from cache import set_shared_cache_entry
 
 class ObjectPermBackend(object):
-    """Authentication backend for object-permission"""
+    """Authentication backend for object-permission
+
+    Object permissions are read from the object permission storage specified
+    with ``OBJECT_PERMISSION_STORAGE_CLASS``.
+    """
     supports_object_permissions = True
     supports_anonymous_user = True
 
@@ -49,40 +62,149 @@ class ObjectPermBackend(object):
         """This backend is only for checking permission"""
         return None
 
-    def _has_user_object_permission(cls, user_obj, perm_codename, obj):
-        """check permission of obj for user from UserObjectPermission"""
-        if user_obj and not user_obj.is_authenticated():
-            return False
-        ct = ContentType.objects.get_for_model(obj)
-        qs = UserObjectPermission.objects.filter(
-                content_type=ct,
-                object_id=obj.pk,
-                user=user_obj)
-        qs = qs.filter(permissions__codename=perm_codename).distinct()
-        return qs.exists()
-
-    def _has_group_object_permission(cls, user_obj, perm_codename, obj):
-        """check permission of obj for user from GroupObjectPermission"""
-        if not user_obj.is_authenticated():
-            return False
+    def _get_object_filter(self, user_obj, model, perm_ids):
+        """get Q filter of model which user_obj have any of perm_ids
+
+        Object permission tables are joined as subqueries of object_id thus
+        the filter can be used for filtering queryset in the database.
+        """
+        ct = ContentType.objects.get_for_model(model)
+        return get_storage().get_object_filter(user_obj, ct, perm_ids)
+
+    def _get_object_permission_ids(self, user_obj, obj, user=True, group=True):
+        """get permission id set of obj which user_obj have with a single query"""
         ct = ContentType.objects.get_for_model(obj)
-        qs = GroupObjectPermission.objects.filter(
-                content_type=ct,
-                object_id=obj.pk,
-                group__in=user_obj.groups.all())
-        qs = qs.filter(permissions__codename=perm_codename).distinct()
-        return qs.exists()
-
-    def _has_anonymous_object_permission(cls, user_obj, perm_codename, obj):
-        """check permission of obj for anonymous from AnonymousObjectPermission"""
-        if user_obj.is_authenticated():
+        return get_storage().get_permission_ids(
+                user_obj, ct, obj.pk, user=user, group=group)
+
+    def _get_object_permissions(self, user_obj, obj, user=True, group=True):
+        """get codename set of obj which user_obj have with a single query"""
+        perm_ids = self._get_object_permission_ids(
+                user_obj, obj, user=user, group=group)
+        return set([registry.get_codename(perm_id) for perm_id in perm_ids])
+
+    def _get_all_object_permissions(self, user_obj, obj):
+        """get codename set of obj which user_obj have
+
+        Prefetched or cached codename set on user_obj (or the codename set of
+        the object checked last by user_obj) is used if available, then the
+        shared cache is used if ``OBJECT_PERMISSION_CACHE`` is set.
+        """
+        key = get_cache_key(obj)
+        permissions = get_user_cache(user_obj, key)
+        if permissions is None:
+            permissions = get_last_cache(user_obj, key)
+        if permissions is not None:
+            return permissions
+        version = get_version(key)
+        last_version = get_last_version(key)
+        if get_shared_cache() is not None:
+            perm_ids, versions = get_shared_cache_entry(user_obj, key)
+            if perm_ids is None:
+                perm_ids = self._get_object_permission_ids(user_obj, obj)
+                set_shared_cache_entry(user_obj, key, versions, perm_ids)
+            permissions = set([registry.get_codename(perm_id) for perm_id in perm_ids])
+        else:
+            permissions = self._get_object_permissions(user_obj, obj)
+        if settings.OBJECT_PERMISSION_USER_CACHE:
+            set_user_cache(user_obj, key, version, permissions)
+        else:
+            set_last_cache(user_obj, key, last_version, permissions)
+        return permissions
+
+    def prefetch_object_permissions(self, user_obj, objects):
+        """load object permissions of objects for user_obj into the cache
+
+        Object permissions are loaded with one query for each object
+        permission table and content type, then stored to the cache of
+        user_obj so following permission checks of the objects don't hit
+        the database.
+        """
+        pks_by_ct = {}
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj)
+            pks_by_ct.setdefault(ct, set()).add(obj.pk)
+        storage = get_storage()
+        for ct, pks in pks_by_ct.iteritems():
+            versions = dict((pk, get_version((ct.pk, pk))) for pk in pks)
+            permissions = storage.get_permission_ids_in_bulk(user_obj, ct, pks)
+            for pk, perm_ids in permissions.iteritems():
+                codenames = [registry.get_codename(perm_id) for perm_id in perm_ids]
+                set_user_cache(user_obj, (ct.pk, pk), versions[pk], codenames)
+
+    def check_many(self, user_obj, perm_obj_pairs):
+        """check permissions of objects for user_obj in bulk
+
+        Checks are grouped by content type and each group is resolved with
+        one query for each object permission table. Cached object
+        permissions of user_obj are used if available. Return a list of
+        bool in the order of perm_obj_pairs.
+        """
+        results = [False] * len(perm_obj_pairs)
+        checks_by_ct = {}
+        for i, (perm, obj) in enumerate(perm_obj_pairs):
+            if obj is None or not isinstance(obj, Model):
+                continue
+            perm_codename = get_perm_codename(perm)
+            permissions = get_user_cache(user_obj, get_cache_key(obj))
+            if permissions is not None:
+                results[i] = perm_codename in permissions
+                continue
+            ct = ContentType.objects.get_for_model(obj)
+            checks_by_ct.setdefault(ct, []).append((i, obj.pk, perm_codename))
+        storage = get_storage()
+        for ct, checks in checks_by_ct.iteritems():
+            pks = set([pk for i, pk, perm_codename in checks])
+            versions = dict((pk, get_version((ct.pk, pk))) for pk in pks)
+            permissions = storage.get_permission_ids_in_bulk(user_obj, ct, pks)
+            for i, pk, perm_codename in checks:
+                perm_id = registry.get_id(ct, perm_codename)
+                results[i] = perm_id is not None and perm_id in permissions[pk]
+            if settings.OBJECT_PERMISSION_USER_CACHE:
+                for pk, perm_ids in permissions.iteritems():
+                    codenames = [registry.get_codename(perm_id) for perm_id in perm_ids]
+                    set_user_cache(user_obj, (ct.pk, pk), versions[pk], codenames)
+        return results
+
+    def _format_permissions(self, permissions, obj):
+        """format codename set to django's standard permission format"""
+        app_label = obj._meta.app_label
+        return set(["%s.%s" % (app_label, codename) for codename in permissions])
+
+    def get_user_permissions(self, user_obj, obj=None):
+        """get permissions of obj which user_obj have directly
+
+        Permissions for all authenticated user (or anonymous user when
+        user_obj is not authenticated) are included.
+        """
+        if obj is None or not isinstance(obj, Model):
+            return set()
+        permissions = self._get_object_permissions(user_obj, obj, group=False)
+        return self._format_permissions(permissions, obj)
+
+    def get_group_permissions(self, user_obj, obj=None):
+        """get permissions of obj which groups of user_obj have"""
+        if obj is None or not isinstance(obj, Model):
+            return set()
+        permissions = self._get_object_permissions(user_obj, obj, user=False)
+        return self._format_permissions(permissions, obj)
+
+    def get_all_permissions(self, user_obj, obj=None):
+        """get all permissions of obj which user_obj have"""
+        if obj is None or not isinstance(obj, Model):
+            return set()
+        permissions = self._get_all_object_permissions(user_obj, obj)
+        return self._format_permissions(permissions, obj)
+
+    def has_perms(self, user_obj, perm_list, obj=None):
+        """check all permissions in perm_list of obj for user_obj"""
+        if obj is None or not isinstance(obj, Model):
             return False
-        ct = ContentType.objects.get_for_model(obj)
-        qs = AnonymousObjectPermission.objects.filter(
-                content_type=ct,
-                object_id=obj.pk)
-        qs = qs.filter(permissions__codename=perm_codename).distinct()
-        return qs.exists()
+        permissions = self._get_all_object_permissions(user_obj, obj)
+        for perm in perm_list:
+            if get_perm_codename(perm) not in permissions:
+                return False
+        return True
 
     def has_perm(self, user_obj, perm, obj=None):
         """check permission of obj for user_obj"""
@@ -90,19 +212,7 @@ class ObjectPermBackend(object):
             # This is object permission backend so don't touch if obj is None
             return False
         
-        perm_codename = get_perm_codename(perm)
-            
-        if user_obj.is_authenticated():
-            # check user_obj specific permissions
-            if self._has_user_object_permission(user_obj, perm_codename, obj):
-                return True
-            # check authenticated user permissions
-            elif self._has_user_object_permission(None, perm_codename, obj):
-                return True
-            # check groups user_obj belong specific permissions
-            elif self._has_group_object_permission(user_obj, perm_codename, obj):
-                return True
-        # check anonymous user specific permissions
-        elif self._has_anonymous_object_permission(user_obj, perm_codename, obj):
-            return True
-        return False
+        # all permissions of obj are loaded with a single query thus the
+        # following checks of obj (e.g. in ``User.has_perms``) reuse them
+        permissions = self._get_all_object_permissions(user_obj, obj)
+        return get_perm_codename(perm) in permissions
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+negative lookup index of object-permission
+
+Most objects don't have any object permission rows for most principals so
+the index keeps Bloom filters of (content type, object id) pairs which have
+any row in each object permission table. The backend can answer 'definitely
+no permissions' without touching the database when the pair is not in the
+filter.
+
+The filters are built in bulk in a background thread when the index is used
+first, updated when object permission rows are created in the process and
+rebuilt in the background every OBJECT_PERMISSION_NEGATIVE_FILTER_TIMEOUT
+seconds to pick up rows created in other processes. Permission checks are
+done with the database until the filters are built first.
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import math
+import time
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_save
+from django.db.models.signals import post_syncdb
+
+from models import iter_object_permission_models
+
+logger = logging.getLogger(__name__)
+
+class BloomFilter(object):
+    """Simple Bloom filter backed by bytearray
+
+    Attribute:
+        capacity   - expected number of items
+        error_rate - expected false positive rate with capacity items
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 64)
+        self.num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_hashes = max(int(round(self.num_bits * math.log(2) / capacity)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _get_offsets(self, item):
+        digest = hashlib.md5(unicode(item).encode('utf8')).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item):
+        for offset in self._get_offsets(item):
+            self._bits[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        for offset in self._get_offsets(item):
+            if not self._bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+        return True
+
+class ObjectPermIndex(object):
+    """Negative lookup index of object permission tables"""
+    models = tuple(iter_object_permission_models())
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._filters = None
+        self._built_at = None
+        self._rebuilding = False
+        # pairs added while the filters are being built (one list per build)
+        self._pendings = []
+
+    def _is_expired(self):
+        if self._built_at is None:
+            return True
+        timeout = settings.OBJECT_PERMISSION_NEGATIVE_FILTER_TIMEOUT
+        if timeout is None:
+            return False
+        return time.time() - self._built_at > timeout
+
+    def build(self):
+        """build Bloom filters of all object permission tables in bulk
+
+        Rows are streamed from the database and the current filters are kept
+        (and updated) until all tables are read.
+        """
+        pending = []
+        with self._lock:
+            self._pendings.append(pending)
+        try:
+            filters = {}
+            for model in self.models:
+                qs = model.objects.values_list('content_type', 'object_id').distinct()
+                bloom = BloomFilter(qs.count() * 2)
+                for ct_id, object_id in qs.iterator():
+                    bloom.add(self._get_key(ct_id, object_id))
+                filters[model] = bloom
+        finally:
+            with self._lock:
+                self._pendings.remove(pending)
+        with self._lock:
+            # rows created while the tables were read
+            for model, key in pending:
+                filters[model].add(key)
+            self._filters = filters
+            self._built_at = time.time()
+        return filters
+
+    def _rebuild(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        thread = threading.Thread(target=self._rebuild_in_thread)
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild_in_thread(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Failed to build object permission index")
+        finally:
+            self._rebuilding = False
+            # database connections are opened for each thread
+            for connection in connections.all():
+                connection.close()
+
+    def _get_key(self, ct_id, object_id):
+        # object id can be int, long or unicode depends on the database
+        # driver so use the same representation
+        return u"%s:%s" % (ct_id, object_id)
+
+    def clear(self):
+        """clear the index (it is rebuilt when it is used next)"""
+        with self._lock:
+            self._filters = None
+
+    def _get_filters(self):
+        """get the current filters or None
+
+        The filters are rebuilt in a background thread when they are not
+        built or expired thus None is returned until they are built first.
+        """
+        filters = self._filters
+        if filters is None or self._is_expired():
+            self._rebuild()
+        return filters
+
+    def add(self, model, ct_id, object_id):
+        """add the (content type id, object id) pair of model to the index"""
+        key = self._get_key(ct_id, object_id)
+        with self._lock:
+            for pending in self._pendings:
+                pending.append((model, key))
+            if self._filters is None:
+                return
+            bloom = self._filters[model]
+            if bloom.count >= bloom.capacity:
+                # the false positive rate is getting worse, rebuild soon
+                self._built_at = None
+            bloom.add(key)
+
+    def may_contain(self, model, ct_id, object_id):
+        """return False if model definitely has no rows of the pair"""
+        filters = self._get_filters()
+        if filters is None:
+            return True
+        return self._get_key(ct_id, object_id) in filters[model]
+
+index = ObjectPermIndex()
+
+def _object_permission_saved_reciver(sender, instance, created, **kwargs):
+    if created:
+        index.add(sender, instance.content_type_id, instance.object_id)
+for model in ObjectPermIndex.models:
+    post_save.connect(_object_permission_saved_reciver, sender=model,
+        dispatch_uid="object_permission.bloom.post_save.%s" % model.__name__)
+
+def _clear_index_reciver(sender, **kwargs):
+    index.clear()
+post_syncdb.connect(_clear_index_reciver,
+    dispatch_uid="object_permission.bloom.post_syncdb")
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+cache utilities of object-permission
+
+Object permission of particular object is cached on the user instance (which
+is created for each request) when OBJECT_PERMISSION_USER_CACHE is True.
+Cached entries are versioned per object and the version is bumped by
+mediators so stale entries are never used in the same process. Versions of
+the recently invalidated objects are kept (up to ``MAX_VERSIONS``) and the
+other objects share the greatest version which was dropped.
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import time
+import threading
+import itertools
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.core.cache import get_cache
+from django.core.signals import request_finished
+from django.db.models.signals import m2m_changed
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+USER_CACHE_NAME = '_object_perm_cache'
+LAST_CACHE_NAME = '_object_perm_last'
+GROUP_CACHE_NAME = '_object_perm_group_ids'
+GROUP_VERSION_KEY = 'user_groups'
+SHARED_CACHE_PREFIX = 'object_permission'
+
+# the number of versions of objects kept in the process
+MAX_VERSIONS = 10000
+
+_counter = itertools.count(1)
+_versions = OrderedDict()
+_versions_lock = threading.Lock()
+# the version of objects which versions are not kept
+_floor_version = [0]
+_shared_caches = {}
+# invalidations done in a managed transaction of each thread
+_local = threading.local()
+
+def get_cache_key(obj):
+    """get cache key (content type id, object pk) of obj"""
+    ct = ContentType.objects.get_for_model(obj)
+    return (ct.pk, obj.pk)
+
+def get_version(key):
+    """get current version of the object permission of key"""
+    return _versions.get(key, _floor_version[0])
+
+def _bump_version(key):
+    """bump the version of key and drop the least recently bumped versions"""
+    with _versions_lock:
+        _versions.pop(key, None)
+        _versions[key] = _counter.next()
+        while len(_versions) > MAX_VERSIONS:
+            # versions are ordered thus the dropped version is greater than
+            # the versions of any entries cached before it was bumped
+            _floor_version[0] = _versions.popitem(last=False)[1]
+
+def _invalidate(key, version_key):
+    """bump the version of key and the shared version_key (if not None)
+
+    Entries might be cached from the data before the transaction is
+    committed by the other processes between the invalidation and the
+    commit thus the versions are bumped again after the commit when the
+    transaction is managed (see ``flush_invalidations``).
+    """
+    if key is not None:
+        _bump_version(key)
+    if version_key is not None:
+        _bump_shared_version(version_key)
+    if transaction.is_managed():
+        pending = getattr(_local, 'pending', None)
+        if pending is None:
+            pending = _local.pending = set()
+        pending.add((key, version_key))
+    else:
+        flush_invalidations()
+
+def flush_invalidations():
+    """bump versions invalidated in the managed transaction of the current
+    thread again
+
+    It is called when the request is finished (after the transaction is
+    committed by ``TransactionMiddleware``). Call it after the commit when
+    object permissions are modified in a managed transaction outside of
+    requests.
+    """
+    pending = getattr(_local, 'pending', None)
+    if not pending:
+        return
+    _local.pending = None
+    for key, version_key in pending:
+        if key is not None:
+            _bump_version(key)
+        if version_key is not None:
+            _bump_shared_version(version_key)
+
+def _request_finished_reciver(sender, **kwargs):
+    flush_invalidations()
+request_finished.connect(_request_finished_reciver,
+    dispatch_uid="object_permission.cache.request_finished")
+
+def invalidate(key):
+    """invalidate all cached object permissions of key"""
+    _invalidate(key, _get_object_version_key(key))
+
+def get_user_cache(user_obj, key):
+    """get cached codename set of key from user_obj or None"""
+    cache = getattr(user_obj, USER_CACHE_NAME, None)
+    if cache is None or key not in cache:
+        return None
+    version, permissions = cache[key]
+    if version != get_version(key):
+        return None
+    return permissions
+
+def set_user_cache(user_obj, key, version, permissions):
+    """set codename set of key to the cache of user_obj
+
+    ``version`` should be taken with ``get_version`` before permissions are
+    loaded from the database so that the concurrent invalidation is not lost.
+    """
+    if not hasattr(user_obj, USER_CACHE_NAME):
+        setattr(user_obj, USER_CACHE_NAME, {})
+    cache = getattr(user_obj, USER_CACHE_NAME)
+    cache[key] = (version, frozenset(permissions))
+
+def get_last_version(key):
+    """get version of key used for the last checked object cache
+
+    Group ids of users are not cached with the last checked object thus the
+    version is bumped when groups of any user is changed as well.
+    """
+    return get_version(key), get_version(GROUP_VERSION_KEY)
+
+def get_last_cache(user_obj, key):
+    """get codename set of key if it is the object checked last by user_obj
+    or None"""
+    last = getattr(user_obj, LAST_CACHE_NAME, None)
+    if last is None or last[0] != key or last[1] != get_last_version(key):
+        return None
+    return last[2]
+
+def set_last_cache(user_obj, key, version, permissions):
+    """set codename set of key as the object checked last by user_obj
+
+    Only one object is kept so consecutive checks of the same object (e.g.
+    ``User.has_perms`` calls ``has_perm`` for each permission) share it even
+    when ``OBJECT_PERMISSION_USER_CACHE`` is disabled. ``version`` should be
+    taken with ``get_last_version`` before permissions are loaded.
+    """
+    setattr(user_obj, LAST_CACHE_NAME, (key, version, frozenset(permissions)))
+
+def clear_user_cache(user_obj):
+    """clear all cached object permissions of user_obj"""
+    for name in (USER_CACHE_NAME, LAST_CACHE_NAME):
+        if hasattr(user_obj, name):
+            delattr(user_obj, name)
+
+def get_group_ids(user_obj):
+    """get group id list of user_obj (cached on user_obj)
+
+    The cache is invalidated when groups of any user is changed in the
+    process.
+    """
+    version = get_version(GROUP_VERSION_KEY)
+    cached = getattr(user_obj, GROUP_CACHE_NAME, None)
+    if cached is None or cached[0] != version:
+        group_ids = list(user_obj.groups.values_list('pk', flat=True))
+        cached = (version, group_ids)
+        setattr(user_obj, GROUP_CACHE_NAME, cached)
+    return cached[1]
+
+def get_shared_cache():
+    """get django's cache instance for object permission or None"""
+    alias = settings.OBJECT_PERMISSION_CACHE
+    if not alias:
+        return None
+    if alias not in _shared_caches:
+        _shared_caches[alias] = get_cache(alias)
+    return _shared_caches[alias]
+
+def _get_object_version_key(key):
+    return '%s:v:%s:%s' % (SHARED_CACHE_PREFIX, key[0], key[1])
+
+def _get_principal_version_key(user_pk):
+    return '%s:u:%s' % (SHARED_CACHE_PREFIX, user_pk)
+
+def _get_entry_key(user_obj, key):
+    if user_obj.is_authenticated():
+        principal = 'u%s' % user_obj.pk
+    else:
+        principal = 'a'
+    return '%s:p:%s:%s:%s' % (SHARED_CACHE_PREFIX, principal, key[0], key[1])
+
+def _get_shared_version(cache, version_key, values):
+    """get version of version_key (initialize the version if required)
+
+    The initial version is the current time in milliseconds so the version
+    is greater than any previous versions even if the version is evicted.
+    """
+    version = values.get(version_key)
+    if version is None:
+        initial = int(time.time() * 1000)
+        if cache.add(version_key, initial, settings.OBJECT_PERMISSION_CACHE_TIMEOUT):
+            version = initial
+        else:
+            version = cache.get(version_key, initial)
+    return version
+
+def _bump_shared_version(version_key):
+    cache = get_shared_cache()
+    if cache is None:
+        return
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # the version does not exist (initialized when it is used)
+        pass
+
+def get_shared_cache_entry(user_obj, key):
+    """get permission ids of key for user_obj from the shared cache
+
+    Return (permission ids or None, versions). the versions should be passed
+    to ``set_shared_cache_entry`` when permissions are loaded from the
+    database.
+    """
+    cache = get_shared_cache()
+    entry_key = _get_entry_key(user_obj, key)
+    version_keys = [_get_object_version_key(key)]
+    if user_obj.is_authenticated():
+        version_keys.append(_get_principal_version_key(user_obj.pk))
+    values = cache.get_many([entry_key] + version_keys)
+    versions = tuple(_get_shared_version(cache, k, values) for k in version_keys)
+    entry = values.get(entry_key)
+    if entry is None or entry[0] != versions:
+        return None, versions
+    return entry[1], versions
+
+def set_shared_cache_entry(user_obj, key, versions, permission_ids):
+    """set permission ids of key for user_obj to the shared cache"""
+    cache = get_shared_cache()
+    entry = (versions, tuple(sorted(permission_ids)))
+    cache.set(_get_entry_key(user_obj, key), entry,
+              settings.OBJECT_PERMISSION_CACHE_TIMEOUT)
+
+def invalidate_principal(user_pk):
+    """invalidate all shared cached object permissions of user"""
+    _invalidate(None, _get_principal_version_key(user_pk))
+
+def _user_groups_changed_reciver(sender, instance, action, reverse, pk_set, **kwargs):
+    # group ids of users and permissions of groups are cached
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    _invalidate(GROUP_VERSION_KEY, None)
+    if get_shared_cache() is None:
+        return
+    if not reverse:
+        user_pks = [instance.pk]
+    elif action == 'pre_clear':
+        user_pks = instance.user_set.values_list('pk', flat=True)
+    else:
+        user_pks = pk_set or []
+    for user_pk in user_pks:
+        invalidate_principal(user_pk)
+m2m_changed.connect(_user_groups_changed_reciver, sender=User.groups.through,
+    dispatch_uid="object_permission.cache.user_groups_changed")
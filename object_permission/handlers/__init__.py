@@ -48,4 +48,6 @@ if isinstance(settings.OBJECT_PERMISSION_DEFAULT_HANDLER_CLASS, basestring):
 
 from base import ObjectPermHandlerBase
 from base import ObjectPermHandler
+from base import coalesce_updates
+from base import with_coalesced_updates
 from authenticated import AuthenticatedObjectPermHandler
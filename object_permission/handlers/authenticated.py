@@ -24,10 +24,16 @@ License:
     limitations under the License.
 """
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.db.models.signals import pre_save
 from django.db.models.signals import post_save
-from django.db.models.signals import post_delete
 from django.contrib.auth.models import User
 from base import ObjectPermHandler
+from ..storages import CHUNK_SIZE
+from ..mediators import QuerySetPermMediator
+from ..utils import chunked_pks
+
+# permissions contributed to active staff users
+MANAGER_PERMISSIONS = ['view', 'change', 'delete']
 
 class AuthenticatedObjectPermHandler(ObjectPermHandler):
     """ObjectPermHandler for model
@@ -38,18 +44,86 @@ class AuthenticatedObjectPermHandler(ObjectPermHandler):
         2.  Editor permission to authenticated user
         3.  Viewer permission to anonymous user
 
+    Object permissions of staff users are maintained incrementally; only
+    the manager permissions of the saved user are changed when the user
+    becomes (or stops being) an active staff user. 'updated' of all objects
+    is called instead when a subclass overrides 'updated'.
     """
+    @classmethod
+    def _get_models(cls):
+        """get models bound to this class (not to the superclass)"""
+        models = cls.__dict__.get('_models')
+        if models is None:
+            models = cls._models = set()
+        return models
+
+    @classmethod
+    def bind(cls, model):
+        super(AuthenticatedObjectPermHandler, cls).bind(model)
+        cls._get_models().add(model)
+
+    @classmethod
+    def unbind(cls, model):
+        super(AuthenticatedObjectPermHandler, cls).unbind(model)
+        cls._get_models().discard(model)
+
+    @classmethod
+    def _update_manager(cls, model, user):
+        """update object permissions of all objects of model for user who
+        becomes or stops being an active staff user"""
+        if cls.updated.im_func is not AuthenticatedObjectPermHandler.updated.im_func:
+            # the permissions of the user cannot be known without 'updated'
+            queryset = model._default_manager.all()
+            for pks in chunked_pks(queryset, CHUNK_SIZE):
+                instances = queryset.in_bulk(pks)
+                cls._updated_many([cls(instances[pk]) for pk in pks
+                                   if pk in instances])
+            return
+        mediator = QuerySetPermMediator(model)
+        if _is_manager(user):
+            mediator.manager(user)
+        else:
+            # the other object permissions of the user are kept
+            mediator.discontribute(user, MANAGER_PERMISSIONS)
+
     def updated(self, attr):
         # staff user has full access
-        staff_users = User.objects.filter(staff=True)
-        self.manager(staff_users.iterator())
+        staff_users = User.objects.filter(is_staff=True, is_active=True)
+        self.manager(staff_users)
         # Authenticated user can edit
         self.editor(None)
         # Anonymous user can view
         self.viewer('anonymous')
 
-def _recall_updated_reciver(sender, instance, **kwargs):
-    # Recall updated method of all AuthenticatedObjectPermHandler instance
-    AuthenticatedObjectPermHandler.update()
-post_save.connect(_recall_updated_reciver, User)
-post_delete.connect(_recall_updated_reciver, User)
+def _iter_handler_classes(cls=AuthenticatedObjectPermHandler):
+    """iterate cls and all subclasses of cls"""
+    yield cls
+    for subclass in cls.__subclasses__():
+        for handler_class in _iter_handler_classes(subclass):
+            yield handler_class
+
+def _is_manager(user):
+    return bool(user.is_staff and user.is_active)
+
+def _remember_manager_reciver(sender, instance, **kwargs):
+    # remember whether the user was an active staff user before save
+    was_manager = False
+    if instance.pk is not None:
+        previous = list(User.objects.filter(pk=instance.pk).values_list(
+                'is_staff', 'is_active')[:1])
+        was_manager = bool(previous and all(previous[0]))
+    instance._object_permission_was_manager = was_manager
+
+def _update_manager_reciver(sender, instance, created, **kwargs):
+    # change object permissions of the user only when the user becomes or
+    # stops being an active staff user (e.g. not on login)
+    was_manager = getattr(instance, '_object_permission_was_manager', False)
+    if _is_manager(instance) == was_manager:
+        return
+    for cls in _iter_handler_classes():
+        for model in list(cls.__dict__.get('_models', ())):
+            cls._update_manager(model, instance)
+pre_save.connect(_remember_manager_reciver, sender=User,
+    dispatch_uid="object_permission.handlers.authenticated.user_pre_save")
+post_save.connect(_update_manager_reciver, sender=User,
+    dispatch_uid="object_permission.handlers.authenticated.user_post_save")
@@ -24,12 +24,102 @@ License:
     limitations under the License.
 """
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import threading
+from hashlib import sha1
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import router
+from django.db.models import Model
+from django.db.models import ForeignKey
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import pre_save
 from django.db.models.signals import post_save
 from django.db.models.signals import post_delete
+from django.db.models.signals import m2m_changed
+from django.db.models.related import RelatedObject
+from django.utils.encoding import force_unicode
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.generic import GenericRelation
 
 from observer import watch
+from observer.watchers import Watcher
 
+from ..mediators import ObjectPermBatch
 from ..mediators import ObjectPermMediator
+from ..models import ObjectPermissionState
+from ..models import get_object_permission_models
+from ..utils import commit_on_success_unless_managed
+from ..storages import get_storage
+from ..queues import get_queue
+from registry import HandlerRegistry
+
+# lock for creating the handler registry of handler classes
+_registry_lock = threading.Lock()
+
+# {(handler class, key): handler} of dirty handlers in coalesce_updates block
+_local = threading.local()
+
+@contextmanager
+def coalesce_updates():
+    """call 'updated' of handlers once for each object when the block exits
+
+    Handlers updated in the block (e.g. an object saved several times) are
+    marked as dirty and 'updated' of each dirty handler is called once when
+    the block exits without exception. The changes of all objects of the
+    same handler class are written together with bulk statements. Nested
+    blocks are merged into the outer block.
+
+    Django has no hook of transaction commit thus use it inside of the
+    transaction (e.g. ``commit_on_success``) to update object permissions
+    once per transaction.
+
+    Usage::
+
+        with transaction.commit_on_success():
+            with coalesce_updates():
+                entry.title = 'foo'
+                entry.save()
+                entry.pub_state = 'published'
+                entry.save()
+
+    """
+    if getattr(_local, 'dirty', None) is not None:
+        yield
+        return
+    _local.dirty = OrderedDict()
+    try:
+        yield
+        dirty = _local.dirty
+    finally:
+        _local.dirty = None
+    handlers_by_class = OrderedDict()
+    for (cls, key), handler in dirty.iteritems():
+        handlers_by_class.setdefault(cls, []).append(handler)
+    for cls, handlers in handlers_by_class.iteritems():
+        cls._updated_many(handlers)
+
+def with_coalesced_updates(func):
+    """decorator version of coalesce_updates"""
+    @wraps(func)
+    def inner(*args, **kwargs):
+        with coalesce_updates():
+            return func(*args, **kwargs)
+    return inner
+
+def _release_watcher(watcher):
+    """unwatch watcher and remove it (and its nested watchers) from observer
+
+    observer keeps all watchers in ``Watcher._instances`` even after unwatch.
+    """
+    watcher.unwatch()
+    instances = getattr(Watcher, '_instances', None)
+    if instances:
+        instances[:] = [instance for instance in instances
+                        if instance is not watcher and
+                        getattr(instance._callback, 'im_self', None) is not watcher]
 
 class ObjectPermHandlerBase(ObjectPermMediator):
     """Base class of ObjectPermHandler
@@ -53,61 +143,305 @@ class ObjectPermHandlerBase(ObjectPermMediator):
         """bind model and this handler"""
         post_save.connect(cls._post_save_reciever, sender=model, weak=False)
         post_delete.connect(cls._post_delete_reciver, sender=model, weak=False)
+        cls._connect_deferred_recivers(model)
 
     @classmethod
     def unbind(cls, model):
         """unbind model and this handler"""
         post_save.disconnect(cls._post_save_reciever, sender=model)
         post_delete.disconnect(cls._post_delete_reciver, sender=model)
+        connected = cls.__dict__.get('_deferred_recivers', {})
+        for signal, sender, dispatch_uid in connected.pop(model, []):
+            signal.disconnect(sender=sender, dispatch_uid=dispatch_uid)
+
+    @classmethod
+    def _connect_deferred_recivers(cls, model):
+        """connect recivers which enqueue 'update' of objects of model when
+        the relations of the objects are changed and the handler queue is used
+
+        Handlers (and their watchers) are created only in the process which
+        runs the queue thus changes of ManyToMany relations (of both sides)
+        and reverse relations of ForeignKey of model are enqueued by these
+        recivers in the process which changes them. Changes of attributes of
+        the objects related with ForeignKey or GenericRelation are not
+        noticed until the objects of model are saved.
+        """
+        opts = model._meta
+        connected = cls.__dict__.get('_deferred_recivers')
+        if connected is None:
+            connected = cls._deferred_recivers = {}
+        recivers = connected.setdefault(model, [])
+        def connect(signal, reciver, sender, name):
+            dispatch_uid = "object_permission.handlers.deferred:%s.%s:%s:%s:%s" % (
+                    cls.__module__, cls.__name__, opts, sender._meta, name)
+            signal.connect(reciver, sender=sender, weak=False,
+                           dispatch_uid=dispatch_uid)
+            if (signal, sender, dispatch_uid) not in recivers:
+                recivers.append((signal, sender, dispatch_uid))
+        def enqueue(queue, instances):
+            for instance in instances:
+                queue.put(cls, 'update', instance)
+        throughs = [field.rel.through for field in opts.many_to_many
+                    if getattr(field.rel, 'through', None)]
+        throughs += [related.field.rel.through for related in
+                     opts.get_all_related_many_to_many_objects()]
+        for through in set(throughs):
+            def m2m_changed_reciver(sender, instance, action, model, pk_set,
+                                    bound_model=model, **kwargs):
+                queue = get_queue()
+                if queue is None:
+                    # watchers of the handlers in the process notice it
+                    return
+                if isinstance(instance, bound_model):
+                    if action in ('post_add', 'post_remove', 'post_clear'):
+                        enqueue(queue, [instance])
+                elif action in ('post_add', 'post_remove'):
+                    enqueue(queue, [bound_model(pk=pk) for pk in pk_set])
+                elif action == 'pre_clear':
+                    # objects of model are not known after the clear
+                    src = [f for f in sender._meta.fields
+                           if f.rel and issubclass(instance.__class__, f.rel.to)][0]
+                    dst = [f for f in sender._meta.fields
+                           if f.rel and f.rel.to is bound_model][0]
+                    pks = sender._default_manager.filter(**{
+                        src.attname: instance.pk}).values_list(dst.attname, flat=True)
+                    enqueue(queue, [bound_model(pk=pk) for pk in pks])
+            connect(m2m_changed, m2m_changed_reciver, through, 'm2m')
+        for related in opts.get_all_related_objects():
+            if related.model._meta.app_label == 'object_permission':
+                # object permissions and states written by the handlers
+                continue
+            field = related.field
+            def get_instances(values, field=field):
+                values = [value for value in values if value is not None]
+                if field.rel.field_name == opts.pk.name:
+                    return [model(pk=value) for value in set(values)]
+                return model._default_manager.filter(**{
+                    '%s__in' % field.rel.field_name: values})
+            def pre_save_reciver(sender, instance, field=field, **kwargs):
+                if instance.pk is None or get_queue() is None:
+                    return
+                values = sender._default_manager.filter(
+                        pk=instance.pk).values_list(field.attname, flat=True)
+                previous = getattr(_local, 'deferred_previous_values', None)
+                if previous is None:
+                    previous = _local.deferred_previous_values = {}
+                previous[(cls, field, id(instance))] = list(values[:1])
+            def post_save_reciver(sender, instance, field=field,
+                                  get_instances=get_instances, **kwargs):
+                previous = getattr(_local, 'deferred_previous_values', {})
+                values = previous.pop((cls, field, id(instance)), [])
+                queue = get_queue()
+                if queue is None:
+                    return
+                values.append(getattr(instance, field.attname))
+                enqueue(queue, get_instances(values))
+            connect(pre_save, pre_save_reciver, related.model,
+                    'pre_save:%s' % field.name)
+            connect(post_save, post_save_reciver, related.model,
+                    'post_save:%s' % field.name)
+            connect(post_delete, post_save_reciver, related.model,
+                    'post_delete:%s' % field.name)
 
     @classmethod
     def _post_save_reciever(cls, sender, instance, created, **kwargs):
+        if cls._defer('save', instance, created=created):
+            return
         # register the instance to this class
         if created or cls.get(instance) is None:
-            cls._register(instance)
+            cls._register(instance, created=created)
 
     @classmethod
     def _post_delete_reciver(cls, sender, instance, **kwargs):
+        if cls._defer('delete', instance):
+            return
         # unregister the instance from this class
         cls._unregister(instance)
 
     @classmethod
-    def _register(cls, instance):
+    def _defer(cls, action, instance, created=False):
+        """enqueue the invocation to the handler queue if it is specified
+
+        Return False if the invocation should be run now.
+        """
+        queue = get_queue()
+        if queue is None:
+            return False
+        queue.put(cls, action, instance, created=created)
+        return True
+
+    @classmethod
+    def _run(cls, action, instance, created=False):
+        """run the deferred invocation of action for the fresh instance
+
+        The handler may not be registered in the process which runs the
+        queue thus existing instances are checked with the stored state.
+        """
+        if action == 'delete':
+            self = cls._get_registry().pop(cls._get_key(instance))
+            if self is None:
+                self = cls(instance)
+            self._teardown()
+            return
+        self = cls.get(instance)
+        if created or self is None:
+            cls._register(instance, created=created or action == 'update')
+        elif action == 'update' or not self._is_up_to_date():
+            self.instance = instance
+            self._updated(attr=None)
+
+    @classmethod
+    def _get_registry(cls):
+        """get the handler registry of this class (not of the superclass)"""
+        registry = cls.__dict__.get('_handlers')
+        if registry is None:
+            with _registry_lock:
+                registry = cls.__dict__.get('_handlers')
+                if registry is None:
+                    registry = HandlerRegistry(
+                            settings.OBJECT_PERMISSION_HANDLER_REGISTRY_SIZE)
+                    cls._handlers = registry
+        return registry
+
+    @classmethod
+    def _get_key(cls, instance):
+        return ContentType.objects.get_for_model(instance).pk, instance.pk
+
+    @classmethod
+    def _register(cls, instance, created=True):
         # create new handler instance
         self = cls(instance)
-        # register the handler instance to cls
-        if not hasattr(cls, '_handlers'):
-            cls._handlers = {}
-        cls._handlers[instance] = self
         # call pre setup method
         self._setup()
-        # call pre updated method
-        self._updated(attr=None)
+        # register the handler instance to cls
+        cls._get_registry().set(cls._get_key(instance), self)
+        # call pre updated method (existing instances are skipped when the
+        # object permissions are built from the same watched attributes)
+        if created or not self._is_up_to_date():
+            self._updated(attr=None)
+
+    @classmethod
+    def _connect_wake_recivers(cls, signal_key):
+        """connect recivers which register released handlers again when
+        the relations of signal_key which they watched are changed
+
+        signal_key is one of
+            ('save', model, None)   - save/delete of model (match: pk)
+            ('fk', model, attname)  - save/delete of model (match: attname
+                                      value before and after the save)
+            ('m2m', through, None)  - m2m_changed of through (match:
+                                      (model, pk) of the changed objects)
+        """
+        with _registry_lock:
+            connected = cls.__dict__.get('_wake_recivers')
+            if connected is None:
+                connected = cls._wake_recivers = set()
+            if signal_key in connected:
+                return
+            connected.add(signal_key)
+        kind, sender, attname = signal_key
+        dispatch_uid = "object_permission.handlers.wake:%s.%s:%s:%s:%s" % (
+                cls.__module__, cls.__name__, kind, sender._meta, attname)
+        def wake(matches):
+            for key in cls._get_registry().get_released(signal_key, matches):
+                cls._wake(key)
+        if kind == 'm2m':
+            def m2m_changed_reciver(sender, instance, action, model, pk_set,
+                                    **kwargs):
+                if action not in ('post_add', 'post_remove', 'post_clear'):
+                    return
+                if pk_set is None:
+                    # objects of the other side are not known
+                    wake(None)
+                    return
+                wake([(instance.__class__, instance.pk)] +
+                     [(model, pk) for pk in pk_set])
+            m2m_changed.connect(m2m_changed_reciver, sender=sender,
+                                weak=False, dispatch_uid=dispatch_uid)
+            return
+        if kind == 'fk':
+            def pre_save_reciver(sender, instance, **kwargs):
+                if instance.pk is None or \
+                        not cls._get_registry().has_released(signal_key):
+                    return
+                values = sender._default_manager.filter(
+                        pk=instance.pk).values_list(attname, flat=True)
+                previous = getattr(_local, 'previous_values', None)
+                if previous is None:
+                    previous = _local.previous_values = {}
+                previous[(signal_key, id(instance))] = list(values[:1])
+            def post_save_reciver(sender, instance, **kwargs):
+                previous = getattr(_local, 'previous_values', {})
+                wake([getattr(instance, attname)] +
+                     previous.pop((signal_key, id(instance)), []))
+            pre_save.connect(pre_save_reciver, sender=sender,
+                             weak=False, dispatch_uid=dispatch_uid)
+        else:
+            def post_save_reciver(sender, instance, **kwargs):
+                wake([instance.pk])
+        post_save.connect(post_save_reciver, sender=sender,
+                          weak=False, dispatch_uid=dispatch_uid)
+        post_delete.connect(post_save_reciver, sender=sender,
+                            weak=False, dispatch_uid=dispatch_uid)
+
+    @classmethod
+    def _wake(cls, key):
+        """register the released handler of key again and update it"""
+        ct_pk, pk = key
+        model = ContentType.objects.get_for_id(ct_pk).model_class()
+        try:
+            instance = model._default_manager.get(pk=pk)
+        except model.DoesNotExist:
+            cls._get_registry().pop(key)
+            return
+        if cls._defer('update', instance):
+            return
+        if cls.get(instance) is None:
+            cls._register(instance, created=True)
 
     @classmethod
     def _unregister(cls, instance):
+        dirty = getattr(_local, 'dirty', None)
+        if dirty is not None:
+            # the deleted instance is not updated in coalesce_updates block
+            dirty.pop((cls, cls._get_key(instance)), None)
+        self = cls._get_registry().pop(cls._get_key(instance))
         # if no handler is registered, just ignore
-        if not hasattr(cls, '_handlers'):
+        if self is None:
             return
-        self = cls._handlers[instance]
         # call pre teardown method
         self._teardown()
-        del cls._handlers[instance]
 
     @classmethod
     def get(cls, instance):
-        if not hasattr(cls, '_handlers'):
-            cls._handlers = {}
-        return cls._handlers.get(instance)
+        return cls._get_registry().get(cls._get_key(instance))
 
     @classmethod
     def update(cls):
         """call 'updated' method of all instance of this class"""
-        if not hasattr(cls, '_handlers'):
-            return
-        for model, handler in cls._handlers.iteritems():
+        for handler in cls._get_registry().values():
             handler._updated(attr=None)
 
+    @classmethod
+    def stats(cls):
+        """get a dictionary of the size and the usage of the handler registry"""
+        return cls._get_registry().stats()
+
+    def _release(self):
+        """release resources of the handler when it is evicted from the registry
+
+        Return the list of (signal key, match) pairs of the relations which
+        the handler watched (see ``_connect_wake_recivers``).
+        """
+        return []
+
+    def _count_watchers(self):
+        return 0
+
+    def _is_up_to_date(self):
+        """return True if object permissions of the instance are up to date"""
+        return False
+
     def _setup(self):
         raise NotImplementedError
     def _teardown(self):
@@ -116,11 +450,19 @@ class ObjectPermHandlerBase(ObjectPermMediator):
         raise NotImplementedError
 
 class ObjectPermHandler(ObjectPermHandlerBase):
+    # change the version when 'updated' is changed to rebuild object
+    # permissions of existing instances
+    version = None
+
     def __init__(self, instance):
         super(ObjectPermHandler, self).__init__(instance)
         self._watchers = {}
+        # fingerprint stored in ObjectPermissionState (None for unknown)
+        self._fingerprint = None
 
     def _watch_update_reciver(self, sender, obj, attr):
+        if self._defer('update', obj):
+            return
         # update instance (because self.instance is not fresh)
         self.instance = obj
         # call pre updated method
@@ -136,12 +478,119 @@ class ObjectPermHandler(ObjectPermHandlerBase):
     def _unwatch(self, instance=None):
         """Unwatch watchers of instance."""
         if instance:
-            if instance in self._watchers:
-                del self._watchers[instance]
+            for watcher in self._watchers.pop(instance, []):
+                _release_watcher(watcher)
         else:
             # unwatch all watchers registered in this class instance
+            for watchers in self._watchers.itervalues():
+                for watcher in watchers:
+                    _release_watcher(watcher)
             self._watchers = {}
 
+    def _release(self):
+        # the handler is registered again with setup when the instance is
+        # saved or the watched relations are changed
+        pairs = self._get_wake_pairs()
+        self._unwatch(instance=None)
+        for signal_key in set(signal_key for signal_key, match in pairs):
+            self._connect_wake_recivers(signal_key)
+        return pairs
+
+    def _get_wake_pairs(self):
+        """get (signal key, match) pairs of the relations and the instances
+        watched by the handler (the watched values of the instance of the
+        handler are checked when the instance is saved)"""
+        pairs = []
+        for instance, watchers in self._watchers.iteritems():
+            if instance != self.instance:
+                pairs.append((('save', instance.__class__, None), instance.pk))
+            for watcher in watchers:
+                pairs.extend(self._get_relation_wake_pairs(instance, watcher._attr))
+        return pairs
+
+    def _get_relation_wake_pairs(self, instance, attr):
+        try:
+            field, model, direct, m2m = instance._meta.get_field_by_name(attr)
+        except FieldDoesNotExist:
+            return []
+        if isinstance(field, ForeignKey):
+            # the related instance is watched
+            value = getattr(instance, field.attname)
+            if value is None:
+                return []
+            return [(('save', field.rel.to, None), value)]
+        elif isinstance(field, GenericRelation):
+            return [(('fk', field.rel.to, field.object_id_field_name),
+                     instance.pk)]
+        elif m2m:
+            through = getattr(instance, attr).through
+            return [(('m2m', through, None), (instance.__class__, instance.pk))]
+        elif isinstance(field, RelatedObject):
+            # reverse relation of ForeignKey (or OneToOneField)
+            return [(('fk', field.model, field.field.attname),
+                     getattr(instance, field.field.rel.field_name))]
+        return []
+
+    def _count_watchers(self):
+        return sum(len(watchers) for watchers in self._watchers.itervalues())
+
+    def _get_watched_value(self, instance, attr):
+        """get unicode of the watched attr value of instance"""
+        try:
+            field = instance._meta.get_field(attr)
+        except FieldDoesNotExist:
+            field = None
+        if isinstance(field, ForeignKey):
+            # avoid fetching the related instance
+            return force_unicode(getattr(instance, field.attname))
+        value = getattr(instance, attr)
+        if isinstance(value, Model):
+            return force_unicode(value.pk)
+        if hasattr(value, 'values_list'):
+            # related managers
+            return u",".join(sorted(force_unicode(pk)
+                for pk in value.values_list('pk', flat=True)))
+        return force_unicode(value)
+
+    def _get_fingerprint(self):
+        """get sha1 hexdigest of the handler and the watched attr values"""
+        lines = [u"%s.%s:%s" % (self.__class__.__module__,
+                                self.__class__.__name__, self.version)]
+        for instance, watchers in self._watchers.iteritems():
+            if instance == self.instance:
+                # the instance of the handler is fresher
+                instance = self.instance
+            for watcher in watchers:
+                lines.append(u"%s:%s:%s=%s" % (
+                    instance._meta, instance.pk, watcher._attr,
+                    self._get_watched_value(instance, watcher._attr)))
+        return sha1(u"\n".join(sorted(lines)).encode('utf8')).hexdigest()
+
+    def _get_states(self):
+        return ObjectPermissionState.objects.filter(
+                content_type=self._ct, object_id=force_unicode(self.instance.pk))
+
+    def _is_up_to_date(self):
+        if not settings.OBJECT_PERMISSION_HANDLER_STATE:
+            return False
+        fingerprints = self._get_states().values_list('fingerprint', flat=True)
+        self._fingerprint = (list(fingerprints[:1]) or [None])[0]
+        return self._fingerprint == self._get_fingerprint()
+
+    def _save_fingerprint(self):
+        """store the fingerprint of the current watched attr values"""
+        if not settings.OBJECT_PERMISSION_HANDLER_STATE:
+            return
+        fingerprint = self._get_fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        if not self._get_states().update(fingerprint=fingerprint):
+            ObjectPermissionState.objects.create(
+                    content_type=self._ct,
+                    object_id=force_unicode(self.instance.pk),
+                    fingerprint=fingerprint)
+        self._fingerprint = fingerprint
+
     def watch(self, attr, instance=None):
         """Watch instance attr and call 'updated' method of this class"""
         if instance is None:
@@ -157,13 +606,61 @@ class ObjectPermHandler(ObjectPermHandlerBase):
         # unwatch all watchers registered in this class instance
         self._unwatch(instance=None)
         self.teardown()
+        if settings.OBJECT_PERMISSION_HANDLER_STATE:
+            self._get_states().delete()
+
+    @classmethod
+    def _updated_many(cls, handlers):
+        """call 'updated' of handlers and write the changes in bulk
+
+        Changes of objects which have the same permission ids and targets are
+        written with one statement in a transaction (or in the transaction of
+        the caller when it is managed).
+        """
+        storage = get_storage()
+        # {(method name, content type, permission ids, acl keys): object ids}
+        changes = OrderedDict()
+        changed = []
+        for handler in handlers:
+            handler._batch = ObjectPermBatch(reset=True)
+            try:
+                handler.updated(None)
+                batch = handler._batch
+            finally:
+                handler._batch = None
+            removals, additions = handler._get_batch_changes(batch)
+            for name, perm_keys in (('remove_objects', removals),
+                                    ('add_objects', additions)):
+                for perm_ids, keys in perm_keys.iteritems():
+                    changes.setdefault((name, handler._ct, perm_ids,
+                        frozenset(keys)), []).append(handler.instance.pk)
+            if removals or additions:
+                changed.append(handler)
+        if changes:
+            ct = handlers[0]._ct
+            using = router.db_for_write(get_object_permission_models(ct)[0])
+            with commit_on_success_unless_managed(using=using):
+                for (name, ct, perm_ids, keys), object_ids in changes.iteritems():
+                    targets = [handlers[0]._get_acl_target(key) for key in keys]
+                    getattr(storage, name)(ct, object_ids, targets, perm_ids)
+        for handler in changed:
+            handler._invalidate()
+        for handler in handlers:
+            handler._save_fingerprint()
 
     def _updated(self, attr):
         """pre updated method"""
-        # reset object permission of the instance
-        self.reset()
-        # call updated method
-        self.updated(attr)
+        dirty = getattr(_local, 'dirty', None)
+        if dirty is not None:
+            # 'updated' is called when coalesce_updates block exits
+            dirty[(self.__class__, self._get_key(self.instance))] = self
+            return
+        # collect object permissions of the instance from the empty state and
+        # write only the differences to the stored object permissions
+        with self.batch(reset=True):
+            # call updated method
+            self.updated(attr)
+        self._save_fingerprint()
 
     def setup(self):
         """called when the bind model instance is created."""
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+object-permission handler registry module
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import threading
+from collections import OrderedDict
+
+class HandlerRegistry(object):
+    """Thread-safe LRU registry of handler instances
+
+    Handlers are stored with (content type id, pk) key thus model instances
+    are not used as keys. The least recently used handler is released (its
+    watchers are unwatched) when the number of handlers exceeds maxsize, and
+    it is registered again lazily when the model instance is saved.
+
+    ``_release`` of the handler returns the list of (signal key, match)
+    pairs of the relations it watched. The keys of released handlers are
+    kept with the pairs so that the handler class can register them again
+    when the watched relations are changed (e.g. ``m2m_changed``).
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._handlers = OrderedDict()
+        # {signal key: {match: set of keys}} and {key: [(signal key, match)]}
+        # of released handlers
+        self._released = {}
+        self._released_keys = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def get(self, key):
+        """get the handler of key (and mark it as recently used) or None"""
+        with self._lock:
+            handler = self._handlers.pop(key, None)
+            if handler is None:
+                self.misses += 1
+                return None
+            self._handlers[key] = handler
+            self.hits += 1
+            return handler
+
+    def set(self, key, handler):
+        """register the handler with key and release least recently used ones"""
+        with self._lock:
+            self._discard_released(key)
+            previous = self._handlers.pop(key, None)
+            self._handlers[key] = handler
+            if previous is not None and previous is not handler:
+                previous._release()
+            while self.maxsize and len(self._handlers) > self.maxsize:
+                _key, _handler = self._handlers.popitem(last=False)
+                self.evictions += 1
+                self._add_released(_key, _handler._release())
+
+    def pop(self, key):
+        """unregister and return the handler of key or None"""
+        with self._lock:
+            self._discard_released(key)
+            return self._handlers.pop(key, None)
+
+    def _add_released(self, key, pairs):
+        if not pairs:
+            return
+        self._released_keys[key] = pairs
+        for signal_key, match in pairs:
+            self._released.setdefault(signal_key, {}).setdefault(
+                    match, set()).add(key)
+
+    def _discard_released(self, key):
+        for signal_key, match in self._released_keys.pop(key, []):
+            matches = self._released.get(signal_key, {})
+            keys = matches.get(match, set())
+            keys.discard(key)
+            if not keys:
+                matches.pop(match, None)
+            if not matches:
+                self._released.pop(signal_key, None)
+
+    def has_released(self, signal_key):
+        """return True if released handlers watched relations of signal_key"""
+        with self._lock:
+            return signal_key in self._released
+
+    def get_released(self, signal_key, matches=None):
+        """get the set of keys of released handlers which watched relations
+        of signal_key and matches (all of signal_key if matches is None)"""
+        with self._lock:
+            released = self._released.get(signal_key, {})
+            if matches is None:
+                matches = released.keys()
+            keys = set()
+            for match in matches:
+                keys.update(released.get(match, ()))
+            return keys
+
+    def values(self):
+        """get the list of registered handlers"""
+        with self._lock:
+            return self._handlers.values()
+
+    def clear(self):
+        """release and unregister all handlers"""
+        with self._lock:
+            handlers = self._handlers.values()
+            self._handlers.clear()
+            self._released.clear()
+            self._released_keys.clear()
+            for handler in handlers:
+                handler._release()
+
+    def stats(self):
+        """get a dictionary of the size and the usage of the registry"""
+        with self._lock:
+            return {
+                'size': len(self._handlers),
+                'maxsize': self.maxsize,
+                'watchers': sum(handler._count_watchers()
+                                for handler in self._handlers.itervalues()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'released': len(self._released_keys),
+            }
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+build ObjectPermissionMask table for bitmask object permission storage
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from optparse import make_option
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import NoArgsCommand
+from django.contrib.contenttypes.models import ContentType
+
+from ...models import ObjectPermissionGrant
+from ...models import ObjectPermissionMask
+from ...models import OBJECT_PERMISSION_MODELS
+from ...models import DEFAULT_OBJECT_PERMISSION_MODELS
+from ...registry import registry
+
+# sqlite limits the number of variables of a query to 999 and a mask row
+# uses 5 of them
+CHUNK_SIZE = 150
+
+class Command(NoArgsCommand):
+    help = ("""Rebuild `ObjectPermissionMask` table from permissions """
+            """ManyToMany tables of user, group and anonymous object """
+            """permissions.""")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to backfill. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        verbosity = int(options.get('verbosity', 1))
+        registry.clear()
+        with transaction.commit_on_success(using=using):
+            # assign bit positions to all permissions
+            for ct in ContentType.objects.using(using).iterator():
+                registry.get_bits(ct)
+        count = 0
+        # the table is replaced in one transaction thus permission checks
+        # never see the table partially built
+        with transaction.commit_on_success(using=using):
+            connection = connections[using]
+            connection.cursor().execute("DELETE FROM %s" % (
+                connection.ops.quote_name(ObjectPermissionMask._meta.db_table)))
+            chunk = []
+            for mask in self._iter_masks(using):
+                chunk.append(mask)
+                if len(chunk) >= CHUNK_SIZE:
+                    ObjectPermissionMask.objects.using(using).bulk_create(chunk)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                ObjectPermissionMask.objects.using(using).bulk_create(chunk)
+                count += len(chunk)
+        # reload the bit positions assigned in the transaction
+        registry.clear()
+        if verbosity > 0:
+            return """Backfilled: %s (%d)\n""" % (
+                    ObjectPermissionMask._meta.db_table, count)
+
+    def _iter_masks(self, using):
+        # object permissions of content types which object id is not an
+        # integer are not stored in the mask table
+        for models in (DEFAULT_OBJECT_PERMISSION_MODELS,
+                       OBJECT_PERMISSION_MODELS['BigIntegerField']):
+            user_model, group_model, anonymous_model = models
+            for model, field in ((user_model, 'user'),
+                                 (group_model, 'group'),
+                                 (anonymous_model, None)):
+                for mask in self._iter_model_masks(model, field, using):
+                    yield mask
+
+    def _iter_model_masks(self, model, field, using):
+        """iterate masks of rows of model (rows of the same object and
+        principal are merged)"""
+        fields = ['content_type', 'object_id', field or 'pk', 'permissions']
+        qs = model.objects.using(using).filter(content_type__isnull=False,
+                object_id__isnull=False, permissions__isnull=False)
+        qs = qs.order_by(*fields[:3]).values_list(*fields)
+        key = None
+        mask = 0
+        for ct_id, object_id, value, perm_id in qs.iterator():
+            bits = registry.get_bits(ContentType.objects.get_for_id(ct_id))
+            if perm_id not in bits:
+                # permission of the other content type could not be
+                # represented in the mask of this content type
+                continue
+            if field is None:
+                value = None
+            if key is not None and key != (ct_id, object_id, value):
+                yield self._create_mask(field, key, mask)
+                mask = 0
+            key = (ct_id, object_id, value)
+            mask |= 1 << bits[perm_id]
+        if key is not None:
+            yield self._create_mask(field, key, mask)
+
+    def _create_mask(self, field, key, mask):
+        ct_id, object_id, principal_id = key
+        if field == 'group':
+            principal_kind = ObjectPermissionGrant.GROUP
+        elif field is None:
+            principal_kind = ObjectPermissionGrant.ANONYMOUS
+        elif principal_id is None:
+            principal_kind = ObjectPermissionGrant.AUTHENTICATED
+        else:
+            principal_kind = ObjectPermissionGrant.USER
+        return ObjectPermissionMask(
+                content_type_id=ct_id, object_id=object_id,
+                principal_kind=principal_kind,
+                principal_id=principal_id or 0, mask=mask)
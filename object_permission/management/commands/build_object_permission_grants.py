@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+build denormalized object permission grant table from object permissions
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from optparse import make_option
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import NoArgsCommand
+
+from ...models import UserObjectPermission
+from ...models import GroupObjectPermission
+from ...models import AnonymousObjectPermission
+from ...models import ObjectPermissionGrant
+
+# sqlite limits the number of variables of a query to 999 and a grant row
+# uses 5 of them
+CHUNK_SIZE = 150
+
+class Command(NoArgsCommand):
+    help = ("""Rebuild `ObjectPermissionGrant` table from user, group and """
+            """anonymous object permissions.""")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to build. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        verbosity = int(options.get('verbosity', 1))
+        count = 0
+        # the table is replaced in one transaction thus permission checks
+        # never see the table partially built
+        with transaction.commit_on_success(using=using):
+            connection = connections[using]
+            connection.cursor().execute("DELETE FROM %s" % (
+                connection.ops.quote_name(ObjectPermissionGrant._meta.db_table)))
+            chunk = []
+            for grant in self._iter_grants(using):
+                chunk.append(grant)
+                if len(chunk) >= CHUNK_SIZE:
+                    ObjectPermissionGrant.objects.using(using).bulk_create(chunk)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                ObjectPermissionGrant.objects.using(using).bulk_create(chunk)
+                count += len(chunk)
+        if verbosity > 0:
+            return """Built: %s (%d)\n""" % (
+                    ObjectPermissionGrant._meta.db_table, count)
+
+    def _iter_grants(self, using):
+        sources = (
+            (UserObjectPermission, 'user'),
+            (GroupObjectPermission, 'group'),
+            (AnonymousObjectPermission, None),
+        )
+        for model, field in sources:
+            fields = ['content_type', 'object_id', 'permissions']
+            if field:
+                fields.append(field)
+            qs = model.objects.using(using).filter(content_type__isnull=False,
+                    object_id__isnull=False, permissions__isnull=False)
+            qs = qs.order_by().values_list(*fields)
+            for row in qs.iterator():
+                ct_id, object_id, perm_id = row[:3]
+                principal_id = row[3] if field else None
+                if model is GroupObjectPermission:
+                    principal_kind = ObjectPermissionGrant.GROUP
+                elif model is AnonymousObjectPermission:
+                    principal_kind = ObjectPermissionGrant.ANONYMOUS
+                elif principal_id is None:
+                    principal_kind = ObjectPermissionGrant.AUTHENTICATED
+                else:
+                    principal_kind = ObjectPermissionGrant.USER
+                yield ObjectPermissionGrant(
+                        content_type_id=ct_id, object_id=object_id,
+                        principal_kind=principal_kind,
+                        principal_id=principal_id or 0,
+                        permission_id=perm_id)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+move object permissions stored in the generic integer models to the typed
+object permission models
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from optparse import make_option
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import NoArgsCommand
+from django.contrib.contenttypes.models import ContentType
+
+from ...models import DEFAULT_OBJECT_PERMISSION_MODELS
+from ...models import get_typed_object_permission_models
+
+
+class Command(NoArgsCommand):
+    help = ("""Move object permissions of models which primary key is not """
+            """an integer field from the generic integer models to the typed """
+            """models. Run it before `OBJECT_PERMISSION_TYPED_OBJECT_ID` is """
+            """enabled.""")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to move. '
+                'Defaults to the "default" database.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database', DEFAULT_DB_ALIAS)
+        verbosity = int(options.get('verbosity', 1))
+        count = 0
+        with transaction.commit_on_success(using=using):
+            for ct in ContentType.objects.using(using).iterator():
+                models = get_typed_object_permission_models(ct)
+                if models == DEFAULT_OBJECT_PERMISSION_MODELS:
+                    continue
+                for source, target, field in zip(DEFAULT_OBJECT_PERMISSION_MODELS,
+                                                 models, ('user', 'group', None)):
+                    count += self._move(ct, source, target, field, using)
+        if verbosity > 0:
+            return """Moved: %d object permissions\n""" % count
+
+    def _move(self, ct, source, target, field, using):
+        qs = source.objects.using(using).filter(content_type=ct)
+        count = 0
+        for obj in qs.iterator():
+            kwargs = {'content_type': ct, 'object_id': obj.object_id}
+            if field:
+                kwargs['%s_id' % field] = getattr(obj, '%s_id' % field)
+            moved, created = target.objects.using(using).get_or_create(**kwargs)
+            permissions = list(obj.permissions.values_list('pk', flat=True))
+            if permissions:
+                moved.permissions.add(*permissions)
+            count += 1
+        # related permissions rows are deleted by the collector
+        qs.delete()
+        return count
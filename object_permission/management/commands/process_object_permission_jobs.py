@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+process deferred object permission handler jobs stored in the database
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.core.management.base import NoArgsCommand
+
+from ...queues import DatabaseHandlerQueue
+
+class Command(NoArgsCommand):
+    help = ("""Process deferred handler jobs stored in """
+            """`ObjectPermissionHandlerJob` table (run it periodically).""")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        count = DatabaseHandlerQueue().flush()
+        if verbosity > 0:
+            return """Processed: %d\n""" % count
@@ -26,29 +26,83 @@ License:
     limitations under the License.
 """
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from contextlib import contextmanager
+
+from django.db import router
 from django.db.models import Model
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
-from django.contrib.auth.models import Permission
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 
-from models import UserObjectPermission
-from models import GroupObjectPermission
-from models import AnonymousObjectPermission
-from utils import get_perm_codename
-from utils import get_perm_codename_with_suffix
+from models import get_object_permission_models
+from registry import registry
+from storages import CHUNK_SIZE
+from storages import get_storage
+from cache import invalidate
+from utils import chunked
+from utils import chunked_pks
+from utils import commit_on_success_unless_managed
+
+# the target shortcut of AnonymousUser
+ANONYMOUS = 'anonymous'
 
 def get_iterable_instances(instance_or_iterable):
     """get iterable instances from instance_or_iterable"""
     from django.db import models
-    if isinstance(instance_or_iterable, models.Manager):
+    if isinstance(instance_or_iterable, (models.Manager, models.query.QuerySet)):
         instance_or_iterable = instance_or_iterable.iterator()
     elif not hasattr(instance_or_iterable, '__iter__'):
         instance_or_iterable = [instance_or_iterable]
     return instance_or_iterable
 
+class ObjectPermBatch(object):
+    """Buffer of object permission changes used in ObjectPermMediator.batch
+
+    Changes are stored for each acl key as [base, additions, removals] where
+    base is None for the stored permissions or a permission id set.
+    """
+    def __init__(self, reset=False):
+        self.is_reset = reset
+        self.changes = {}
+
+    def _get_change(self, key):
+        return self.changes.setdefault(key, [None, set(), set()])
+
+    def reset(self):
+        """remove all permissions of all targets"""
+        self.is_reset = True
+        self.changes = {}
+
+    def clear(self, key):
+        """remove all permissions of key"""
+        self.changes[key] = [set(), set(), set()]
+
+    def add(self, key, perm_ids):
+        """add perm_ids to key"""
+        change = self._get_change(key)
+        change[1].update(perm_ids)
+        change[2].difference_update(perm_ids)
+
+    def remove(self, key, perm_ids):
+        """remove perm_ids from key"""
+        change = self._get_change(key)
+        change[2].update(perm_ids)
+        change[1].difference_update(perm_ids)
+
+    def resolve(self, current):
+        """get {acl key: permission id set} from the stored current acl"""
+        if self.is_reset:
+            acl = {}
+        else:
+            acl = dict((key, set(perm_ids)) for key, perm_ids in current.iteritems())
+        for key, (base, additions, removals) in self.changes.iteritems():
+            if base is None:
+                base = acl.get(key, set())
+            acl[key] = (base - removals) | additions
+        return acl
+
 class ObjectPermMediatorBase(object):
     """Base Mediator for object-permission"""
 
@@ -62,26 +116,39 @@ class ObjectPermMediatorBase(object):
             raise AttributeError("'%s' is not an instance of model" % instance)
         self.instance = instance
         self._ct = ContentType.objects.get_for_model(instance)
+        # ObjectPermBatch while object permission changes are buffered
+        self._batch = None
 
-    def _get_or_create_permission(self, perm):
-        """get or create django permission instance"""
-        perm_codename = get_perm_codename(perm)
-        try:
-            # try to find permissin without suffix
-            permission = Permission.objects.get(
-                    content_type=self._ct,
-                    codename=perm_codename)
-        except Permission.DoesNotExist:
-            # try to find/create permission with suffix
-            perm_codename = get_perm_codename_with_suffix(perm, self.instance)
-            permission = Permission.objects.get_or_create(
-                    content_type=self._ct,
-                    codename=perm_codename)[0]
-        return permission
-
-    def _get_object_permission_cls(self, target):
-        """get object permission cls suite for target"""
-        ANONYMOUS = 'anonymous'
+    def _invalidate(self):
+        """invalidate cached object permissions of instance"""
+        invalidate((self._ct.pk, self.instance.pk))
+
+    def _get_or_create_permission_id(self, perm):
+        """get or create django permission id from the permission registry"""
+        return registry.get_or_create_id(self._ct, perm, self.instance)
+
+    def _get_user_ids(self, usernames):
+        """get {username: user pk} of usernames with a query for each chunk
+
+        AttributeError is raised with all unknown usernames.
+        """
+        user_ids = {}
+        for chunk in chunked(sorted(set(usernames)), CHUNK_SIZE):
+            user_ids.update(User.objects.filter(
+                    username__in=chunk).values_list('username', 'pk'))
+        unknown = sorted(set(usernames) - set(user_ids))
+        if unknown:
+            raise AttributeError("Unknown usernames %s are passed, you may mean '%s'?" % (
+                    ", ".join("'%s'" % username for username in unknown), ANONYMOUS))
+        return user_ids
+
+    def _get_object_permission_cls(self, target, user_ids=None):
+        """get object permission cls suite for target
+
+        user_ids is {username: user pk} of the usernames resolved in advance.
+        """
+        UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission = \
+                get_object_permission_models(self._ct)
         if isinstance(target, basestring) and target == ANONYMOUS:
             return AnonymousObjectPermission, {}
         elif isinstance(target, AnonymousUser):
@@ -91,30 +158,187 @@ class ObjectPermMediatorBase(object):
         elif target is None or isinstance(target, User) or isinstance(target, basestring):
             if isinstance(target, basestring):
                 # Search from username
-                try:
-                    target = User.objects.get(username=target)
-                except User.DoesNotExist:
-                    raise AttributeError("Unknown parameter '%s' is passed, you may mean '%s'?" % (target, ANONYMOUS))
+                if user_ids is None:
+                    user_ids = self._get_user_ids([target])
+                target = user_ids[target]
             return UserObjectPermission, {'user': target}
         raise AttributeError("Unknown parameter '%s' is passed" % target)
 
-    def _get_or_create_object_permission(self, target):
-        """get or create object permission suite for instance"""
-        model, kwargs = self._get_object_permission_cls(target)
-        return model.objects.get_or_create_object_permission(self.instance, **kwargs)[0]
+    def _get_chunk_targets(self, instances):
+        """get object permission cls suite list for a chunk of instances
+
+        usernames are resolved with a single query.
+        """
+        usernames = [instance for instance in instances
+                     if isinstance(instance, basestring) and instance != ANONYMOUS]
+        user_ids = self._get_user_ids(usernames) if usernames else {}
+        return [self._get_object_permission_cls(instance, user_ids)
+                for instance in instances]
+
+    def _iter_targets(self, instance_or_iterable):
+        """iterate object permission cls suite lists for instance(s) in chunks
+
+        Querysets (or managers) of User or Group are iterated as pk chunks
+        and other iterables are consumed lazily thus only a chunk of
+        principals is in memory at once.
+        """
+        from django.db import models
+        queryset = instance_or_iterable
+        if isinstance(queryset, models.Manager):
+            queryset = queryset.all()
+        if isinstance(queryset, models.query.QuerySet) and \
+                issubclass(queryset.model, (User, Group)):
+            UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission = \
+                    get_object_permission_models(self._ct)
+            if issubclass(queryset.model, User):
+                model, field = UserObjectPermission, 'user'
+            else:
+                model, field = GroupObjectPermission, 'group'
+            for pks in chunked_pks(queryset, CHUNK_SIZE):
+                yield [(model, {field: pk}) for pk in pks]
+            return
+        instances = get_iterable_instances(instance_or_iterable)
+        for chunk in chunked(instances, CHUNK_SIZE):
+            yield self._get_chunk_targets(chunk)
+
+    def _get_targets(self, instance_or_iterable):
+        """get object permission cls suite list for instance(s)"""
+        return [target
+                for targets in self._iter_targets(instance_or_iterable)
+                for target in targets]
+
+    def _get_acl_key(self, target):
+        """get the key of the acl dictionary from (model, kwargs) target"""
+        model, kwargs = target
+        if not kwargs:
+            return model, None
+        field, value = kwargs.items()[0]
+        if isinstance(value, Model):
+            value = value.pk
+        return model, (field, value)
+
+    def _get_acl_target(self, key):
+        """get (model, kwargs) target from the key of the acl dictionary"""
+        model, item = key
+        return model, dict([item]) if item else {}
+
+    def _get_batch_changes(self, batch):
+        """get (removals, additions) between the result of batch and stored
+        object permissions
+
+        Both are {permission id frozenset: acl key list}.
+        """
+        current = get_storage().get_acl(self._ct, self.instance.pk)
+        acl = batch.resolve(current)
+        additions = {}
+        removals = {}
+        for key in set(current) | set(acl):
+            perm_ids = acl.get(key, set())
+            current_perm_ids = current.get(key, set())
+            if perm_ids - current_perm_ids:
+                additions.setdefault(
+                        frozenset(perm_ids - current_perm_ids), []).append(key)
+            if current_perm_ids - perm_ids:
+                removals.setdefault(
+                        frozenset(current_perm_ids - perm_ids), []).append(key)
+        return removals, additions
+
+    def _apply_batch(self, batch):
+        """write the differences between the result of batch and stored
+        object permissions
+
+        Nothing is written when the stored object permissions are same as
+        the result of batch.
+        """
+        storage = get_storage()
+        removals, additions = self._get_batch_changes(batch)
+        for perm_ids, keys in removals.iteritems():
+            targets = [self._get_acl_target(key) for key in keys]
+            storage.remove_many(self._ct, self.instance.pk, targets, perm_ids)
+        for perm_ids, keys in additions.iteritems():
+            targets = [self._get_acl_target(key) for key in keys]
+            storage.add_many(self._ct, self.instance.pk, targets, perm_ids)
+        if additions or removals:
+            self._invalidate()
+
+    @contextmanager
+    def batch(self, reset=False):
+        """buffer object permission changes and flush them on exit
+
+        reset, clear, contribute and discontribute (and the shortcuts like
+        viewer or manager) called in the block are merged, then only the
+        differences to the stored object permissions are written in one
+        transaction (or in the transaction of the caller when it is managed)
+        with bulk statements when the block exits. Nothing is written when an
+        exception is raised in the block.
+
+        Attribute:
+            reset - start from the empty state (as reset is called first)
+
+        Usage::
+
+            with mediator.batch():
+                mediator.manager(instance.author)
+                mediator.viewer(None)
+                mediator.reject('anonymous')
+
+        """
+        if self._batch is not None:
+            # nested batch is merged into the outer batch
+            if reset:
+                self._batch.reset()
+            yield self._batch
+            return
+        self._batch = ObjectPermBatch(reset=reset)
+        try:
+            yield self._batch
+            batch = self._batch
+        finally:
+            self._batch = None
+        using = router.db_for_write(get_object_permission_models(self._ct)[0])
+        with commit_on_success_unless_managed(using=using):
+            self._apply_batch(batch)
+
+    def _apply_targets(self, instance_or_iterable, clear=False,
+                       add=None, remove=None):
+        """clear, add and remove permission ids of instance(s)
+
+        Changes are applied with bulk statements for each chunk of the
+        principals (or buffered in the batch) while the principals are
+        iterated only once.
+        """
+        storage = get_storage()
+        for targets in self._iter_targets(instance_or_iterable):
+            if self._batch is not None:
+                for target in targets:
+                    key = self._get_acl_key(target)
+                    if clear:
+                        self._batch.clear(key)
+                    if remove is not None:
+                        self._batch.remove(key, remove)
+                    if add is not None:
+                        self._batch.add(key, add)
+                continue
+            if clear:
+                storage.clear_many(self._ct, self.instance.pk, targets)
+            if remove is not None:
+                storage.remove_many(self._ct, self.instance.pk, targets, remove)
+            if add is not None:
+                storage.add_many(self._ct, self.instance.pk, targets, add)
+        if self._batch is None:
+            self._invalidate()
 
     def reset(self):
         """reset all permissions of obj"""
-        AnonymousObjectPermission.objects.get_for_model(self.instance).delete()
-        GroupObjectPermission.objects.get_for_model(self.instance).delete()
-        UserObjectPermission.objects.get_for_model(self.instance).delete()
+        if self._batch is not None:
+            self._batch.reset()
+            return
+        get_storage().reset(self._ct, self.instance.pk)
+        self._invalidate()
 
     def clear(self, instance_or_iterable):
         """clear all object permissions of obj for instance(s)"""
-        instance_or_iterable = get_iterable_instances(instance_or_iterable)
-        for instance in instance_or_iterable:
-            object_permission = self._get_or_create_object_permission(instance)
-            object_permission.permissions.clear()
+        self._apply_targets(instance_or_iterable, clear=True)
 
     def contribute(self, instance_or_iterable, permissions=[]):
         """contribute permissions of obj to instance(s)
@@ -128,12 +352,8 @@ class ObjectPermMediatorBase(object):
                                    authenticated users
             permissions          - codename list of permission
         """
-        instance_or_iterable = get_iterable_instances(instance_or_iterable)
-        for instance in instance_or_iterable:
-            object_permission = self._get_or_create_object_permission(instance)
-            for perm in permissions:
-                permission = self._get_or_create_permission(perm)
-                object_permission.permissions.add(permission)
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        self._apply_targets(instance_or_iterable, add=perm_ids)
 
     def discontribute(self, instance_or_iterable, permissions=[]):
         """discontribute permissions of obj to instance(s)
@@ -147,20 +367,17 @@ class ObjectPermMediatorBase(object):
                                    authenticated users
             permissions          - codename list of permission
         """
-        instance_or_iterable = get_iterable_instances(instance_or_iterable)
-        for instance in instance_or_iterable:
-            object_permission = self._get_or_create_object_permission(instance)
-            for perm in permissions:
-                permission = self._get_or_create_permission(perm)
-                object_permission.permissions.remove(permission)
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        self._apply_targets(instance_or_iterable, remove=perm_ids)
 
 class ObjectPermMediator(ObjectPermMediatorBase):
     """Mediator class for object permission"""
     def _contribute(self, instance_or_iterable, permissions, extra_permissions):
         if isinstance(extra_permissions, (list, tuple)):
             permissions += list(extra_permissions)
-        self.clear(instance_or_iterable)
-        self.contribute(instance_or_iterable, permissions)
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        # clear and contribute for each chunk while iterating principals once
+        self._apply_targets(instance_or_iterable, clear=True, add=perm_ids)
 
     def reject(self, instance_or_iterable, extra_permissions=[]):
         """reject all management permission (view, change, delete)"""
@@ -178,3 +395,145 @@ class ObjectPermMediator(ObjectPermMediatorBase):
         """can view, change and delete"""
         permissions = ['view', 'change', 'delete']
         self._contribute(instance_or_iterable, permissions, extra_permissions)
+
+
+class QuerySetPermMediatorBase(ObjectPermMediatorBase):
+    """Base Mediator for object-permission of all objects of a queryset
+
+    Object permissions are written with set-based statements for each chunk
+    of the objects and each chunk is written in its own transaction thus
+    very large querysets are never loaded into memory at once.
+    """
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, queryset, chunk_size=None):
+        """constructor for QuerySetPermMediator
+
+        Attribute:
+            queryset   - QuerySet, Manager or Model class of target objects
+            chunk_size - the number of objects written in one transaction
+        """
+        if hasattr(queryset, '_default_manager'):
+            queryset = queryset._default_manager.all()
+        if not hasattr(queryset, 'values_list'):
+            raise AttributeError("'%s' is not a queryset" % queryset)
+        self.queryset = queryset.all()
+        self.model = queryset.model
+        self._ct = ContentType.objects.get_for_model(self.model)
+        self._batch = None
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def _iter_object_ids(self):
+        """iterate object id lists of the queryset in chunks"""
+        return chunked_pks(self.queryset, self.chunk_size)
+
+    def _apply(self, fn):
+        """call fn with object id list of each chunk in a transaction
+
+        The chunks are written in the transaction of the caller when it is
+        managed. fn is buffered while the changes are batched.
+        """
+        if self._batch is not None:
+            self._batch.append(fn)
+            return
+        using = router.db_for_write(get_object_permission_models(self._ct)[0])
+        for object_ids in self._iter_object_ids():
+            with commit_on_success_unless_managed(using=using):
+                fn(object_ids)
+            for object_id in object_ids:
+                invalidate((self._ct.pk, object_id))
+
+    def _get_or_create_permission_id(self, perm):
+        """get or create django permission id from the permission registry"""
+        return registry.get_or_create_id(self._ct, perm, self.model)
+
+    @contextmanager
+    def batch(self, reset=False):
+        """buffer object permission changes and flush them on exit
+
+        Changes called in the block are written in the called order for each
+        chunk of the objects in one transaction of the chunk when the block
+        exits thus the queryset is iterated only once. Nothing is written
+        when an exception is raised in the block.
+
+        Attribute:
+            reset - start from the empty state (as reset is called first)
+        """
+        if self._batch is not None:
+            # nested batch is merged into the outer batch
+            if reset:
+                self.reset()
+            yield self._batch
+            return
+        self._batch = []
+        try:
+            if reset:
+                self.reset()
+            yield self._batch
+            fns = self._batch
+        finally:
+            self._batch = None
+        if fns:
+            def fn(object_ids):
+                for _fn in fns:
+                    _fn(object_ids)
+            self._apply(fn)
+
+    def reset(self):
+        """reset all permissions of the objects"""
+        storage = get_storage()
+        self._apply(lambda object_ids:
+                storage.reset_objects(self._ct, object_ids))
+
+    def clear(self, instance_or_iterable):
+        """clear all object permissions of the objects for instance(s)"""
+        targets = self._get_targets(instance_or_iterable)
+        storage = get_storage()
+        self._apply(lambda object_ids:
+                storage.clear_objects(self._ct, object_ids, targets))
+
+    def contribute(self, instance_or_iterable, permissions=[]):
+        """contribute permissions of the objects to instance(s)
+
+        See ``ObjectPermMediatorBase.contribute``
+        """
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        targets = self._get_targets(instance_or_iterable)
+        storage = get_storage()
+        self._apply(lambda object_ids:
+                storage.add_objects(self._ct, object_ids, targets, perm_ids))
+
+    def discontribute(self, instance_or_iterable, permissions=[]):
+        """discontribute permissions of the objects to instance(s)
+
+        See ``ObjectPermMediatorBase.discontribute``
+        """
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        targets = self._get_targets(instance_or_iterable)
+        storage = get_storage()
+        self._apply(lambda object_ids:
+                storage.remove_objects(self._ct, object_ids, targets, perm_ids))
+
+    def _contribute(self, instance_or_iterable, permissions, extra_permissions):
+        # clear and contribute in the same transaction of each chunk
+        if isinstance(extra_permissions, (list, tuple)):
+            permissions += list(extra_permissions)
+        perm_ids = [self._get_or_create_permission_id(perm) for perm in permissions]
+        targets = self._get_targets(instance_or_iterable)
+        storage = get_storage()
+        def fn(object_ids):
+            storage.clear_objects(self._ct, object_ids, targets)
+            storage.add_objects(self._ct, object_ids, targets, perm_ids)
+        self._apply(fn)
+
+class QuerySetPermMediator(QuerySetPermMediatorBase, ObjectPermMediator):
+    """Mediator class for object permission of all objects of a queryset
+
+    Usage::
+
+        mediator = QuerySetPermMediator(Article.objects.filter(author=user))
+        mediator.contribute(group, ['view'])
+        mediator.editor(user)
+
+    """
@@ -24,6 +24,7 @@ License:
     limitations under the License.
 """
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
@@ -31,6 +32,7 @@ from django.contrib.auth.models import Permission
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import string_concat
         
 class BaseObjectPermissionManager(models.Manager):
     def get_for_model(self, obj):
@@ -59,13 +61,12 @@ class BaseObjectPermissionManager(models.Manager):
         kwargs = self._get_filter_kwargs(obj, **kwargs)
         return self.get_or_create(**kwargs)
 
-class BaseObjectPermission(models.Model):
+class AbstractObjectPermission(models.Model):
     """
-    Permission model for perticular object
+    Permission model for perticular object without object_id field
     """
     content_type    = models.ForeignKey(
         ContentType, verbose_name=_('content type'), null=True)
-    object_id       = models.PositiveIntegerField(_('object id'), null=True)
     content_object  = generic.GenericForeignKey()
     
     permissions     = models.ManyToManyField(
@@ -73,6 +74,15 @@ class BaseObjectPermission(models.Model):
     
     class Meta:
         abstract    = True
+
+class BaseObjectPermission(AbstractObjectPermission):
+    """
+    Permission model for perticular object
+    """
+    object_id       = models.PositiveIntegerField(_('object id'), null=True)
+    
+    class Meta:
+        abstract    = True
         
 class GroupObjectPermissionManager(BaseObjectPermissionManager):
     def _get_filter_kwargs(self, obj, group):
@@ -155,3 +165,243 @@ class UserObjectPermission(BaseObjectPermission):
 
     def __unicode__(self):
         return u"UserObjectPermission of '%s' for '%s'" % (self.content_object, self.user)
+
+def _create_object_permission_models(prefix, object_id_field):
+    """create user, group and anonymous object permission models which
+    object_id is object_id_field"""
+    def create(model, **fields):
+        opts = model._meta
+        meta = type('Meta', (object,), {
+                'ordering':             opts.ordering,
+                'unique_together':      opts.unique_together,
+                'verbose_name':         string_concat(
+                                            prefix.lower(), ' ', opts.verbose_name),
+                'verbose_name_plural':  string_concat(
+                                            prefix.lower(), ' ', opts.verbose_name_plural),
+            })
+        attrs = {
+                '__module__':   __name__,
+                '__doc__':      '%s with %s object id' % (model.__doc__.strip(), prefix.lower()),
+                '__unicode__':  model.__unicode__.im_func,
+                'Meta':         meta,
+                'object_id':    object_id_field(),
+                'objects':      model.objects.__class__(),
+            }
+        attrs.update(fields)
+        return type(prefix + model.__name__, (AbstractObjectPermission,), attrs)
+    return (
+            create(UserObjectPermission, user=models.ForeignKey(
+                User, blank=True, null=True,
+                verbose_name=_('user'),
+                help_text=_('`None` for all authenticated user'))),
+            create(GroupObjectPermission, group=models.ForeignKey(
+                Group, verbose_name=_('group'))),
+            create(AnonymousObjectPermission),
+        )
+
+CharUserObjectPermission, CharGroupObjectPermission, CharAnonymousObjectPermission = \
+        _create_object_permission_models('Char', lambda: models.CharField(
+            _('object id'), max_length=255, null=True, db_index=True))
+BigIntegerUserObjectPermission, BigIntegerGroupObjectPermission, BigIntegerAnonymousObjectPermission = \
+        _create_object_permission_models('BigInteger', lambda: models.BigIntegerField(
+            _('object id'), null=True, db_index=True))
+
+# (user, group, anonymous) object permission models for the internal type of
+# primary key. Models which primary key is not listed use char models
+OBJECT_PERMISSION_MODELS = {
+    'AutoField':                    (UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission),
+    'IntegerField':                 (UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission),
+    'PositiveIntegerField':         (UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission),
+    'SmallIntegerField':            (UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission),
+    'PositiveSmallIntegerField':    (UserObjectPermission, GroupObjectPermission, AnonymousObjectPermission),
+    'BigIntegerField':              (BigIntegerUserObjectPermission, BigIntegerGroupObjectPermission, BigIntegerAnonymousObjectPermission),
+    'CharField':                    (CharUserObjectPermission, CharGroupObjectPermission, CharAnonymousObjectPermission),
+}
+DEFAULT_OBJECT_PERMISSION_MODELS = OBJECT_PERMISSION_MODELS['AutoField']
+
+_object_permission_models_cache = {}
+def get_object_permission_models(model_or_ct):
+    """get (user, group, anonymous) object permission models of model
+
+    The models are chosen with the type of primary key of model so the type
+    of object_id matches to the type of primary key. The generic integer
+    models are used when ``OBJECT_PERMISSION_TYPED_OBJECT_ID`` is False or
+    the model class is not available.
+    """
+    if not settings.OBJECT_PERMISSION_TYPED_OBJECT_ID:
+        return DEFAULT_OBJECT_PERMISSION_MODELS
+    return get_typed_object_permission_models(model_or_ct)
+
+def get_typed_object_permission_models(model_or_ct):
+    """get (user, group, anonymous) object permission models of model chosen
+    with the type of primary key regardless of
+    ``OBJECT_PERMISSION_TYPED_OBJECT_ID``"""
+    if isinstance(model_or_ct, ContentType):
+        model = model_or_ct.model_class()
+    elif isinstance(model_or_ct, models.Model):
+        model = model_or_ct.__class__
+    else:
+        model = model_or_ct
+    if model is None:
+        return DEFAULT_OBJECT_PERMISSION_MODELS
+    if model not in _object_permission_models_cache:
+        field = model._meta.pk
+        # follow the primary key of the parent (multi-table inheritance)
+        while field.rel:
+            field = field.rel.get_related_field()
+        internal_type = field.get_internal_type()
+        _object_permission_models_cache[model] = OBJECT_PERMISSION_MODELS.get(
+                internal_type, OBJECT_PERMISSION_MODELS['CharField'])
+    return _object_permission_models_cache[model]
+
+def iter_object_permission_models():
+    """iterate all (user, group, anonymous) object permission models"""
+    for models_ in (DEFAULT_OBJECT_PERMISSION_MODELS,
+                    OBJECT_PERMISSION_MODELS['BigIntegerField'],
+                    OBJECT_PERMISSION_MODELS['CharField']):
+        for model in models_:
+            yield model
+
+class ObjectPermissionGrant(models.Model):
+    """
+    Denormalized object permission row used by grant object permission storage
+
+    A row is a single (object, principal, permission) grant so that any
+    permission check can be done with one index-only lookup.
+    """
+    USER = 1
+    AUTHENTICATED = 2
+    GROUP = 3
+    ANONYMOUS = 4
+    PRINCIPAL_KIND_CHOICES = (
+        (USER, _('user')),
+        (AUTHENTICATED, _('authenticated user')),
+        (GROUP, _('group')),
+        (ANONYMOUS, _('anonymous user')),
+    )
+    content_type    = models.ForeignKey(
+        ContentType, verbose_name=_('content type'))
+    object_id       = models.PositiveIntegerField(_('object id'))
+    content_object  = generic.GenericForeignKey()
+    principal_kind  = models.PositiveSmallIntegerField(
+        _('principal kind'), choices=PRINCIPAL_KIND_CHOICES)
+    # pk of user or group. 0 for authenticated and anonymous user
+    principal_id    = models.PositiveIntegerField(_('principal id'), default=0)
+    permission      = models.ForeignKey(
+        Permission, verbose_name=_('permission'))
+
+    class Meta:
+        # the unique index is used as a covering index of permission lookups
+        unique_together     = ('content_type', 'object_id',
+                               'principal_kind', 'principal_id', 'permission')
+        verbose_name        = _('object permission grant')
+        verbose_name_plural = _('object permission grants')
+
+    def __unicode__(self):
+        return u"ObjectPermissionGrant '%s' of '%s' for '%s:%s'" % (
+                self.permission, self.content_object,
+                self.get_principal_kind_display(), self.principal_id)
+
+class ObjectPermissionMask(models.Model):
+    """
+    Permission bitmask of a principal for an object used by bitmask object
+    permission storage
+
+    A row has all permissions of a (object, principal) pair as an integer
+    bitmask so that any permission check can be done with one indexed
+    single-table query. Bit positions are assigned per content type by the
+    permission registry.
+    """
+    content_type    = models.ForeignKey(
+        ContentType, verbose_name=_('content type'))
+    object_id       = models.BigIntegerField(_('object id'))
+    content_object  = generic.GenericForeignKey()
+    principal_kind  = models.PositiveSmallIntegerField(
+        _('principal kind'),
+        choices=ObjectPermissionGrant.PRINCIPAL_KIND_CHOICES)
+    # pk of user or group. 0 for authenticated and anonymous user
+    principal_id    = models.PositiveIntegerField(_('principal id'), default=0)
+    mask            = models.BigIntegerField(_('permission mask'), default=0)
+
+    class Meta:
+        unique_together     = ('content_type', 'object_id',
+                               'principal_kind', 'principal_id')
+        verbose_name        = _('object permission mask')
+        verbose_name_plural = _('object permission masks')
+
+    def __unicode__(self):
+        return u"ObjectPermissionMask '%s' of '%s' for '%s:%s'" % (
+                self.mask, self.content_object,
+                self.get_principal_kind_display(), self.principal_id)
+
+class ObjectPermissionBit(models.Model):
+    """
+    Bit position of a permission in ``ObjectPermissionMask``
+
+    Bit positions are assigned per content type by the permission registry
+    and persisted so that every process uses the same positions. A position
+    of a deleted permission is kept (with null permission) and never reused
+    while existing masks might have the bit.
+    """
+    content_type    = models.ForeignKey(
+        ContentType, verbose_name=_('content type'))
+    permission      = models.ForeignKey(
+        Permission, verbose_name=_('permission'), unique=True, null=True,
+        on_delete=models.SET_NULL)
+    bit             = models.PositiveSmallIntegerField(_('bit'))
+
+    class Meta:
+        ordering            = ('content_type', 'bit')
+        unique_together     = ('content_type', 'bit')
+        verbose_name        = _('object permission bit')
+        verbose_name_plural = _('object permission bits')
+
+    def __unicode__(self):
+        return u"ObjectPermissionBit '%s' of '%s'" % (self.bit, self.permission)
+
+class ObjectPermissionState(models.Model):
+    """
+    Fingerprint of watched attributes of the object when object permissions
+    of the object were built by the handler
+
+    Handlers registered again (e.g. after a process restart) compare the
+    fingerprint and rebuild object permissions only when it is changed.
+    """
+    content_type    = models.ForeignKey(
+        ContentType, verbose_name=_('content type'))
+    object_id       = models.CharField(_('object id'), max_length=255)
+    content_object  = generic.GenericForeignKey()
+    fingerprint     = models.CharField(_('fingerprint'), max_length=40)
+
+    class Meta:
+        unique_together     = ('content_type', 'object_id')
+        verbose_name        = _('object permission state')
+        verbose_name_plural = _('object permission states')
+
+    def __unicode__(self):
+        return u"ObjectPermissionState '%s' of '%s'" % (
+                self.fingerprint, self.content_object)
+
+class ObjectPermissionHandlerJob(models.Model):
+    """
+    Deferred handler invocation stored by ``DatabaseHandlerQueue``
+    """
+    handler         = models.CharField(_('handler'), max_length=255)
+    action          = models.CharField(_('action'), max_length=10)
+    content_type    = models.ForeignKey(
+        ContentType, verbose_name=_('content type'))
+    object_id       = models.CharField(_('object id'), max_length=255)
+    content_object  = generic.GenericForeignKey()
+    instance_created = models.BooleanField(_('instance created'), default=False)
+    attempts        = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    error           = models.TextField(_('error'), blank=True, default='')
+    created_at      = models.DateTimeField(_('created at'), auto_now_add=True)
+
+    class Meta:
+        ordering            = ('pk',)
+        verbose_name        = _('object permission handler job')
+        verbose_name_plural = _('object permission handler jobs')
+
+    def __unicode__(self):
+        return u"ObjectPermissionHandlerJob '%s' of '%s' by '%s'" % (
+                self.action, self.content_object, self.handler)
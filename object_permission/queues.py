@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+object-permission handler queue module
+
+Handler invocations (registration, update and teardown) are enqueued to the
+queue specified with ``OBJECT_PERMISSION_HANDLER_QUEUE`` and processed off
+the request path.
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import time
+import logging
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.db import transaction
+from django.core.signals import request_finished
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_unicode
+from django.utils.importlib import import_module
+from django.contrib.contenttypes.models import ContentType
+
+from models import ObjectPermissionHandlerJob
+from utils import commit_on_success_unless_managed
+
+logger = logging.getLogger(__name__)
+
+def load_queue_class(path):
+    i = path.rfind('.')
+    module, attr = path[:i], path[i+1:]
+    try:
+        mod = import_module(module)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing object permission handler queue %s: "%s"' % (path, e))
+    try:
+        cls = getattr(mod, attr)
+    except AttributeError:
+        raise ImproperlyConfigured('Module "%s" does not define a "%s" object permission handler queue' % (module, attr))
+
+    return cls
+
+_queues = {}
+_queues_lock = threading.Lock()
+def get_queue():
+    """get handler queue instance specified in settings or None"""
+    queue_class = settings.OBJECT_PERMISSION_HANDLER_QUEUE
+    if queue_class is None:
+        return None
+    with _queues_lock:
+        if queue_class not in _queues:
+            cls = queue_class
+            if isinstance(cls, basestring):
+                cls = load_queue_class(cls)
+            _queues[queue_class] = cls()
+        return _queues[queue_class]
+
+def flush():
+    """process all enqueued handler invocations now (e.g. in tests)"""
+    queue = get_queue()
+    if queue is not None:
+        queue.flush()
+
+class HandlerQueueBase(object):
+    """Base class of handler queue
+
+    A job is a dictionary of the handler class path, the action ('save',
+    'update' or 'delete'), the content type id and the object id of the
+    instance. Jobs are run with the fresh instance and retried up to
+    ``OBJECT_PERMISSION_HANDLER_QUEUE_RETRIES`` times.
+    """
+    def __init__(self, retries=None):
+        if retries is None:
+            retries = settings.OBJECT_PERMISSION_HANDLER_QUEUE_RETRIES
+        self.retries = retries
+
+    def put(self, handler_class, action, instance, created=False):
+        """enqueue the handler invocation of action for instance"""
+        self._put({
+            'handler': '%s.%s' % (handler_class.__module__, handler_class.__name__),
+            'action': action,
+            'content_type': ContentType.objects.get_for_model(instance).pk,
+            'object_id': force_unicode(instance.pk),
+            'created': created,
+        })
+
+    def _put(self, job):
+        raise NotImplementedError
+
+    def flush(self):
+        """process all enqueued jobs and return the number of processed jobs"""
+        raise NotImplementedError
+
+    def run(self, job):
+        """run the job in a transaction"""
+        from handlers import load_handler_class
+        handler_class = load_handler_class(job['handler'])
+        model = ContentType.objects.get_for_id(job['content_type']).model_class()
+        object_id = model._meta.pk.to_python(job['object_id'])
+        if job['action'] == 'delete':
+            # the instance is already deleted
+            instance = model(pk=object_id)
+        else:
+            instance = model._default_manager.get(pk=object_id)
+        with commit_on_success_unless_managed():
+            handler_class._run(job['action'], instance, created=job['created'])
+
+    def _run_with_retries(self, job, delay=0):
+        """run the job and retry on failure, return True if it succeeded
+
+        Wait delay seconds before the first retry and double it for each
+        retry (e.g. the instance is not committed yet).
+        """
+        for attempt in range(self.retries + 1):
+            if attempt and delay:
+                time.sleep(delay * 2 ** (attempt - 1))
+            try:
+                self.run(job)
+                return True
+            except Exception:
+                logger.exception("Failed to run object permission handler "
+                                 "job %r (attempt %d)" % (job, attempt + 1))
+        return False
+
+class LocalHandlerQueue(HandlerQueueBase):
+    """Handler queue in the memory of the process
+
+    Jobs are processed when ``flush`` is called.
+    """
+    def __init__(self, retries=None):
+        super(LocalHandlerQueue, self).__init__(retries=retries)
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    def _put(self, job):
+        with self._lock:
+            self._jobs.append(job)
+
+    def flush(self):
+        count = 0
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    return count
+                job = self._jobs.pop(0)
+            self._run_with_retries(job)
+            count += 1
+
+class ThreadPoolHandlerQueue(HandlerQueueBase):
+    """Handler queue processed by worker threads
+
+    The number of worker threads is ``OBJECT_PERMISSION_HANDLER_QUEUE_POOL_SIZE``.
+    Use a single thread to keep the order of jobs of the same instance.
+
+    Jobs put in a managed transaction (e.g. ``TransactionMiddleware``) are
+    submitted to the workers when the request is finished (after the
+    transaction is committed) or when a job is put outside of a managed
+    transaction, thus workers don't read the instance before it is
+    committed. Failed jobs are retried with
+    ``OBJECT_PERMISSION_HANDLER_QUEUE_RETRY_DELAY``.
+    """
+    def __init__(self, retries=None, pool_size=None, retry_delay=None):
+        super(ThreadPoolHandlerQueue, self).__init__(retries=retries)
+        if pool_size is None:
+            pool_size = settings.OBJECT_PERMISSION_HANDLER_QUEUE_POOL_SIZE
+        if retry_delay is None:
+            retry_delay = settings.OBJECT_PERMISSION_HANDLER_QUEUE_RETRY_DELAY
+        self.retry_delay = retry_delay
+        self._pool = ThreadPool(pool_size)
+        self._results = []
+        self._lock = threading.Lock()
+        # jobs put in a managed transaction of each thread
+        self._local = threading.local()
+        request_finished.connect(self._request_finished_reciver, weak=False,
+                dispatch_uid="object_permission.queues.%d" % id(self))
+
+    def _run_in_thread(self, job):
+        try:
+            return self._run_with_retries(job, delay=self.retry_delay)
+        finally:
+            # database connections are opened for each thread
+            for connection in connections.all():
+                connection.close()
+
+    def _get_pending(self):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = []
+        return pending
+
+    def _put(self, job):
+        pending = self._get_pending()
+        pending.append(job)
+        if not transaction.is_managed():
+            self._submit()
+
+    def _submit(self):
+        """submit jobs put in the current thread to the workers"""
+        pending = self._get_pending()
+        if not pending:
+            return
+        jobs, pending[:] = pending[:], []
+        with self._lock:
+            # forget results of finished jobs
+            self._results = [result for result in self._results
+                             if not result.ready()]
+            for job in jobs:
+                self._results.append(
+                        self._pool.apply_async(self._run_in_thread, (job,)))
+
+    def _request_finished_reciver(self, sender, **kwargs):
+        self._submit()
+
+    def flush(self):
+        self._submit()
+        with self._lock:
+            results, self._results = self._results, []
+        for result in results:
+            result.wait()
+        return len(results)
+
+class DatabaseHandlerQueue(HandlerQueueBase):
+    """Handler queue stored in ``ObjectPermissionHandlerJob`` table
+
+    Jobs are processed by ``flush`` (e.g. ``process_object_permission_jobs``
+    command run periodically). A failed job is kept with the error and
+    retried on the next flush until the attempts exceed the retries.
+    """
+    def _put(self, job):
+        ObjectPermissionHandlerJob.objects.create(
+                handler=job['handler'], action=job['action'],
+                content_type_id=job['content_type'],
+                object_id=job['object_id'],
+                instance_created=job['created'])
+
+    def flush(self):
+        count = 0
+        last = 0
+        while True:
+            jobs = list(ObjectPermissionHandlerJob.objects.filter(
+                    pk__gt=last, attempts__lte=self.retries)[:100])
+            if not jobs:
+                return count
+            for job in jobs:
+                last = job.pk
+                try:
+                    self.run({
+                        'handler': job.handler,
+                        'action': job.action,
+                        'content_type': job.content_type_id,
+                        'object_id': job.object_id,
+                        'created': job.instance_created,
+                    })
+                except Exception:
+                    logger.exception("Failed to run object permission handler "
+                                     "job %d" % job.pk)
+                    ObjectPermissionHandlerJob.objects.filter(pk=job.pk).update(
+                            attempts=job.attempts + 1,
+                            error=traceback.format_exc())
+                else:
+                    job.delete()
+                count += 1
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+permission id registry of object-permission
+
+The registry maps (content type id, codename) to the id of django's
+Permission so object permission queries filter on integer ids insted of
+joining auth_permission and matching codename strings. All permissions
+are loaded with a single query when the registry is used first and the
+registry is cleared when a Permission is saved/deleted or syncdb is called.
+
+The registry also assigns bit positions of permissions per content type
+which are used by the bitmask storage. The positions are persisted in
+``ObjectPermissionBit`` table so that they never change once assigned.
+Default permissions of the model (add, change, delete,
+``OBJECT_PERMISSION_EXTRA_DEFAULT_PERMISSIONS`` and ``Meta.permissions``)
+get their positions in the list if they are not taken and other permissions
+of the content type get the first free position after them.
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import threading
+
+from django.conf import settings
+from django.db import router
+from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import signals
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.auth.models import Permission
+from django.contrib.auth.management import _get_permission_codename
+
+from models import ObjectPermissionBit
+from utils import get_perm_codename
+from utils import get_perm_codename_with_suffix
+
+# the sign bit of 64bit integer is not used
+MAX_BITS = 63
+
+class PermissionRegistry(object):
+    """In-process registry of permission ids"""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._maps = None
+        # {content type id: bitmask of positions of deleted permissions}
+        self._unused_bits = {}
+
+    def load(self):
+        """load all permissions if the registry is not loaded yet
+
+        Return (ids, codenames, permissions by content type id, bits by
+        content type id) mappings
+        """
+        maps = self._maps
+        if maps is not None:
+            return maps
+        with self._lock:
+            if self._maps is not None:
+                return self._maps
+            ids = {}
+            codenames = {}
+            by_ct = {}
+            qs = Permission.objects.values_list('pk', 'content_type', 'codename')
+            for pk, ct_id, codename in qs.order_by('pk').iterator():
+                ids[(ct_id, codename)] = pk
+                codenames[pk] = codename
+                by_ct.setdefault(ct_id, []).append((pk, codename))
+            bits = {}
+            qs = ObjectPermissionBit.objects.filter(permission__isnull=False)
+            for ct_id, pk, bit in qs.values_list(
+                    'content_type', 'permission', 'bit').iterator():
+                bits.setdefault(ct_id, {})[pk] = bit
+            for ct_id, positions in bits.items():
+                # positions are assigned to the other permissions when the
+                # content type is used
+                if len(positions) != len(by_ct.get(ct_id, [])):
+                    del bits[ct_id]
+            self._maps = (ids, codenames, by_ct, bits)
+            return self._maps
+
+    def _set(self, ct_id, codename, pk):
+        with self._lock:
+            if self._maps is not None:
+                ids, codenames, by_ct, bits = self._maps
+                ids[(ct_id, codename)] = pk
+                codenames[pk] = codename
+                by_ct.setdefault(ct_id, []).append((pk, codename))
+                by_ct[ct_id].sort()
+                bits.pop(ct_id, None)
+
+    def clear(self):
+        """clear the registry (it is reloaded when it is used next)"""
+        with self._lock:
+            self._maps = None
+            self._unused_bits = {}
+
+    def get_id(self, ct, codename):
+        """get permission id of codename for ct or None if not found"""
+        ids = self.load()[0]
+        pk = ids.get((ct.pk, codename))
+        if pk is None:
+            # the permission might be created in another process
+            pks = Permission.objects.filter(
+                    content_type=ct, codename=codename).values_list('pk', flat=True)[:1]
+            if pks:
+                pk = pks[0]
+                self._set(ct.pk, codename, pk)
+        return pk
+
+    def get_codename(self, pk):
+        """get codename of permission id or None if not found"""
+        codenames = self.load()[1]
+        codename = codenames.get(pk)
+        if codename is None:
+            # the permission might be created in another process
+            rows = Permission.objects.filter(pk=pk).values_list(
+                    'content_type', 'codename')[:1]
+            if rows:
+                ct_id, codename = rows[0]
+                self._set(ct_id, codename, pk)
+        return codename
+
+    def get_ids(self, ct, perm, obj):
+        """get permission ids of perm for ct with and without suffix
+
+        obj can be either a model instance or a model class which is used for
+        determine the suffix of permission codename.
+        """
+        ids = []
+        codenames = set([
+                get_perm_codename(perm),
+                get_perm_codename_with_suffix(perm, obj),
+            ])
+        for codename in codenames:
+            pk = self.get_id(ct, codename)
+            if pk is not None:
+                ids.append(pk)
+        return ids
+
+    def get_or_create_id(self, ct, perm, obj):
+        """get or create permission id of perm for ct
+
+        the permission without suffix is used if exists otherwise the
+        permission with suffix is used (and created if it does not exist)
+        """
+        pk = self.get_id(ct, get_perm_codename(perm))
+        if pk is None:
+            codename = get_perm_codename_with_suffix(perm, obj)
+            pk = self.get_id(ct, codename)
+            if pk is None:
+                pk = Permission.objects.get_or_create(
+                        content_type=ct, codename=codename)[0].pk
+        return pk
+
+    def _get_default_codenames(self, ct):
+        model = ct.model_class()
+        if model is None:
+            return []
+        opts = model._meta
+        actions = ['add', 'change', 'delete']
+        actions += list(settings.OBJECT_PERMISSION_EXTRA_DEFAULT_PERMISSIONS)
+        codenames = [_get_permission_codename(action, opts) for action in actions]
+        codenames += [codename for codename, name in opts.permissions]
+        return codenames
+
+    def get_bits(self, ct):
+        """get {permission id: bit position} of ct"""
+        ids, codenames, by_ct, bits = self.load()
+        positions = bits.get(ct.pk)
+        if positions is None:
+            positions, assigned = self._load_bits(ct, by_ct.get(ct.pk, []))
+            using = router.db_for_write(ObjectPermissionBit)
+            # positions assigned in the transaction of the caller are read
+            # again from the table when they are used next (they are
+            # discarded if the transaction is rolled back)
+            if not assigned or not transaction.is_managed(using=using):
+                bits[ct.pk] = positions
+        return positions
+
+    def _load_bits(self, ct, permissions, retry=True):
+        """load bit positions of ct and assign positions to permissions which
+        don't have them yet
+
+        Return ({permission id: bit position}, True if positions are assigned)
+        """
+        qs = ObjectPermissionBit.objects.filter(content_type=ct)
+        taken = dict(qs.values_list('bit', 'permission'))
+        positions = dict((pk, bit) for bit, pk in taken.iteritems()
+                         if pk is not None)
+        defaults = self._get_default_codenames(ct)
+        new = []
+        for pk, codename in permissions:
+            if pk in positions:
+                continue
+            if codename in defaults and defaults.index(codename) not in taken:
+                bit = defaults.index(codename)
+            else:
+                free = [i for i in range(len(defaults), MAX_BITS) + range(len(defaults))
+                        if i not in taken]
+                if not free:
+                    raise ImproperlyConfigured(
+                            "Content type '%s' has too many permissions for "
+                            "bitmask object permission storage" % ct)
+                bit = free[0]
+            taken[bit] = pk
+            positions[pk] = bit
+            new.append(ObjectPermissionBit(
+                    content_type=ct, permission_id=pk, bit=bit))
+        if new:
+            using = router.db_for_write(ObjectPermissionBit)
+            sid = transaction.savepoint(using=using)
+            try:
+                ObjectPermissionBit.objects.using(using).bulk_create(new)
+            except IntegrityError:
+                # positions are assigned in another process at the same time
+                transaction.savepoint_rollback(sid, using=using)
+                if not retry:
+                    raise
+                return self._load_bits(ct, permissions, retry=False)
+            transaction.savepoint_commit(sid, using=using)
+            transaction.commit_unless_managed(using=using)
+        return positions, bool(new)
+
+    def _reload_bits(self, ct):
+        """read bit positions of ct from the table again
+
+        Positions might be assigned to permissions created in another
+        process. Return {permission id: bit position} of ct.
+        """
+        self.load()
+        unused = 0
+        qs = ObjectPermissionBit.objects.filter(content_type=ct)
+        for pk, bit in qs.values_list('permission', 'bit'):
+            if pk is None:
+                unused |= 1 << bit
+            else:
+                # register the permission created in another process
+                self.get_codename(pk)
+        with self._lock:
+            if self._maps is not None:
+                self._maps[3].pop(ct.pk, None)
+            self._unused_bits[ct.pk] = unused
+        return self.get_bits(ct)
+
+    def get_mask(self, ct, perm_ids):
+        """get bitmask of perm_ids for ct"""
+        bits = self.get_bits(ct)
+        if any(perm_id not in bits for perm_id in perm_ids):
+            bits = self._reload_bits(ct)
+        mask = 0
+        for perm_id in perm_ids:
+            mask |= 1 << bits[perm_id]
+        return mask
+
+    def get_ids_from_mask(self, ct, mask):
+        """get permission id set from bitmask for ct"""
+        if not mask:
+            return set()
+        bits = self.get_bits(ct)
+        known = self._unused_bits.get(ct.pk, 0)
+        for bit in bits.itervalues():
+            known |= 1 << bit
+        if mask & ~known:
+            # the positions are assigned in another process
+            bits = self._reload_bits(ct)
+        return set([pk for pk, bit in bits.iteritems()
+                    if mask & (1 << bit)])
+
+registry = PermissionRegistry()
+
+def _clear_registry_reciver(sender, **kwargs):
+    registry.clear()
+signals.post_save.connect(_clear_registry_reciver, sender=Permission,
+    dispatch_uid="object_permission.registry.post_save")
+signals.post_delete.connect(_clear_registry_reciver, sender=Permission,
+    dispatch_uid="object_permission.registry.post_delete")
+signals.post_syncdb.connect(_clear_registry_reciver,
+    dispatch_uid="object_permission.registry.post_syncdb")
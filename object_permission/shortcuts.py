@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+shortcut functions of object-permission
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+from django.contrib.auth import get_backends
+from django.contrib.contenttypes.models import ContentType
+
+from backends import ObjectPermBackend
+from registry import registry
+
+def _get_backend():
+    """get ObjectPermBackend instance from AUTHENTICATION_BACKENDS"""
+    for backend in get_backends():
+        if isinstance(backend, ObjectPermBackend):
+            return backend
+    return ObjectPermBackend()
+
+def prefetch_object_permissions(user_obj, objects_or_queryset):
+    """prefetch object permissions of objects for user_obj
+
+    Object permissions of all objects are loaded with a few queries and
+    cached on user_obj so following permission checks (e.g. ``has_perm`` or
+    ``of`` operator of ``pif`` templatetag) of the objects don't hit the
+    database. Return the objects (a queryset is evaluated and the result is
+    cached on the queryset).
+
+    Usage::
+
+        object_list = prefetch_object_permissions(request.user,
+                                                  Entry.objects.all())
+
+    """
+    if not hasattr(objects_or_queryset, '_clone'):
+        # iterator may not be iterated twice
+        objects_or_queryset = list(objects_or_queryset)
+    _get_backend().prefetch_object_permissions(user_obj, objects_or_queryset)
+    return objects_or_queryset
+
+def get_objects_for_user(user_obj, perm, queryset):
+    """get queryset filtered to objects which user_obj have perm
+
+    The queryset is filtered in the database with subqueries of object
+    permission tables, so pagination and counting is done in the database.
+    Active superuser has all permissions thus the queryset is returned as it
+    is.
+
+    Attribute:
+        user_obj - User or AnonymousUser instance
+        perm     - permission in django's standard permission format. the
+                   codename with and without model suffix are both checked
+                   (e.g. 'view' and 'blogs.view_entry' for Entry model)
+        queryset - QuerySet, Manager or Model class to filter
+
+    Usage::
+
+        entries = get_objects_for_user(request.user, 'blogs.change_entry', Entry)
+
+    """
+    if hasattr(queryset, '_default_manager'):
+        queryset = queryset._default_manager.all()
+    elif not hasattr(queryset, '_clone'):
+        queryset = queryset.all()
+    if user_obj.is_active and user_obj.is_superuser:
+        return queryset
+    model = queryset.model
+    ct = ContentType.objects.get_for_model(model)
+    perm_ids = registry.get_ids(ct, perm, model)
+    if not perm_ids:
+        # the permission does not exist
+        return queryset.none()
+    q = _get_backend()._get_object_filter(user_obj, model, perm_ids)
+    return queryset.filter(q)
+
+_pool = None
+_pool_lock = threading.Lock()
+def _get_pool():
+    """get the thread pool of permission checks (created on demand)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.OBJECT_PERMISSION_CHECK_POOL_SIZE)
+        return _pool
+
+def _check_many_in_thread(user_obj, perm_obj_pairs):
+    """check_many for a worker thread of the pool
+
+    Database connections are opened for each thread and kept for the life
+    of the thread. The transaction of the reads is finished after each check
+    so the following checks don't see a stale snapshot, and the connections
+    are closed when the check fails (e.g. the connection is lost) so the
+    next check reconnects.
+    """
+    try:
+        results = check_many(user_obj, perm_obj_pairs)
+    except Exception:
+        for connection in connections.all():
+            connection.close()
+        raise
+    for connection in connections.all():
+        connection.rollback_unless_managed()
+    return results
+
+def check_many(user_obj, perm_obj_pairs, pool=None):
+    """check permissions of objects for user_obj in bulk
+
+    Checks are grouped by content type and each group is resolved with one
+    query for each object permission table. Active superuser has all
+    permissions. Return a list of bool in the order of perm_obj_pairs.
+
+    Attribute:
+        user_obj       - User or AnonymousUser instance
+        perm_obj_pairs - list of (perm, obj) pairs
+        pool           - ``True`` or ``multiprocessing.pool.ThreadPool``
+                         instance to resolve the groups concurrently in the
+                         threads. ``True`` for the shared pool which size is
+                         ``OBJECT_PERMISSION_CHECK_POOL_SIZE``
+
+    Usage::
+
+        can_view, can_change = check_many(request.user, [
+                ('blogs.view_entry', entry),
+                ('blogs.change_entry', entry)])
+
+    """
+    perm_obj_pairs = list(perm_obj_pairs)
+    if user_obj.is_active and user_obj.is_superuser:
+        return [True] * len(perm_obj_pairs)
+    if pool is None:
+        return _get_backend().check_many(user_obj, perm_obj_pairs)
+    if pool is True:
+        pool = _get_pool()
+    indexes_by_ct = {}
+    for i, (perm, obj) in enumerate(perm_obj_pairs):
+        ct = ContentType.objects.get_for_model(obj) if obj is not None else None
+        indexes_by_ct.setdefault(ct, []).append(i)
+    groups = indexes_by_ct.values()
+    async_results = [pool.apply_async(_check_many_in_thread, (
+            user_obj, [perm_obj_pairs[i] for i in indexes]))
+        for indexes in groups]
+    results = [False] * len(perm_obj_pairs)
+    for indexes, async_result in zip(groups, async_results):
+        for i, result in zip(indexes, async_result.get()):
+            results[i] = result
+    return results
+
+def check_many_async(user_obj, perm_obj_pairs, pool=None):
+    """check permissions of objects for user_obj in a thread of the pool
+
+    Return ``multiprocessing.pool.AsyncResult`` instance of ``check_many``.
+    Call ``get()`` of the instance to get the results, or ``ready()`` to
+    poll it without blocking (e.g. from an event loop).
+
+    Usage::
+
+        async_result = check_many_async(request.user, perm_obj_pairs)
+        # do something else
+        results = async_result.get(timeout=10)
+
+    """
+    if pool is None or pool is True:
+        pool = _get_pool()
+    return pool.apply_async(_check_many_in_thread,
+                            (user_obj, list(perm_obj_pairs)))
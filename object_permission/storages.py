@@ -0,0 +1,924 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+object permission storages of object-permission
+
+Storage is used by the backend to read object permissions and by the mediator
+to write object permissions. The storage class is specified with
+``OBJECT_PERMISSION_STORAGE_CLASS`` setting.
+
+``M2MObjectPermStorage``
+    Permissions of object permission rows are stored in ManyToMany relation
+    to django's Permission (default)
+
+``GrantObjectPermStorage``
+    Permissions are read from denormalized ``ObjectPermissionGrant`` table.
+    The table is maintained together with ManyToMany relation. Use
+    ``build_object_permission_grants`` command to build it from existing
+    object permissions.
+
+``BitmaskObjectPermStorage``
+    Permissions are read from ``ObjectPermissionMask`` table which has an
+    integer bitmask for each (object, principal). The table is maintained
+    together with ManyToMany relation. Bit positions are assigned per content
+    type by the permission registry. Use ``backfill_object_permission_masks``
+    command to build it from existing object permissions.
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.conf import settings
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import Model
+from django.db.models import Q
+from django.db.models import signals
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from django.contrib.auth.models import User
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+
+from models import ObjectPermissionGrant
+from models import ObjectPermissionMask
+from models import get_object_permission_models
+from models import iter_object_permission_models
+from models import DEFAULT_OBJECT_PERMISSION_MODELS
+from models import OBJECT_PERMISSION_MODELS
+from registry import registry
+from bloom import index
+from cache import get_group_ids
+from cache import invalidate
+from utils import chunked
+
+# the number of items of an ``__in`` lookup (some databases limit the number
+# of variables of a query)
+CHUNK_SIZE = 500
+
+def load_storage_class(path):
+    i = path.rfind('.')
+    module, attr = path[:i], path[i+1:]
+    try:
+        mod = import_module(module)
+    except ImportError, e:
+        raise ImproperlyConfigured('Error importing object permission storage %s: "%s"' % (path, e))
+    try:
+        cls = getattr(mod, attr)
+    except AttributeError:
+        raise ImproperlyConfigured('Module "%s" does not define a "%s" object permission storage' % (module, attr))
+
+    return cls
+
+_storages = {}
+def get_storage():
+    """get object permission storage instance specified in settings"""
+    storage_class = settings.OBJECT_PERMISSION_STORAGE_CLASS
+    if storage_class not in _storages:
+        cls = storage_class
+        if isinstance(cls, basestring):
+            cls = load_storage_class(cls)
+        _storages[storage_class] = cls()
+    return _storages[storage_class]
+
+class ObjectPermStorageBase(object):
+    """Base class of object permission storage
+
+    Object permission target is specified with (model, kwargs) pair which
+    ``ObjectPermMediatorBase._get_object_permission_cls`` returns. Object
+    permission models of the content type are found with
+    ``get_object_permission_models``.
+    """
+
+    def _may_have_rows(self, model, ct, object_id):
+        """return False if model definitely has no rows for object_id
+
+        The negative lookup index is used only when
+        ``OBJECT_PERMISSION_NEGATIVE_FILTER`` is True.
+        """
+        if object_id is None or not settings.OBJECT_PERMISSION_NEGATIVE_FILTER:
+            return True
+        return index.may_contain(model, ct.pk, object_id)
+
+    def _get_querysets(self, user_obj, ct, object_id=None, user=True, group=True,
+                       **lookup_kwargs):
+        """get querysets of object permission rows which user_obj relate
+
+        Attribute:
+            object_id     - object id of the rows. None to filter with
+                            lookup_kwargs
+            user          - include user specific, all authenticated user
+                            and anonymous user rows
+            group         - include rows of groups which user_obj belong
+            lookup_kwargs - extra lookup kwargs of the rows
+
+        Tables which definitely have no rows for object_id are skipped.
+        The default ordering of the rows is cleared.
+        """
+        user_model, group_model, anonymous_model = get_object_permission_models(ct)
+        lookup_kwargs['content_type'] = ct
+        if object_id is not None:
+            lookup_kwargs['object_id'] = object_id
+        querysets = []
+        if user_obj.is_authenticated():
+            if user and self._may_have_rows(user_model, ct, object_id):
+                # user_obj specific and all authenticated user rows
+                qs = user_model.objects.filter(**lookup_kwargs)
+                qs = qs.filter(Q(user=user_obj) | Q(user__isnull=True))
+                querysets.append(qs)
+            group_ids = None
+            if group and self._may_have_rows(group_model, ct, object_id):
+                group_ids = get_group_ids(user_obj)
+            if group_ids:
+                # rows of groups user_obj belong
+                qs = group_model.objects.filter(**lookup_kwargs)
+                qs = qs.filter(group__in=group_ids)
+                querysets.append(qs)
+        elif user and self._may_have_rows(anonymous_model, ct, object_id):
+            # anonymous user rows
+            qs = anonymous_model.objects.filter(**lookup_kwargs)
+            querysets.append(qs)
+        return [qs.order_by() for qs in querysets]
+
+    def _group_targets(self, targets):
+        """group targets into {(model, principal field): principal pk set}
+
+        The principal field is 'user', 'group' or None for anonymous and the
+        principal pk is None for all authenticated user and anonymous.
+        """
+        groups = {}
+        for model, kwargs in targets:
+            field = self._get_principal_field(model)
+            value = kwargs[field] if field else None
+            if isinstance(value, Model):
+                value = value.pk
+            groups.setdefault((model, field), set()).add(value)
+        return groups
+
+    def _get_principal_field(self, model):
+        """get principal field name of model or None for anonymous"""
+        for name in ('user', 'group'):
+            if name in model._meta.get_all_field_names():
+                return name
+        return None
+
+    def _get_principal(self, model, kwargs):
+        """get (principal_kind, principal_id) of the target
+
+        The principal kinds are the ones of ``ObjectPermissionGrant``.
+        """
+        field = self._get_principal_field(model)
+        if field is None:
+            return ObjectPermissionGrant.ANONYMOUS, 0
+        value = kwargs.get(field)
+        if isinstance(value, Model):
+            value = value.pk
+        if field == 'group':
+            return ObjectPermissionGrant.GROUP, value
+        elif value is None:
+            return ObjectPermissionGrant.AUTHENTICATED, 0
+        return ObjectPermissionGrant.USER, value
+
+    def _get_principal_filter(self, user_obj, ct, object_id=None,
+                              user=True, group=True):
+        """get Q filter of principals which user_obj relate or None"""
+        user_model, group_model, anonymous_model = get_object_permission_models(ct)
+        q = None
+        if user_obj.is_authenticated():
+            if user and self._may_have_rows(user_model, ct, object_id):
+                q = (Q(principal_kind=ObjectPermissionGrant.USER,
+                       principal_id=user_obj.pk) |
+                     Q(principal_kind=ObjectPermissionGrant.AUTHENTICATED))
+            group_ids = None
+            if group and self._may_have_rows(group_model, ct, object_id):
+                group_ids = get_group_ids(user_obj)
+            if group_ids:
+                _q = Q(principal_kind=ObjectPermissionGrant.GROUP,
+                       principal_id__in=group_ids)
+                q = _q if q is None else q | _q
+        elif user and self._may_have_rows(anonymous_model, ct, object_id):
+            q = Q(principal_kind=ObjectPermissionGrant.ANONYMOUS)
+        return q
+
+    def _iter_principal_querysets(self, model, ct, object_ids, targets):
+        """iterate querysets of principal rows (e.g. ``ObjectPermissionGrant``)
+        of the objects and targets (in chunks)
+
+        Yield (principal_kind, object ids, principal ids, queryset).
+        """
+        principals = {}
+        for _model, kwargs in targets:
+            principal_kind, principal_id = self._get_principal(_model, kwargs)
+            principals.setdefault(principal_kind, set()).add(principal_id)
+        qs = model.objects.filter(content_type=ct)
+        for chunk in chunked(sorted(set(object_ids)), CHUNK_SIZE):
+            _qs = qs.filter(object_id__in=chunk)
+            for principal_kind, principal_ids in principals.iteritems():
+                for _chunk in chunked(sorted(principal_ids), CHUNK_SIZE):
+                    yield principal_kind, chunk, _chunk, _qs.filter(
+                            principal_kind=principal_kind,
+                            principal_id__in=_chunk)
+
+    def _iter_row_querysets(self, ct, object_ids, model, field, values):
+        """iterate querysets of rows of the objects and principal pks (in chunks)"""
+        qs = model.objects.filter(content_type=ct).order_by()
+        values = set(values)
+        for chunk in chunked(sorted(set(object_ids)), CHUNK_SIZE):
+            _qs = qs.filter(object_id__in=chunk)
+            if field is None:
+                yield _qs
+                continue
+            if None in values:
+                yield _qs.filter(**{'%s__isnull' % field: True})
+            for _chunk in chunked(sorted(values - set([None])), CHUNK_SIZE):
+                yield _qs.filter(**{'%s__in' % field: _chunk})
+
+    def _to_object_ids(self, model, object_ids):
+        """convert object ids to the python type of object_id of model"""
+        to_python = model._meta.get_field('object_id').to_python
+        return set(to_python(object_id) for object_id in object_ids)
+
+    def _get_row_ids(self, ct, object_ids, model, field, values):
+        """get {(object id, principal pk): row id} of existing rows"""
+        row_ids = {}
+        for qs in self._iter_row_querysets(ct, object_ids, model, field, values):
+            if field is None:
+                for pk, object_id in qs.values_list('pk', 'object_id'):
+                    row_ids[(object_id, None)] = pk
+            else:
+                for pk, object_id, value in qs.values_list(
+                        'pk', 'object_id', field):
+                    row_ids[(object_id, value)] = pk
+        return row_ids
+
+    def _get_or_create_row_ids(self, ct, object_ids, model, field, values,
+                               row_ids=None, **defaults):
+        """get {(object id, principal pk): row id} and create missing rows in bulk
+
+        row_ids is {(object id, principal pk): row id} of the rows already
+        found.
+        """
+        object_ids = self._to_object_ids(model, object_ids)
+        if row_ids is None:
+            row_ids = self._get_row_ids(ct, object_ids, model, field, values)
+        row_ids = dict(row_ids)
+        missing = set((object_id, value)
+                      for object_id in object_ids
+                      for value in values) - set(row_ids)
+        if missing:
+            objs = []
+            for object_id, value in missing:
+                kwargs = dict(defaults)
+                if field:
+                    kwargs['%s_id' % field] = value
+                objs.append(model(content_type=ct, object_id=object_id, **kwargs))
+            model.objects.bulk_create(objs)
+            # bulk_create does not send post_save
+            missing_object_ids = set(object_id for object_id, value in missing)
+            for object_id in missing_object_ids:
+                index.add(model, ct.pk, object_id)
+            row_ids.update(self._get_row_ids(
+                    ct, missing_object_ids, model, field,
+                    set(value for object_id, value in missing)))
+        return row_ids
+
+    def get_permission_ids(self, user_obj, ct, object_id, user=True, group=True):
+        """get permission id set of the object which user_obj have"""
+        raise NotImplementedError
+
+    def has_permission(self, user_obj, ct, object_id, perm_id):
+        """check perm_id of the object for user_obj"""
+        return perm_id in self.get_permission_ids(user_obj, ct, object_id)
+
+    def get_permission_ids_in_bulk(self, user_obj, ct, object_ids):
+        """get {object id: permission id set} of objects which user_obj have"""
+        raise NotImplementedError
+
+    def get_object_filter(self, user_obj, ct, perm_ids):
+        """get Q filter of objects which user_obj have any of perm_ids"""
+        raise NotImplementedError
+
+    def get_row_permission_ids(self, object_permission):
+        """get permission id set of an object permission row"""
+        raise NotImplementedError
+
+    def get_acl(self, ct, object_id):
+        """get {(model, kwargs item): permission id set} of the object
+
+        The kwargs item is a (principal field, principal pk) pair of the
+        (model, kwargs) target, or None for anonymous.
+        """
+        raise NotImplementedError
+
+    def add_objects(self, ct, object_ids, targets, perm_ids):
+        """add perm_ids to the targets of the objects in bulk
+
+        targets is a list of (model, kwargs) pair. The number of queries
+        does not depend on the number of targets and depends on the number
+        of objects only by chunks.
+        """
+        raise NotImplementedError
+
+    def remove_objects(self, ct, object_ids, targets, perm_ids):
+        """remove perm_ids from the targets of the objects in bulk"""
+        raise NotImplementedError
+
+    def clear_objects(self, ct, object_ids, targets):
+        """remove all permissions from the targets of the objects in bulk"""
+        raise NotImplementedError
+
+    def add_many(self, ct, object_id, targets, perm_ids):
+        """add perm_ids to the targets of the object in bulk"""
+        self.add_objects(ct, [object_id], targets, perm_ids)
+
+    def remove_many(self, ct, object_id, targets, perm_ids):
+        """remove perm_ids from the targets of the object in bulk"""
+        self.remove_objects(ct, [object_id], targets, perm_ids)
+
+    def clear_many(self, ct, object_id, targets):
+        """remove all permissions from the targets of the object in bulk"""
+        self.clear_objects(ct, [object_id], targets)
+
+    def add(self, ct, object_id, model, kwargs, perm_ids):
+        """add perm_ids to the target of the object"""
+        self.add_many(ct, object_id, [(model, kwargs)], perm_ids)
+
+    def remove(self, ct, object_id, model, kwargs, perm_ids):
+        """remove perm_ids from the target of the object"""
+        self.remove_many(ct, object_id, [(model, kwargs)], perm_ids)
+
+    def clear(self, ct, object_id, model, kwargs):
+        """remove all permissions from the target of the object"""
+        self.clear_many(ct, object_id, [(model, kwargs)])
+
+    def _delete_rows(self, model, ct, object_ids):
+        """delete rows of the objects and their through rows with raw SQL
+
+        Rows are deleted with set-based DELETE statements (for each chunk of
+        object ids) without loading model instances thus no delete signals
+        are sent.
+        """
+        using = router.db_for_write(model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = model._meta
+        cursor = connection.cursor()
+        for chunk in chunked(sorted(set(object_ids)), CHUNK_SIZE):
+            where = "%s = %%s AND %s IN (%s)" % (
+                    qn(opts.get_field('content_type').column),
+                    qn(opts.get_field('object_id').column),
+                    ", ".join(["%s"] * len(chunk)))
+            params = [ct.pk] + list(chunk)
+            for field in opts.many_to_many:
+                cursor.execute(
+                        "DELETE FROM %s WHERE %s IN (SELECT %s FROM %s WHERE %s)" % (
+                            qn(field.rel.through._meta.db_table),
+                            qn(field.m2m_column_name()),
+                            qn(opts.pk.column), qn(opts.db_table), where),
+                        params)
+            cursor.execute("DELETE FROM %s WHERE %s" % (qn(opts.db_table), where),
+                           params)
+        transaction.commit_unless_managed(using=using)
+
+    def _get_row_principal(self, object_permission):
+        """get (principal_kind, principal_id) of the object permission row"""
+        model = type(object_permission)
+        field = self._get_principal_field(model)
+        kwargs = {}
+        if field:
+            kwargs[field] = getattr(object_permission, '%s_id' % field)
+        return self._get_principal(model, kwargs)
+
+    def sync_row(self, object_permission, perm_ids=None):
+        """rebuild storage specific rows of the object permission row
+
+        Called when permissions of the row are modified directly (e.g. in
+        admin site) instead of through the storage. perm_ids is the
+        permission ids of the row. None to read them from the row.
+        """
+        pass
+
+    def reset_objects(self, ct, object_ids):
+        """remove all object permissions of the objects"""
+        for model in get_object_permission_models(ct):
+            self._delete_rows(model, ct, object_ids)
+
+    def reset(self, ct, object_id):
+        """remove all object permissions of the object"""
+        self.reset_objects(ct, [object_id])
+
+class M2MObjectPermStorage(ObjectPermStorageBase):
+    """Object permission storage with ManyToMany relation to Permission"""
+
+    def _get_permission_filter(self, querysets):
+        """get Q filter of Permission related to the rows of querysets
+
+        Each object permission table is checked with a subquery so the
+        user, authenticated, group and anonymous paths are resolved in a
+        single SQL statement.
+        """
+        q = None
+        for qs in querysets:
+            _q = Q(pk__in=qs.values('permissions'))
+            q = _q if q is None else q | _q
+        return q
+
+    def get_permission_ids(self, user_obj, ct, object_id, user=True, group=True):
+        querysets = self._get_querysets(user_obj, ct, object_id,
+                                        user=user, group=group)
+        if not querysets:
+            return set()
+        qs = Permission.objects.filter(self._get_permission_filter(querysets))
+        return set(qs.values_list('pk', flat=True))
+
+    def has_permission(self, user_obj, ct, object_id, perm_id):
+        querysets = self._get_querysets(user_obj, ct, object_id)
+        if not querysets:
+            return False
+        qs = Permission.objects.filter(pk=perm_id)
+        return qs.filter(self._get_permission_filter(querysets)).exists()
+
+    def get_permission_ids_in_bulk(self, user_obj, ct, object_ids):
+        permissions = dict((object_id, set()) for object_id in object_ids)
+        querysets = self._get_querysets(user_obj, ct,
+                                        object_id__in=list(object_ids))
+        querysets = [qs.values_list('object_id', 'permissions')
+                     for qs in querysets]
+        if len(querysets) > 1:
+            # the user, authenticated and group rows are read with a single
+            # UNION ALL statement
+            using = router.db_for_read(querysets[0].model)
+            sqls, params = [], []
+            for qs in querysets:
+                sql, _params = qs.query.get_compiler(using=using).as_sql()
+                sqls.append(sql)
+                params.extend(_params)
+            cursor = connections[using].cursor()
+            cursor.execute(" UNION ALL ".join(sqls), params)
+            rows = cursor.fetchall()
+        else:
+            rows = querysets and querysets[0] or []
+        for object_id, perm_id in rows:
+            if perm_id is not None:
+                permissions[object_id].add(perm_id)
+        return permissions
+
+    def get_object_filter(self, user_obj, ct, perm_ids):
+        querysets = self._get_querysets(user_obj, ct,
+                                        permissions__in=list(perm_ids))
+        q = Q(pk__in=[])
+        for qs in querysets:
+            q = q | Q(pk__in=qs.values('object_id'))
+        return q
+
+    def get_row_permission_ids(self, object_permission):
+        return set(object_permission.permissions.values_list('pk', flat=True))
+
+    def get_acl(self, ct, object_id):
+        acl = {}
+        for model in get_object_permission_models(ct):
+            field = self._get_principal_field(model)
+            qs = model.objects.filter(content_type=ct, object_id=object_id)
+            qs = qs.order_by().values_list(field or 'pk', 'permissions')
+            for value, perm_id in qs:
+                key = (model, (field, value) if field else None)
+                perm_ids = acl.setdefault(key, set())
+                if perm_id is not None:
+                    perm_ids.add(perm_id)
+        return acl
+
+    def _get_through(self, model):
+        """get the through model of permissions and the name of row field"""
+        return model.permissions.through, model._meta.object_name.lower()
+
+    def add_objects(self, ct, object_ids, targets, perm_ids):
+        perm_ids = set(perm_ids)
+        for (model, field), values in self._group_targets(targets).iteritems():
+            row_ids = self._get_row_ids(ct, object_ids, model, field, values)
+            # rows created now don't have any permissions
+            existing_row_ids = row_ids.values()
+            if len(row_ids) < len(values) * len(set(object_ids)):
+                row_ids = self._get_or_create_row_ids(
+                        ct, object_ids, model, field, values, row_ids=row_ids)
+            if not perm_ids:
+                continue
+            through, name = self._get_through(model)
+            existing = set()
+            for chunk in chunked(existing_row_ids, CHUNK_SIZE):
+                qs = through.objects.filter(**{
+                        '%s__in' % name: chunk,
+                        'permission__in': perm_ids})
+                existing.update(qs.values_list(name, 'permission'))
+            through.objects.bulk_create([
+                    through(**{'%s_id' % name: row_id, 'permission_id': perm_id})
+                    for row_id in row_ids.itervalues()
+                    for perm_id in perm_ids
+                    if (row_id, perm_id) not in existing])
+
+    def remove_objects(self, ct, object_ids, targets, perm_ids):
+        perm_ids = set(perm_ids)
+        if not perm_ids:
+            return
+        for (model, field), values in self._group_targets(targets).iteritems():
+            through, name = self._get_through(model)
+            for qs in self._iter_row_querysets(ct, object_ids, model, field, values):
+                through.objects.filter(**{
+                        '%s__in' % name: qs.values('pk'),
+                        'permission__in': perm_ids}).delete()
+
+    def clear_objects(self, ct, object_ids, targets):
+        for (model, field), values in self._group_targets(targets).iteritems():
+            through, name = self._get_through(model)
+            for qs in self._iter_row_querysets(ct, object_ids, model, field, values):
+                through.objects.filter(**{
+                        '%s__in' % name: qs.values('pk')}).delete()
+
+class BitmaskObjectPermStorage(M2MObjectPermStorage):
+    """Object permission storage with integer bitmask
+
+    Writes go to both ManyToMany relation and ``ObjectPermissionMask`` and
+    permissions are checked with one indexed single-table query of
+    ``ObjectPermissionMask`` without joining ManyToMany tables.
+    Content types which object id is not an integer (see
+    ``get_object_permission_models``) are not stored in the mask table and
+    handled as ``M2MObjectPermStorage``.
+    """
+
+    def _has_masks(self, ct):
+        """return True if object permissions of ct are in the mask table"""
+        return get_object_permission_models(ct) in (
+                DEFAULT_OBJECT_PERMISSION_MODELS,
+                OBJECT_PERMISSION_MODELS['BigIntegerField'])
+
+    def _get_masks(self, user_obj, ct, object_id=None, user=True, group=True,
+                   **lookup_kwargs):
+        """get queryset of masks which user_obj relate or None"""
+        q = self._get_principal_filter(user_obj, ct, object_id,
+                                       user=user, group=group)
+        if q is None:
+            return None
+        lookup_kwargs['content_type'] = ct
+        if object_id is not None:
+            lookup_kwargs['object_id'] = object_id
+        return ObjectPermissionMask.objects.filter(q, **lookup_kwargs)
+
+    def _get_mask(self, user_obj, ct, object_id, user=True, group=True):
+        qs = self._get_masks(user_obj, ct, object_id, user=user, group=group)
+        mask = 0
+        if qs is not None:
+            for _mask in qs.values_list('mask', flat=True):
+                mask |= _mask
+        return mask
+
+    def get_permission_ids(self, user_obj, ct, object_id, user=True, group=True):
+        if not self._has_masks(ct):
+            return super(BitmaskObjectPermStorage, self).get_permission_ids(
+                    user_obj, ct, object_id, user=user, group=group)
+        mask = self._get_mask(user_obj, ct, object_id, user=user, group=group)
+        return registry.get_ids_from_mask(ct, mask)
+
+    def has_permission(self, user_obj, ct, object_id, perm_id):
+        if not self._has_masks(ct):
+            return super(BitmaskObjectPermStorage, self).has_permission(
+                    user_obj, ct, object_id, perm_id)
+        mask = self._get_mask(user_obj, ct, object_id)
+        return bool(mask & registry.get_mask(ct, [perm_id]))
+
+    def get_permission_ids_in_bulk(self, user_obj, ct, object_ids):
+        if not self._has_masks(ct):
+            return super(BitmaskObjectPermStorage, self).get_permission_ids_in_bulk(
+                    user_obj, ct, object_ids)
+        masks = dict((object_id, 0) for object_id in object_ids)
+        qs = self._get_masks(user_obj, ct, object_id__in=list(object_ids))
+        if qs is not None:
+            for object_id, mask in qs.values_list('object_id', 'mask'):
+                masks[object_id] |= mask
+        return dict((object_id, registry.get_ids_from_mask(ct, mask))
+                    for object_id, mask in masks.iteritems())
+
+    def get_object_filter(self, user_obj, ct, perm_ids):
+        if not self._has_masks(ct):
+            return super(BitmaskObjectPermStorage, self).get_object_filter(
+                    user_obj, ct, perm_ids)
+        qs = self._get_masks(user_obj, ct)
+        if qs is None:
+            return Q(pk__in=[])
+        qn = connections[router.db_for_read(ObjectPermissionMask)].ops.quote_name
+        # the column is not qualified while the table is relabeled in the
+        # subquery
+        qs = qs.extra(where=['(%s & %%s) != 0' % qn('mask')],
+                      params=[registry.get_mask(ct, perm_ids)])
+        return Q(pk__in=qs.values('object_id'))
+
+    def _update_masks(self, ct, object_ids, principal_kind, principal_ids,
+                      operator, mask):
+        """apply mask to masks of the rows with bitwise operator in raw SQL
+
+        Bitwise operators of ``F`` expressions are not available in newer
+        Django thus the statement is written in SQL.
+        """
+        using = router.db_for_write(ObjectPermissionMask)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = ObjectPermissionMask._meta
+        column = qn(opts.get_field('mask').column)
+        object_ids = list(object_ids)
+        principal_ids = list(principal_ids)
+        connection.cursor().execute(
+                "UPDATE %s SET %s = %s %s %%s WHERE %s = %%s AND %s = %%s "
+                "AND %s IN (%s) AND %s IN (%s)" % (
+                    qn(opts.db_table), column, column, operator,
+                    qn(opts.get_field('content_type').column),
+                    qn(opts.get_field('principal_kind').column),
+                    qn(opts.get_field('object_id').column),
+                    ", ".join(["%s"] * len(object_ids)),
+                    qn(opts.get_field('principal_id').column),
+                    ", ".join(["%s"] * len(principal_ids))),
+                [mask, ct.pk, principal_kind] + object_ids + principal_ids)
+        transaction.commit_unless_managed(using=using)
+
+    def add_objects(self, ct, object_ids, targets, perm_ids):
+        super(BitmaskObjectPermStorage, self).add_objects(
+                ct, object_ids, targets, perm_ids)
+        if not self._has_masks(ct):
+            return
+        mask = registry.get_mask(ct, perm_ids)
+        if not mask:
+            return
+        object_ids = self._to_object_ids(ObjectPermissionMask, object_ids)
+        masks = []
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionMask, ct, object_ids, targets):
+            existing = set(qs.values_list('object_id', 'principal_id'))
+            if existing:
+                self._update_masks(ct, _object_ids, principal_kind,
+                                   principal_ids, '|', mask)
+            masks.extend([ObjectPermissionMask(
+                    content_type=ct, object_id=object_id,
+                    principal_kind=principal_kind, principal_id=principal_id,
+                    mask=mask)
+                for object_id in _object_ids
+                for principal_id in principal_ids
+                if (object_id, principal_id) not in existing])
+        ObjectPermissionMask.objects.bulk_create(masks)
+
+    def remove_objects(self, ct, object_ids, targets, perm_ids):
+        super(BitmaskObjectPermStorage, self).remove_objects(
+                ct, object_ids, targets, perm_ids)
+        if not self._has_masks(ct):
+            return
+        mask = registry.get_mask(ct, perm_ids)
+        if not mask:
+            return
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionMask, ct, object_ids, targets):
+            self._update_masks(ct, _object_ids, principal_kind,
+                               principal_ids, '&', ~mask)
+
+    def clear_objects(self, ct, object_ids, targets):
+        super(BitmaskObjectPermStorage, self).clear_objects(
+                ct, object_ids, targets)
+        if not self._has_masks(ct):
+            return
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionMask, ct, object_ids, targets):
+            qs.delete()
+
+    def sync_row(self, object_permission, perm_ids=None):
+        ct = ContentType.objects.get_for_id(object_permission.content_type_id)
+        if not self._has_masks(ct):
+            return
+        if perm_ids is None:
+            perm_ids = self.get_row_permission_ids(object_permission)
+        principal_kind, principal_id = self._get_row_principal(object_permission)
+        qs = ObjectPermissionMask.objects.filter(
+                content_type=ct, object_id=object_permission.object_id,
+                principal_kind=principal_kind, principal_id=principal_id)
+        mask = registry.get_mask(ct, perm_ids)
+        if not mask:
+            qs.delete()
+        elif not qs.update(mask=mask):
+            ObjectPermissionMask.objects.create(
+                    content_type=ct, object_id=object_permission.object_id,
+                    principal_kind=principal_kind, principal_id=principal_id,
+                    mask=mask)
+
+    def reset_objects(self, ct, object_ids):
+        super(BitmaskObjectPermStorage, self).reset_objects(ct, object_ids)
+        if not self._has_masks(ct):
+            return
+        self._delete_rows(ObjectPermissionMask, ct, object_ids)
+
+class GrantObjectPermStorage(M2MObjectPermStorage):
+    """Object permission storage with denormalized grant table
+
+    Writes go to both ManyToMany relation and ``ObjectPermissionGrant`` and
+    reads are done with a single index-only query of ``ObjectPermissionGrant``.
+    Content types which object id is not an integer (see
+    ``get_object_permission_models``) are not stored in the grant table and
+    handled as ``M2MObjectPermStorage``.
+    """
+
+    def _has_grants(self, ct):
+        """return True if object permissions of ct are in the grant table"""
+        return get_object_permission_models(ct) is DEFAULT_OBJECT_PERMISSION_MODELS
+
+    def _get_grants(self, user_obj, ct, object_id=None, user=True, group=True,
+                    **lookup_kwargs):
+        """get queryset of grants which user_obj relate or None"""
+        q = self._get_principal_filter(user_obj, ct, object_id,
+                                       user=user, group=group)
+        if q is None:
+            return None
+        lookup_kwargs['content_type'] = ct
+        if object_id is not None:
+            lookup_kwargs['object_id'] = object_id
+        return ObjectPermissionGrant.objects.filter(q, **lookup_kwargs)
+
+    def get_permission_ids(self, user_obj, ct, object_id, user=True, group=True):
+        if not self._has_grants(ct):
+            return super(GrantObjectPermStorage, self).get_permission_ids(
+                    user_obj, ct, object_id, user=user, group=group)
+        qs = self._get_grants(user_obj, ct, object_id, user=user, group=group)
+        if qs is None:
+            return set()
+        return set(qs.values_list('permission', flat=True))
+
+    def has_permission(self, user_obj, ct, object_id, perm_id):
+        if not self._has_grants(ct):
+            return super(GrantObjectPermStorage, self).has_permission(
+                    user_obj, ct, object_id, perm_id)
+        qs = self._get_grants(user_obj, ct, object_id, permission=perm_id)
+        if qs is None:
+            return False
+        return qs.exists()
+
+    def get_permission_ids_in_bulk(self, user_obj, ct, object_ids):
+        if not self._has_grants(ct):
+            return super(GrantObjectPermStorage, self).get_permission_ids_in_bulk(
+                    user_obj, ct, object_ids)
+        permissions = dict((object_id, set()) for object_id in object_ids)
+        qs = self._get_grants(user_obj, ct, object_id__in=list(object_ids))
+        if qs is not None:
+            for object_id, perm_id in qs.values_list('object_id', 'permission'):
+                permissions[object_id].add(perm_id)
+        return permissions
+
+    def get_object_filter(self, user_obj, ct, perm_ids):
+        if not self._has_grants(ct):
+            return super(GrantObjectPermStorage, self).get_object_filter(
+                    user_obj, ct, perm_ids)
+        qs = self._get_grants(user_obj, ct, permission__in=list(perm_ids))
+        if qs is None:
+            return Q(pk__in=[])
+        return Q(pk__in=qs.values('object_id'))
+
+    def add_objects(self, ct, object_ids, targets, perm_ids):
+        super(GrantObjectPermStorage, self).add_objects(
+                ct, object_ids, targets, perm_ids)
+        perm_ids = set(perm_ids)
+        if not self._has_grants(ct) or not perm_ids:
+            return
+        object_ids = self._to_object_ids(ObjectPermissionGrant, object_ids)
+        grants = []
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionGrant, ct, object_ids, targets):
+            existing = set(qs.filter(permission__in=perm_ids).values_list(
+                    'object_id', 'principal_id', 'permission'))
+            grants.extend([ObjectPermissionGrant(
+                    content_type=ct, object_id=object_id,
+                    principal_kind=principal_kind, principal_id=principal_id,
+                    permission_id=perm_id)
+                for object_id in _object_ids
+                for principal_id in principal_ids
+                for perm_id in perm_ids
+                if (object_id, principal_id, perm_id) not in existing])
+        ObjectPermissionGrant.objects.bulk_create(grants)
+
+    def remove_objects(self, ct, object_ids, targets, perm_ids):
+        super(GrantObjectPermStorage, self).remove_objects(
+                ct, object_ids, targets, perm_ids)
+        perm_ids = set(perm_ids)
+        if not self._has_grants(ct) or not perm_ids:
+            return
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionGrant, ct, object_ids, targets):
+            qs.filter(permission__in=perm_ids).delete()
+
+    def clear_objects(self, ct, object_ids, targets):
+        super(GrantObjectPermStorage, self).clear_objects(
+                ct, object_ids, targets)
+        if not self._has_grants(ct):
+            return
+        for principal_kind, _object_ids, principal_ids, qs in \
+                self._iter_principal_querysets(
+                    ObjectPermissionGrant, ct, object_ids, targets):
+            qs.delete()
+
+    def sync_row(self, object_permission, perm_ids=None):
+        ct = ContentType.objects.get_for_id(object_permission.content_type_id)
+        if not self._has_grants(ct):
+            return
+        if perm_ids is None:
+            perm_ids = self.get_row_permission_ids(object_permission)
+        principal_kind, principal_id = self._get_row_principal(object_permission)
+        qs = ObjectPermissionGrant.objects.filter(
+                content_type=ct, object_id=object_permission.object_id,
+                principal_kind=principal_kind, principal_id=principal_id)
+        qs.exclude(permission__in=perm_ids).delete()
+        existing = set(qs.values_list('permission', flat=True))
+        ObjectPermissionGrant.objects.bulk_create([ObjectPermissionGrant(
+                content_type=ct, object_id=object_permission.object_id,
+                principal_kind=principal_kind, principal_id=principal_id,
+                permission_id=perm_id)
+            for perm_id in perm_ids if perm_id not in existing])
+
+    def reset_objects(self, ct, object_ids):
+        super(GrantObjectPermStorage, self).reset_objects(ct, object_ids)
+        if not self._has_grants(ct):
+            return
+        self._delete_rows(ObjectPermissionGrant, ct, object_ids)
+
+def _delete_principal_grants_reciver(sender, instance, **kwargs):
+    """delete grants and masks of deleted user or group"""
+    if sender is Group:
+        principal_kind = ObjectPermissionGrant.GROUP
+    else:
+        principal_kind = ObjectPermissionGrant.USER
+    for model in (ObjectPermissionGrant, ObjectPermissionMask):
+        model.objects.filter(
+                principal_kind=principal_kind, principal_id=instance.pk).delete()
+signals.post_delete.connect(_delete_principal_grants_reciver, sender=User,
+    dispatch_uid="object_permission.storages.user_post_delete")
+signals.post_delete.connect(_delete_principal_grants_reciver, sender=Group,
+    dispatch_uid="object_permission.storages.group_post_delete")
+
+def _sync_row(object_permission, perm_ids=None):
+    get_storage().sync_row(object_permission, perm_ids)
+    ct = ContentType.objects.get_for_id(object_permission.content_type_id)
+    object_id = object_permission.object_id
+    model = ct.model_class()
+    if model is not None:
+        # object_id may be stored in a different type (e.g. CharField)
+        object_id = model._meta.pk.to_python(object_id)
+    invalidate((ct.pk, object_id))
+
+def _object_permission_permissions_changed_reciver(sender, instance, action,
+                                                   reverse, model, pk_set,
+                                                   **kwargs):
+    """sync rows of the storage when permissions of object permission rows
+    are modified directly (e.g. in admin site)
+
+    The storage itself writes the ManyToMany table in bulk thus this is not
+    called for changes done through the storage.
+    """
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            _sync_row(instance)
+    elif action == 'pre_clear':
+        # the permission is removed from all rows which have it
+        instance._object_permission_cleared_rows = list(
+                model.objects.filter(permissions=instance))
+    elif action == 'post_clear':
+        for object_permission in instance.__dict__.pop(
+                '_object_permission_cleared_rows', []):
+            _sync_row(object_permission)
+    elif action in ('post_add', 'post_remove'):
+        for object_permission in model.objects.filter(pk__in=pk_set):
+            _sync_row(object_permission)
+
+def _object_permission_deleted_reciver(sender, instance, **kwargs):
+    """sync rows of the storage when an object permission row is deleted"""
+    _sync_row(instance, set())
+
+for model in iter_object_permission_models():
+    signals.m2m_changed.connect(_object_permission_permissions_changed_reciver,
+        sender=model.permissions.through,
+        dispatch_uid="object_permission.storages.m2m_changed.%s" % model.__name__)
+    signals.post_delete.connect(_object_permission_deleted_reciver,
+        sender=model,
+        dispatch_uid="object_permission.storages.post_delete.%s" % model.__name__)
@@ -1 +1,3 @@
 from test_models import *
+from test_backends import *
+from test_mediators import *
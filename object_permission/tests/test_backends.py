@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+Unittest module of backends
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+
+from override_settings import with_apps
+from override_settings import override_settings
+from ..backends import ObjectPermBackend
+from ..mediators import ObjectPermMediator
+from ..models import ObjectPermissionGrant
+from ..registry import registry
+from ..cache import get_shared_cache
+from ..cache import get_group_ids
+from ..cache import clear_user_cache
+from ..bloom import index
+
+@with_apps('object_permission.tests.testapp')
+class ObjectPermBackendTestCase(TestCase):
+    fixtures = ['object_permission_test.yaml']
+
+    def setUp(self):
+        from .. import autodiscover
+        autodiscover()
+        from testapp.models import Article
+        self.backend = ObjectPermBackend()
+        self.foo = User.objects.get(username='foo')
+        self.foofoo = User.objects.get(username='foofoo')
+        self.barbarbar = User.objects.get(username='barbarbar')
+        self.hoge = AnonymousUser()
+
+        self.article = Article.objects.get(pk=1)
+        self.article.pub_state = 'published'
+        self.article.save()
+        # load permission registry and group ids before counting queries
+        registry.load()
+        for user in (self.foo, self.foofoo, self.barbarbar):
+            get_group_ids(user)
+
+    def test_has_perm_single_query(self):
+        # user specific permission
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perm(self.foo, 'app.delete_article', self.article))
+        # group permission
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perm(self.foofoo, 'app.delete_article', self.article))
+        # authenticated user permission
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perm(self.barbarbar, 'app.view_article', self.article))
+        # permissions of the object checked last are reused
+        with self.assertNumQueries(0):
+            self.assert_(not self.backend.has_perm(self.barbarbar, 'app.change_article', self.article))
+        # anonymous user permission
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perm(self.hoge, 'app.view_article', self.article))
+        with self.assertNumQueries(0):
+            self.assert_(not self.backend.has_perm(self.hoge, 'app.change_article', self.article))
+
+    def test_has_perm_group_ids_cached(self):
+        foofoo = User.objects.get(pk=self.foofoo.pk)
+        with self.assertNumQueries(2):
+            self.assert_(self.backend.has_perm(foofoo, 'app.delete_article', self.article))
+        clear_user_cache(foofoo)
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perm(foofoo, 'app.delete_article', self.article))
+        # modification of groups invalidate the cached group ids
+        foofoo.groups.clear()
+        with self.assertNumQueries(2):
+            self.assert_(not self.backend.has_perm(foofoo, 'app.delete_article', self.article))
+
+    def test_has_perm_without_object(self):
+        with self.assertNumQueries(0):
+            self.assert_(not self.backend.has_perm(self.foo, 'app.view_article'))
+
+    def test_has_perm_user_cache(self):
+        with override_settings(OBJECT_PERMISSION_USER_CACHE=True):
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.barbarbar, 'app.view_article', self.article))
+            with self.assertNumQueries(0):
+                self.assert_(self.backend.has_perm(self.barbarbar, 'app.view_article', self.article))
+                self.assert_(not self.backend.has_perm(self.barbarbar, 'app.change_article', self.article))
+            # modification via mediator invalidate the cache
+            mediator = ObjectPermMediator(self.article)
+            mediator.contribute(self.barbarbar, ['change'])
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.barbarbar, 'app.change_article', self.article))
+
+    def test_cache_versions_bounded(self):
+        from .. import cache
+        max_versions = cache.MAX_VERSIONS
+        cache.MAX_VERSIONS = 2
+        try:
+            version = cache.get_version(('test', 0))
+            for i in range(5):
+                cache.invalidate(('test', i))
+            self.assert_(len(cache._versions) <= 2)
+            # the version of the dropped key is changed
+            self.assertNotEqual(cache.get_version(('test', 0)), version)
+            version = cache.get_version(('test', 4))
+            cache.invalidate(('test', 5))
+            self.assertEqual(cache.get_version(('test', 4)), version)
+        finally:
+            cache.MAX_VERSIONS = max_versions
+
+    def test_has_perm_shared_cache(self):
+        caches = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'object_permission': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'object_permission_test',
+            },
+        }
+        with override_settings(OBJECT_PERMISSION_CACHE='object_permission', CACHES=caches):
+            get_shared_cache().clear()
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.barbarbar, 'app.view_article', self.article))
+            # the cache is shared between user instances
+            barbarbar = User.objects.get(pk=self.barbarbar.pk)
+            get_group_ids(barbarbar)
+            with self.assertNumQueries(0):
+                self.assert_(self.backend.has_perm(barbarbar, 'app.view_article', self.article))
+                self.assert_(not self.backend.has_perm(barbarbar, 'app.change_article', self.article))
+            # modification via mediator invalidate the cache
+            mediator = ObjectPermMediator(self.article)
+            mediator.contribute(self.barbarbar, ['change'])
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(barbarbar, 'app.change_article', self.article))
+            # modification of groups invalidate the cache of the user
+            self.assert_(not self.backend.has_perm(barbarbar, 'app.delete_article', self.article))
+            barbarbar.groups.add(1)
+            with self.assertNumQueries(2):
+                self.assert_(self.backend.has_perm(barbarbar, 'app.delete_article', self.article))
+
+    def test_invalidate_after_commit(self):
+        from django.core.signals import request_finished
+        from .. import cache
+        caches = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'object_permission': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'object_permission_test',
+            },
+        }
+        with override_settings(OBJECT_PERMISSION_CACHE='object_permission', CACHES=caches):
+            get_shared_cache().clear()
+            self.assert_(self.backend.has_perm(self.barbarbar, 'app.view_article', self.article))
+            key = cache.get_cache_key(self.article)
+            versions = cache.get_shared_cache_entry(self.barbarbar, key)[1]
+            # the transaction of the test case is managed thus the versions
+            # are bumped when the mediator writes and after the commit
+            mediator = ObjectPermMediator(self.article)
+            mediator.contribute(self.barbarbar, ['change'])
+            bumped = cache.get_shared_cache_entry(self.barbarbar, key)[1]
+            self.assertNotEqual(bumped, versions)
+            version = cache.get_version(key)
+            request_finished.send(sender=self.__class__)
+            self.assertNotEqual(cache.get_shared_cache_entry(self.barbarbar, key)[1], bumped)
+            self.assertNotEqual(cache.get_version(key), version)
+            # nothing is pending anymore
+            bumped = cache.get_shared_cache_entry(self.barbarbar, key)[1]
+            request_finished.send(sender=self.__class__)
+            self.assertEqual(cache.get_shared_cache_entry(self.barbarbar, key)[1], bumped)
+
+    def test_has_perm_negative_filter(self):
+        from django.contrib.auth.models import Group
+        group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(group)
+        with override_settings(OBJECT_PERMISSION_NEGATIVE_FILTER=True):
+            index.build()
+            with self.assertNumQueries(0):
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                self.assert_(not self.backend.has_perm(self.hoge, 'auth.change_group', group))
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.foo, 'app.change_article', self.article))
+            # object permissions created in the process are added to the index
+            ObjectPermMediator(group).contribute(self.foo, ['change'])
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.foo, 'auth.change_group', group))
+
+    def test_negative_filter_rebuild(self):
+        import threading
+        from django.contrib.auth.models import Group
+        group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(group)
+        called = threading.Event()
+        def rebuild_in_thread():
+            index._rebuilding = False
+            called.set()
+        index._rebuild_in_thread = rebuild_in_thread
+        try:
+            with override_settings(OBJECT_PERMISSION_NEGATIVE_FILTER=True):
+                index.clear()
+                # permission checks are not blocked by building the filters
+                with self.assertNumQueries(1):
+                    self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                self.assert_(called.wait(5))
+                index.build()
+                clear_user_cache(self.foo)
+                with self.assertNumQueries(0):
+                    self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                # expired filters are used while they are rebuilt
+                called.clear()
+                index._built_at = 0
+                clear_user_cache(self.foo)
+                with self.assertNumQueries(0):
+                    self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                self.assert_(called.wait(5))
+        finally:
+            del index._rebuild_in_thread
+            index.clear()
+
+    def test_has_perm_bitmask_storage(self):
+        from django.core.management import call_command
+        from ..shortcuts import get_objects_for_user
+        from django.contrib.auth.models import Group
+        group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(group)
+        storage_class = 'object_permission.storages.BitmaskObjectPermStorage'
+        with override_settings(OBJECT_PERMISSION_STORAGE_CLASS=storage_class):
+            call_command('backfill_object_permission_masks', verbosity=0)
+            registry.load()
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.foofoo, 'app.view_article', self.article))
+            with self.assertNumQueries(1):
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+            self.assertEqual(
+                    self.backend.get_all_permissions(self.foofoo, self.article),
+                    set(['testapp.view_article', 'testapp.change_article', 'testapp.delete_article']))
+            mediator = ObjectPermMediator(group)
+            mediator.contribute(self.foo, ['change', 'delete'])
+            self.assert_(self.backend.has_perm(self.foo, 'auth.change_group', group))
+            mediator.discontribute(self.foo, ['change'])
+            self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+            self.assert_(self.backend.has_perm(self.foo, 'auth.delete_group', group))
+            self.assertEqual(
+                    list(get_objects_for_user(self.foo, 'auth.delete_group', Group)),
+                    [group])
+            # permission contributed in another process (the permission and
+            # the bit position are not known in this process)
+            from django.contrib.auth.models import Permission
+            from ..models import ObjectPermissionBit
+            from ..models import ObjectPermissionMask
+            ct = ContentType.objects.get_for_model(group)
+            Permission.objects.bulk_create([Permission(
+                    content_type=ct, codename='publish_group', name='Can publish group')])
+            perm = Permission.objects.get(content_type=ct, codename='publish_group')
+            ObjectPermissionBit.objects.create(content_type=ct, permission=perm, bit=40)
+            masks = ObjectPermissionMask.objects.filter(content_type=ct,
+                    object_id=group.pk, principal_kind=ObjectPermissionGrant.USER,
+                    principal_id=self.foo.pk)
+            masks.update(mask=masks[0].mask | (1 << 40))
+            foo = User.objects.get(pk=self.foo.pk)
+            self.assert_(self.backend.has_perm(foo, 'auth.publish_group', group))
+            self.assert_(self.backend.has_perm(foo, 'auth.delete_group', group))
+            masks.update(mask=0)
+        # bit positions are persisted and a position of a deleted permission
+        # is never reused
+        from django.contrib.auth.models import Permission
+        ct = ContentType.objects.get_for_model(group)
+        bits = dict(registry.get_bits(ct))
+        registry.clear()
+        self.assertEqual(registry.get_bits(ct), bits)
+        perm = Permission.objects.create(
+                content_type=ct, codename='foo_group', name='Can foo group')
+        bit = registry.get_bits(ct)[perm.pk]
+        self.assert_(bit not in bits.values())
+        perm.delete()
+        perm = Permission.objects.create(
+                content_type=ct, codename='bar_group', name='Can bar group')
+        self.assert_(registry.get_bits(ct)[perm.pk] not in
+                     bits.values() + [bit])
+        # ManyToMany relation is maintained together thus the storage can be
+        # switched back
+        self.assert_(self.backend.has_perm(self.foo, 'auth.delete_group', group))
+        self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+
+    def test_has_perm_grant_storage(self):
+        from django.core.management import call_command
+        from django.contrib.auth.models import Group
+        group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(group)
+        storage_class = 'object_permission.storages.GrantObjectPermStorage'
+        with override_settings(OBJECT_PERMISSION_STORAGE_CLASS=storage_class):
+            call_command('build_object_permission_grants', verbosity=0)
+            with self.assertNumQueries(1):
+                self.assert_(self.backend.has_perm(self.foofoo, 'app.view_article', self.article))
+            with self.assertNumQueries(1):
+                self.assert_(not self.backend.has_perm(self.hoge, 'app.change_article', self.article))
+            self.assertEqual(
+                    self.backend.get_all_permissions(self.foofoo, self.article),
+                    set(['testapp.view_article', 'testapp.change_article', 'testapp.delete_article']))
+            mediator = ObjectPermMediator(group)
+            mediator.contribute(self.foo, ['change', 'delete'])
+            self.assert_(self.backend.has_perm(self.foo, 'auth.change_group', group))
+            mediator.discontribute(self.foo, ['change'])
+            self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+            self.assert_(self.backend.has_perm(self.foo, 'auth.delete_group', group))
+            # grants of deleted user are deleted
+            grants = ObjectPermissionGrant.objects.filter(
+                    content_type=ContentType.objects.get_for_model(group),
+                    principal_kind=ObjectPermissionGrant.USER,
+                    principal_id=self.foo.pk)
+            self.assert_(grants.exists())
+            self.foo.delete()
+            self.assert_(not grants.exists())
+
+    def test_direct_permission_changes(self):
+        # permissions of object permission rows modified directly (e.g. in
+        # admin site) are synced to the storage
+        from django.core.management import call_command
+        from django.contrib.auth.models import Group
+        from django.contrib.auth.models import Permission
+        from ..models import UserObjectPermission
+        group = Group.objects.get(pk=1)
+        ct = ContentType.objects.get_for_model(group)
+        change = Permission.objects.get(content_type=ct, codename='change_group')
+        delete = Permission.objects.get(content_type=ct, codename='delete_group')
+        for storage_class in ('object_permission.storages.BitmaskObjectPermStorage',
+                              'object_permission.storages.GrantObjectPermStorage'):
+            with override_settings(OBJECT_PERMISSION_STORAGE_CLASS=storage_class):
+                call_command('backfill_object_permission_masks', verbosity=0)
+                call_command('build_object_permission_grants', verbosity=0)
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                row = UserObjectPermission.objects.create_object_permission(
+                        group, user=self.foo)
+                row.permissions.add(change, delete)
+                self.assert_(self.backend.has_perm(self.foo, 'auth.change_group', group))
+                row.permissions.remove(change)
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+                self.assert_(self.backend.has_perm(self.foo, 'auth.delete_group', group))
+                delete.userobjectpermission_set.clear()
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.delete_group', group))
+                change.userobjectpermission_set.add(row)
+                self.assert_(self.backend.has_perm(self.foo, 'auth.change_group', group))
+                row.delete()
+                self.assert_(not self.backend.has_perm(self.foo, 'auth.change_group', group))
+
+    def test_typed_object_id(self):
+        from testapp.models import Tag
+        from ..models import CharUserObjectPermission
+        from ..shortcuts import get_objects_for_user
+        tag = Tag.objects.create(slug='foo')
+        Tag.objects.create(slug='bar')
+        with override_settings(OBJECT_PERMISSION_TYPED_OBJECT_ID=True):
+            ObjectPermMediator(tag).contribute(self.foo, ['change'])
+            self.assertEqual(CharUserObjectPermission.objects.filter(
+                    object_id='foo', user=self.foo).count(), 1)
+            self.assert_(self.backend.has_perm(self.foo, 'testapp.change_tag', tag))
+            self.assert_(not self.backend.has_perm(self.foofoo, 'testapp.change_tag', tag))
+            self.assertEqual(
+                    list(get_objects_for_user(self.foo, 'testapp.change_tag', Tag)),
+                    [tag])
+
+    def test_move_typed_object_permissions(self):
+        from django.core.management import call_command
+        from testapp.models import Tag
+        from ..models import UserObjectPermission
+        from ..models import CharUserObjectPermission
+        # stored in the generic integer models (numeric slug)
+        tag = Tag.objects.create(slug='1')
+        ObjectPermMediator(tag).contribute(self.foo, ['change'])
+        ObjectPermMediator(tag).contribute(self.foofoo, ['view'])
+        ObjectPermMediator(self.article).contribute(self.foo, ['change'])
+        self.assertEqual(UserObjectPermission.objects.filter(
+                content_type=ContentType.objects.get_for_model(Tag)).count(), 2)
+        with override_settings(OBJECT_PERMISSION_TYPED_OBJECT_ID=True):
+            # permissions in the generic models are not seen anymore
+            self.assert_(not self.backend.has_perm(self.foo, 'testapp.change_tag', tag))
+            call_command('move_typed_object_permissions', verbosity=0)
+            self.assertEqual(UserObjectPermission.objects.filter(
+                    content_type=ContentType.objects.get_for_model(Tag)).count(), 0)
+            self.assertEqual(CharUserObjectPermission.objects.filter(
+                    object_id='1').count(), 2)
+            foo = User.objects.get(pk=self.foo.pk)
+            self.assert_(self.backend.has_perm(foo, 'testapp.change_tag', tag))
+            self.assert_(not self.backend.has_perm(foo, 'testapp.view_tag', tag))
+            foofoo = User.objects.get(pk=self.foofoo.pk)
+            self.assert_(self.backend.has_perm(foofoo, 'testapp.view_tag', tag))
+            # object permissions of integer primary key models are kept
+            self.assert_(self.backend.has_perm(foo, 'app.change_article', self.article))
+
+    def test_registry_fallback(self):
+        from django.contrib.auth.models import Permission
+        ct = ContentType.objects.get_for_model(self.article)
+        # permission created in another process (the registry is not cleared)
+        Permission.objects.bulk_create([Permission(
+                content_type=ct, codename='foo_article', name='Can foo article')])
+        perm = Permission.objects.get(content_type=ct, codename='foo_article')
+        self.assertEqual(registry.get_codename(perm.pk), 'foo_article')
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_id(ct, 'foo_article'), perm.pk)
+        self.assertEqual(registry.get_codename(-1), None)
+
+    def test_get_all_permissions(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                    self.backend.get_all_permissions(self.foofoo, self.article),
+                    set(['testapp.view_article', 'testapp.change_article', 'testapp.delete_article']))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                    self.backend.get_user_permissions(self.foofoo, self.article),
+                    set(['testapp.view_article']))
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                    self.backend.get_group_permissions(self.barbarbar, self.article),
+                    set())
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                    self.backend.get_all_permissions(self.hoge, self.article),
+                    set(['testapp.view_article']))
+        self.assertEqual(self.backend.get_all_permissions(self.foo), set())
+
+    def test_has_perms(self):
+        with self.assertNumQueries(1):
+            self.assert_(self.backend.has_perms(self.foo, [
+                'app.view_article', 'app.change_article', 'app.delete_article'], self.article))
+        with self.assertNumQueries(1):
+            self.assert_(not self.backend.has_perms(self.barbarbar, [
+                'app.view_article', 'app.change_article'], self.article))
+        # User.has_perms calls has_perm of backends for each permission and
+        # the permissions of the object are loaded once
+        with self.assertNumQueries(1):
+            self.assert_(self.foofoo.has_perms([
+                'app.view_article', 'app.change_article', 'app.delete_article'], self.article))
+        with self.assertNumQueries(1):
+            self.assert_(not self.hoge.has_perms([
+                'app.view_article', 'app.change_article'], self.article))
+        # modification via mediator invalidate the permissions
+        ObjectPermMediator(self.article).discontribute(self.foofoo, ['delete'])
+        ObjectPermMediator(self.article).discontribute(self.foofoo.groups.all(), ['delete'])
+        with self.assertNumQueries(1):
+            self.assert_(not self.foofoo.has_perms([
+                'app.view_article', 'app.delete_article'], self.article))
+
+    def test_prefetch_object_permissions(self):
+        from testapp.models import Article
+        from ..shortcuts import prefetch_object_permissions
+        for i in range(3):
+            Article.objects.create(title='article%d' % i, author=self.foo)
+        queryset = Article.objects.all()
+        # the objects and the user and group object permissions
+        with self.assertNumQueries(2):
+            prefetch_object_permissions(self.foofoo, queryset)
+        with self.assertNumQueries(0):
+            for article in queryset:
+                self.assertEqual(
+                        self.foofoo.has_perm('app.view_article', article),
+                        article.pk == self.article.pk)
+        # anonymous object permissions
+        with self.assertNumQueries(2):
+            prefetch_object_permissions(self.hoge, Article.objects.all())
+        with self.assertNumQueries(0):
+            self.assert_(self.hoge.has_perm('app.view_article', self.article))
+
+    def test_check_many(self):
+        from django.contrib.auth.models import Group
+        from ..shortcuts import check_many
+        from ..shortcuts import check_many_async
+        group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(group)
+        ObjectPermMediator(group).contribute(self.foofoo, ['change'])
+        pairs = [
+            ('app.view_article', self.article),
+            ('auth.change_group', group),
+            ('app.delete_article', self.article),
+            ('auth.delete_group', group),
+            ('app.view_article', None),
+        ]
+        # one query for each content type
+        with self.assertNumQueries(2):
+            self.assertEqual(check_many(self.foofoo, pairs),
+                             [True, True, True, False, False])
+        with self.assertNumQueries(2):
+            self.assertEqual(check_many(self.hoge, pairs),
+                             [True, False, False, False, False])
+        # object permissions are loaded in the worker threads which share
+        # the connection of the test (in-memory database) and the connection
+        # is kept open between the checks
+        from multiprocessing.pool import ThreadPool
+        from django.db import connections
+        shared = dict((conn.alias, conn) for conn in connections.all())
+        def share_connections():
+            for alias, conn in shared.iteritems():
+                connections[alias] = conn
+        closed = []
+        for conn in shared.values():
+            conn.allow_thread_sharing = True
+            conn.close = lambda alias=conn.alias: closed.append(alias)
+        pool = ThreadPool(1, share_connections)
+        try:
+            for i in range(2):
+                self.assertEqual(check_many(self.foofoo, pairs, pool=pool),
+                                 [True, True, True, False, False])
+            self.assertEqual(closed, [])
+        finally:
+            pool.terminate()
+            for conn in shared.values():
+                conn.allow_thread_sharing = False
+                del conn.close
+        # cached object permissions are used in the worker threads
+        from ..shortcuts import prefetch_object_permissions
+        prefetch_object_permissions(self.foofoo, [self.article, group])
+        self.assertEqual(check_many(self.foofoo, pairs, pool=True),
+                         [True, True, True, False, False])
+        self.assertEqual(check_many_async(self.foofoo, pairs).get(timeout=10),
+                         [True, True, True, False, False])
+
+    def test_get_objects_for_user(self):
+        from testapp.models import Article
+        from ..shortcuts import get_objects_for_user
+        article = Article.objects.create(title='article', author=self.barbarbar)
+        # user specific, group, authenticated and anonymous permissions
+        qs = get_objects_for_user(self.barbarbar, 'app.delete_article', Article)
+        self.assertEqual(list(qs.values_list('pk', flat=True)), [article.pk])
+        qs = get_objects_for_user(self.foofoo, 'app.delete_article', Article.objects.all())
+        self.assertEqual(list(qs.values_list('pk', flat=True)), [self.article.pk])
+        qs = get_objects_for_user(self.barbarbar, 'view', Article.objects)
+        self.assertEqual(qs.count(), 2)
+        qs = get_objects_for_user(self.hoge, 'app.view_article', Article)
+        self.assertEqual(list(qs.values_list('pk', flat=True)), [self.article.pk])
+        qs = get_objects_for_user(self.hoge, 'app.change_article', Article)
+        self.assertEqual(qs.count(), 0)
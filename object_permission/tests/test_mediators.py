@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf8:
+"""
+Unittest module of mediators
+
+
+AUTHOR:
+    lambdalisue[Ali su ae] (lambdalisue@hashnote.net)
+    
+Copyright:
+    Copyright 2011 Alisue allright reserved.
+
+License:
+    Licensed under the Apache License, Version 2.0 (the "License"); 
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unliss required by applicable law or agreed to in writing, software
+    distributed under the License is distrubuted on an "AS IS" BASICS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import transaction
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+
+from override_settings import with_apps
+from override_settings import override_settings
+from ..mediators import ObjectPermMediator
+from ..mediators import QuerySetPermMediator
+from ..registry import registry
+from ..models import UserObjectPermission
+
+@with_apps('object_permission.tests.testapp')
+class ObjectPermMediatorTestCase(TestCase):
+    fixtures = ['object_permission_test.yaml']
+
+    def setUp(self):
+        self.group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(self.group)
+        registry.load()
+        self.mediator = ObjectPermMediator(self.group)
+
+    def _create_users(self, prefix, count):
+        User.objects.bulk_create([
+            User(username='%s%d' % (prefix, i)) for i in range(count)])
+        return list(User.objects.filter(username__startswith=prefix))
+
+    def _assign_bits(self):
+        """assign bit positions of the bitmask storage before counting queries"""
+        from django.core.management import call_command
+        call_command('backfill_object_permission_masks', verbosity=0)
+        registry.load()
+
+    def _capture_queries(self, fn, *args):
+        from django.db import connection
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = len(connection.queries)
+            fn(*args)
+            return [query['sql'] for query in connection.queries[start:]]
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+
+    def _count_queries(self, fn, *args):
+        return len(self._capture_queries(fn, *args))
+
+    def _count_writes(self, fn, *args):
+        return len([sql for sql in self._capture_queries(fn, *args)
+                    if not sql.startswith('SELECT')])
+
+    def test_contribute_many(self):
+        storages = (
+            'object_permission.storages.M2MObjectPermStorage',
+            'object_permission.storages.BitmaskObjectPermStorage',
+            'object_permission.storages.GrantObjectPermStorage',
+        )
+        self._assign_bits()
+        for i, storage_class in enumerate(storages):
+            with override_settings(OBJECT_PERMISSION_STORAGE_CLASS=storage_class):
+                few = self._create_users('few%d_' % i, 3)
+                many = self._create_users('many%d_' % i, 30)
+                for method, args in (('viewer', ()),
+                                     ('discontribute', (['view'],)),
+                                     ('editor', ()),
+                                     ('clear', ())):
+                    fn = getattr(self.mediator, method)
+                    # the number of queries does not depend on the users
+                    self.assertEqual(self._count_queries(fn, few, *args),
+                                     self._count_queries(fn, many, *args))
+                self.mediator.contribute(many + [None, 'anonymous'], ['view'])
+                self.mediator.contribute(many, ['view', 'change'])
+                for user in many:
+                    self.assert_(user.has_perm('auth.view_group', self.group))
+                    self.assert_(user.has_perm('auth.change_group', self.group))
+                self.assertEqual(UserObjectPermission.objects.filter(
+                    object_id=self.group.pk, user__in=many).count(), 30)
+                self.mediator.discontribute(many, ['change'])
+                self.assert_(not many[0].has_perm('auth.change_group', self.group))
+                self.assert_(many[0].has_perm('auth.view_group', self.group))
+                self.mediator.reset()
+
+    def test_handler_updated_diff(self):
+        from .. import autodiscover
+        from testapp.models import Article
+        from testapp.ophandler import ArticleObjectPermHandler
+        autodiscover()
+        article = Article.objects.get(pk=1)
+        handler = ArticleObjectPermHandler.get(article)
+        if handler is None:
+            ArticleObjectPermHandler._register(article)
+            handler = ArticleObjectPermHandler.get(article)
+        bar = User.objects.get(username='bar')
+        # nothing changed
+        self.assertEqual(self._count_writes(handler._updated, None), 0)
+        self.assert_(not bar.has_perm('app.view_article', article))
+        # only the differences are written
+        article.pub_state = 'inspecting'
+        handler.instance = article
+        self.assert_(self._count_writes(handler._updated, None) > 0)
+        self.assert_(bar.has_perm('app.change_article', article))
+        self.assertEqual(self._count_writes(handler._updated, None), 0)
+
+    def test_batch(self):
+        users = self._create_users('batch', 3)
+        def fn():
+            with self.mediator.batch():
+                self.mediator.viewer(users)
+                self.mediator.editor(users[0])
+                self.mediator.discontribute(users[1], ['view'])
+                self.mediator.reject('anonymous')
+        # rows and through rows are inserted for each distinct permission set
+        # ({view, change} and {view}) not for each call or user
+        queries = self._capture_queries(fn)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('INSERT')]), 4)
+        self.assert_(users[0].has_perm('auth.change_group', self.group))
+        self.assert_(not users[1].has_perm('auth.view_group', self.group))
+        self.assert_(users[2].has_perm('auth.view_group', self.group))
+        self.assert_(not users[2].has_perm('auth.change_group', self.group))
+        # nothing is written when an exception is raised
+        try:
+            with self.mediator.batch():
+                self.mediator.reset()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assert_(users[2].has_perm('auth.view_group', self.group))
+        # nothing is written when nothing is changed
+        self.assertEqual(self._count_writes(fn), 0)
+
+    def test_queryset_mediator(self):
+        storages = (
+            'object_permission.storages.M2MObjectPermStorage',
+            'object_permission.storages.BitmaskObjectPermStorage',
+            'object_permission.storages.GrantObjectPermStorage',
+        )
+        self._assign_bits()
+        for i, storage_class in enumerate(storages):
+            with override_settings(OBJECT_PERMISSION_STORAGE_CLASS=storage_class):
+                prefix = 'qs%d_' % i
+                Group.objects.bulk_create([
+                    Group(name='%s%d' % (prefix, j)) for j in range(10)])
+                Group.objects.bulk_create([
+                    Group(name='few%s%d' % (prefix, j)) for j in range(3)])
+                groups = Group.objects.filter(name__startswith=prefix)
+                few = Group.objects.filter(name__startswith='few%s' % prefix)
+                users = self._create_users(prefix, 3)
+                # the number of queries does not depend on the objects
+                for method, args in (('viewer', ()),
+                                     ('discontribute', (['view'],)),
+                                     ('editor', ()),
+                                     ('clear', ())):
+                    self.assertEqual(
+                        self._count_queries(getattr(
+                            QuerySetPermMediator(few), method), users, *args),
+                        self._count_queries(getattr(
+                            QuerySetPermMediator(groups), method), users, *args))
+                mediator = QuerySetPermMediator(groups, chunk_size=7)
+                mediator.contribute(users, ['view', 'change'])
+                mediator.discontribute(users[0], ['change'])
+                for group in groups:
+                    self.assert_(users[0].has_perm('auth.view_group', group))
+                    self.assert_(not users[0].has_perm('auth.change_group', group))
+                    self.assert_(users[1].has_perm('auth.change_group', group))
+                self.assert_(not users[1].has_perm('auth.view_group', self.group))
+                # sliced queryset
+                QuerySetPermMediator(groups.order_by('pk')[:4]).reject(users)
+                for j, group in enumerate(groups.order_by('pk')):
+                    self.assertEqual(users[2].has_perm('auth.view_group', group),
+                                     j >= 4)
+                mediator.reset()
+                self.assert_(not users[2].has_perm('auth.view_group', groups[0]))
+                # changes in batch are written while iterating the queryset once
+                mediator.viewer(users[1])
+                self.assertEqual(self._count_writes(
+                        self.assertRaises, ValueError, self._batch_queryset,
+                        mediator, users, ValueError), 0)
+                self.assert_(users[1].has_perm('auth.view_group', groups[0]))
+                self.assert_(not users[0].has_perm('auth.view_group', groups[0]))
+                is_scan = lambda sql: 'FROM "auth_group"' in sql
+                scans = filter(is_scan, self._capture_queries(
+                        mediator.clear, users[0]))
+                self.assertEqual(scans, filter(is_scan, self._capture_queries(
+                        self._batch_queryset, mediator, users)))
+                for group in groups:
+                    self.assert_(not users[1].has_perm('auth.view_group', group))
+                    self.assert_(users[0].has_perm('auth.change_group', group))
+                    self.assert_(users[2].has_perm('auth.delete_group', group))
+                    self.assert_(not users[2].has_perm('auth.view_group', group))
+
+    def _batch_queryset(self, mediator, users, exception=None):
+        with mediator.batch(reset=True):
+            mediator.editor(users[0])
+            # nested batch is merged into the outer batch
+            with mediator.batch():
+                mediator.contribute(users[2], ['delete'])
+            if exception:
+                raise exception
+
+    def test_reset(self):
+        few = self._create_users('resetfew', 3)
+        many = self._create_users('resetmany', 30)
+        through = UserObjectPermission.permissions.through
+        def fn(users):
+            self.mediator.contribute(users + ['anonymous'], ['view', 'change'])
+            self.row_ids = list(UserObjectPermission.objects.filter(
+                content_type=self.mediator._ct,
+                object_id=self.group.pk).values_list('pk', flat=True))
+            return self._capture_queries(self.mediator.reset)
+        # rows are deleted without loading them
+        queries = fn(few)
+        self.assert_(all(sql.startswith('DELETE') for sql in queries))
+        self.assertEqual(len(queries), len(fn(many)))
+        self.assertEqual(len(self.row_ids), 30)
+        self.assertEqual(through.objects.filter(
+            userobjectpermission_id__in=self.row_ids).count(), 0)
+        self.assert_(not many[0].has_perm('auth.view_group', self.group))
+
+    def test_contribute_usernames(self):
+        users = self._create_users('name', 30)
+        usernames = [user.username for user in users]
+        # usernames are resolved with a single query
+        queries = self._capture_queries(self.mediator.contribute,
+                                        usernames, ['view'])
+        self.assertEqual(len([sql for sql in queries
+                              if 'auth_user' in sql.split('WHERE')[0]]), 1)
+        self.assert_(users[-1].has_perm('auth.view_group', self.group))
+        # all unknown usernames are reported
+        try:
+            self.mediator.contribute(usernames + ['unknown1', 'unknown2'])
+            self.fail('AttributeError is not raised')
+        except AttributeError, e:
+            self.assert_("'unknown1', 'unknown2'" in str(e))
+
+    def test_contribute_stream(self):
+        users = self._create_users('stream', 5)
+        # generators are iterated only once
+        self.mediator.viewer(user for user in users)
+        for user in users:
+            self.assert_(user.has_perm('auth.view_group', self.group))
+        # querysets of principals are iterated by pk chunks
+        queryset = User.objects.filter(username__startswith='stream')
+        with self.mediator.batch():
+            self.mediator.editor(queryset)
+        self.mediator.discontribute(queryset.all(), ['view'])
+        for user in users:
+            self.assert_(not user.has_perm('auth.view_group', self.group))
+            self.assert_(user.has_perm('auth.change_group', self.group))
+
+    def test_handler_registry(self):
+        from .. import autodiscover
+        from ..handlers.registry import HandlerRegistry
+        from testapp.models import Article
+        from testapp.ophandler import ArticleObjectPermHandler
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        handlers = ArticleObjectPermHandler.__dict__.get('_handlers')
+        ArticleObjectPermHandler._handlers = HandlerRegistry(2)
+        try:
+            articles = [Article.objects.create(author=bar, pub_state='published')
+                        for i in range(3)]
+            stats = ArticleObjectPermHandler.stats()
+            self.assertEqual(stats['size'], 2)
+            self.assertEqual(stats['evictions'], 1)
+            self.assertEqual(stats['watchers'], 8)
+            # the least recently used handler is released
+            self.assertEqual(ArticleObjectPermHandler.get(articles[0]), None)
+            self.assert_(ArticleObjectPermHandler.get(articles[2]) is not None)
+            # and registered again when the instance is saved
+            articles[0].save()
+            self.assert_(ArticleObjectPermHandler.get(articles[0]) is not None)
+            self.assertEqual(ArticleObjectPermHandler.get(articles[1]), None)
+            self.assert_(bar.has_perm('testapp.delete_article', articles[0]))
+            # released handlers are registered again when the watched
+            # relations are changed
+            self.assertEqual(ArticleObjectPermHandler.stats()['released'], 1)
+            foo = User.objects.get(username='foo')
+            articles[1].inspectors.add(foo)
+            self.assert_(ArticleObjectPermHandler.get(articles[1]) is not None)
+            self.assert_(foo.has_perm('testapp.change_article', articles[1]))
+            released = [article for article in articles
+                        if ArticleObjectPermHandler.get(article) is None][0]
+            foo.inspected_articles.add(released)
+            self.assert_(ArticleObjectPermHandler.get(released) is not None)
+            self.assert_(foo.has_perm('testapp.change_article', released))
+        finally:
+            ArticleObjectPermHandler._handlers.clear()
+            if handlers is None:
+                del ArticleObjectPermHandler._handlers
+            else:
+                ArticleObjectPermHandler._handlers = handlers
+
+    def test_handler_state(self):
+        from .. import autodiscover
+        from ..handlers.registry import HandlerRegistry
+        from testapp.models import Article
+        from testapp.ophandler import ArticleObjectPermHandler
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        article = Article.objects.create(author=bar)
+        handlers = ArticleObjectPermHandler.__dict__.get('_handlers')
+        try:
+            # registered again without rewriting object permissions
+            ArticleObjectPermHandler._handlers = HandlerRegistry(0)
+            queries = self._capture_queries(article.save)
+            self.assert_(ArticleObjectPermHandler.get(article) is not None)
+            tables = [sql.split('WHERE')[0] for sql in queries]
+            self.assert_(not [table for table in tables
+                              if 'objectpermission' in table and
+                                 'objectpermissionstate' not in table])
+            # rebuilt when watched attributes are changed while unregistered
+            ArticleObjectPermHandler._handlers = HandlerRegistry(0)
+            Article.objects.filter(pk=article.pk).update(pub_state='published')
+            article = Article.objects.get(pk=article.pk)
+            self.assert_(not AnonymousUser().has_perm('testapp.view_article', article))
+            article.save()
+            self.assert_(AnonymousUser().has_perm('testapp.view_article', article))
+        finally:
+            if handlers is None:
+                del ArticleObjectPermHandler._handlers
+            else:
+                ArticleObjectPermHandler._handlers = handlers
+
+    def test_authenticated_handler(self):
+        from .. import site
+        from ..handlers import AuthenticatedObjectPermHandler
+        from testapp.models import Tag
+        site.register(Tag, AuthenticatedObjectPermHandler)
+        try:
+            tags = [Tag.objects.create(slug=str(i)) for i in range(3)]
+            staff = User.objects.create(username='staff', is_staff=True)
+            user = User.objects.create(username='user')
+            for tag in tags:
+                self.assert_(staff.has_perm('testapp.delete_tag', tag))
+                self.assert_(not user.has_perm('testapp.delete_tag', tag))
+                self.assert_(user.has_perm('testapp.change_tag', tag))
+            # saving users without staff changes does not write anything
+            def fn():
+                staff.save()
+                user.save()
+            self.assertEqual(self._count_writes(fn), 2)
+            # object permissions given to the user by the others are kept
+            ObjectPermMediator(tags[0]).contribute(staff, ['add'])
+            user.is_staff = True
+            user.save()
+            staff.is_staff = False
+            staff.save()
+            for tag in tags:
+                self.assert_(user.has_perm('testapp.delete_tag', tag))
+                self.assert_(not staff.has_perm('testapp.delete_tag', tag))
+            self.assert_(staff.has_perm('testapp.add_tag', tags[0]))
+        finally:
+            site.unregister(Tag)
+            AuthenticatedObjectPermHandler._get_registry().clear()
+
+    def test_authenticated_handler_subclass(self):
+        from .. import site
+        from ..handlers import AuthenticatedObjectPermHandler
+        from testapp.models import Tag
+        class TagObjectPermHandler(AuthenticatedObjectPermHandler):
+            def updated(self, attr):
+                # staff users can only view
+                staff_users = User.objects.filter(is_staff=True, is_active=True)
+                self.viewer(staff_users)
+        site.register(Tag, TagObjectPermHandler)
+        try:
+            # models are kept for each class
+            self.assertEqual(TagObjectPermHandler._get_models(), set([Tag]))
+            self.assert_(Tag not in AuthenticatedObjectPermHandler._get_models())
+            tags = [Tag.objects.create(slug=str(i)) for i in range(3)]
+            user = User.objects.create(username='user')
+            for tag in tags:
+                self.assert_(not user.has_perm('testapp.view_tag', tag))
+            # 'updated' of the subclass is used when the user becomes staff
+            user.is_staff = True
+            user.save()
+            for tag in tags:
+                self.assert_(user.has_perm('testapp.view_tag', tag))
+                self.assert_(not user.has_perm('testapp.delete_tag', tag))
+            user.is_staff = False
+            user.save()
+            for tag in tags:
+                self.assert_(not user.has_perm('testapp.view_tag', tag))
+        finally:
+            site.unregister(Tag)
+            TagObjectPermHandler._get_registry().clear()
+
+    def test_handler_queue(self):
+        from .. import autodiscover
+        from ..queues import flush
+        from ..models import ObjectPermissionHandlerJob
+        from ..models import ObjectPermissionState
+        from testapp.models import Article
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        queues = (
+            'object_permission.queues.LocalHandlerQueue',
+            'object_permission.queues.DatabaseHandlerQueue',
+        )
+        for queue_class in queues:
+            with override_settings(OBJECT_PERMISSION_HANDLER_QUEUE=queue_class):
+                # handlers are not called in post_save
+                article = Article.objects.create(author=bar)
+                states = ObjectPermissionState.objects.filter(
+                    object_id=article.pk)
+                self.assertEqual(states.count(), 0)
+                if queue_class.endswith('DatabaseHandlerQueue'):
+                    self.assertEqual(ObjectPermissionHandlerJob.objects.filter(
+                        action='save').count(), 1)
+                flush()
+                self.assert_(bar.has_perm('testapp.delete_article', article))
+                self.assertEqual(ObjectPermissionHandlerJob.objects.count(), 0)
+                self.assertEqual(states.count(), 1)
+                article.delete()
+                self.assertEqual(states.count(), 1)
+                flush()
+                self.assertEqual(states.count(), 0)
+
+    def test_handler_queue_relations(self):
+        from .. import autodiscover
+        from ..queues import flush
+        from ..models import ObjectPermissionHandlerJob
+        from ..handlers.registry import HandlerRegistry
+        from testapp.models import Article
+        from testapp.ophandler import ArticleObjectPermHandler
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        inspector = User.objects.create(username='inspector')
+        queue_class = 'object_permission.queues.DatabaseHandlerQueue'
+        handlers = ArticleObjectPermHandler.__dict__.get('_handlers')
+        ArticleObjectPermHandler._handlers = HandlerRegistry(100)
+        try:
+            with override_settings(OBJECT_PERMISSION_HANDLER_QUEUE=queue_class):
+                article = Article.objects.create(author=bar, pub_state='published')
+                flush()
+                # the handler is not registered in the process which changes
+                # the relations (e.g. web process)
+                key = ArticleObjectPermHandler._get_key(article)
+                ArticleObjectPermHandler._get_registry().pop(key)._unwatch(instance=None)
+                article.inspectors.add(inspector)
+                jobs = ObjectPermissionHandlerJob.objects.filter(
+                        action='update', object_id=article.pk)
+                self.assertEqual(jobs.count(), 1)
+                flush()
+                self.assert_(inspector.has_perm('testapp.change_article', article))
+                # the other side of the relation
+                ArticleObjectPermHandler._get_registry().pop(key)._unwatch(instance=None)
+                inspector.inspected_articles.clear()
+                self.assertEqual(jobs.count(), 1)
+                flush()
+                inspector = User.objects.get(pk=inspector.pk)
+                self.assert_(not inspector.has_perm('testapp.change_article', article))
+        finally:
+            ArticleObjectPermHandler._handlers.clear()
+            if handlers is None:
+                del ArticleObjectPermHandler._handlers
+            else:
+                ArticleObjectPermHandler._handlers = handlers
+
+    def test_thread_pool_handler_queue(self):
+        from django.core.signals import request_finished
+        from ..queues import ThreadPoolHandlerQueue
+        queue = ThreadPoolHandlerQueue(retries=0)
+        ran = []
+        queue._run_in_thread = ran.append
+        try:
+            # jobs put in a managed transaction are submitted when the
+            # request is finished
+            queue.put(ObjectPermMediator, 'update', self.group)
+            self.assertEqual(queue._results, [])
+            request_finished.send(sender=self.__class__)
+            queue.flush()
+            self.assertEqual([job['action'] for job in ran], ['update'])
+        finally:
+            request_finished.disconnect(
+                dispatch_uid="object_permission.queues.%d" % id(queue))
+            queue._pool.close()
+
+    def test_coalesce_updates(self):
+        from .. import autodiscover
+        from ..handlers import coalesce_updates
+        from testapp.models import Article
+        from testapp.ophandler import ArticleObjectPermHandler
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        calls = []
+        updated = ArticleObjectPermHandler.__dict__['updated']
+        def _updated(self, attr):
+            calls.append(self.instance.pk)
+            return updated(self, attr)
+        ArticleObjectPermHandler.updated = _updated
+        def fn(count):
+            with coalesce_updates():
+                articles = [Article.objects.create(author=bar)
+                            for i in range(count)]
+                for article in articles:
+                    article.pub_state = 'published'
+                    article.save()
+            return articles
+        try:
+            # 'updated' is called once for each object and the changes of
+            # all objects are written together
+            inserts = []
+            for count in (2, 4):
+                del calls[:]
+                articles = []
+                queries = self._capture_queries(
+                    lambda: articles.extend(fn(count)))
+                self.assertEqual(sorted(calls),
+                                 sorted(article.pk for article in articles))
+                inserts.append(len([sql for sql in queries
+                    if sql.startswith('INSERT') and 'objectpermission' in sql
+                    and 'objectpermissionstate' not in sql]))
+                for article in articles:
+                    self.assert_(bar.has_perm('testapp.delete_article', article))
+                    self.assert_(AnonymousUser().has_perm(
+                        'testapp.view_article', article))
+            self.assertEqual(inserts[0], inserts[1])
+        finally:
+            ArticleObjectPermHandler.updated = updated
+
+
+@with_apps('object_permission.tests.testapp')
+class ObjectPermMediatorTransactionTestCase(TransactionTestCase):
+    fixtures = ['object_permission_test.yaml']
+
+    def setUp(self):
+        self.group = Group.objects.get(pk=1)
+        ContentType.objects.get_for_model(self.group)
+        registry.load()
+        self.mediator = ObjectPermMediator(self.group)
+
+    def test_batch_rollback(self):
+        user = User.objects.create(username='rollback')
+        # the batch is written in the transaction of the caller thus it is
+        # rolled back with the transaction
+        try:
+            with transaction.commit_on_success():
+                with self.mediator.batch():
+                    self.mediator.viewer(user)
+                raise ValueError
+        except ValueError:
+            pass
+        user = User.objects.get(pk=user.pk)
+        self.assert_(not user.has_perm('auth.view_group', self.group))
+        with self.mediator.batch():
+            self.mediator.viewer(user)
+        user = User.objects.get(pk=user.pk)
+        self.assert_(user.has_perm('auth.view_group', self.group))
+
+    def test_batch_invalidate_after_commit(self):
+        from .. import cache
+        caches = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'object_permission': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'object_permission_test',
+            },
+        }
+        user = User.objects.create(username='invalidate')
+        key = cache.get_cache_key(self.group)
+        with override_settings(OBJECT_PERMISSION_CACHE='object_permission', CACHES=caches):
+            cache.get_shared_cache().clear()
+            version = cache.get_shared_cache_entry(user, key)[1][0]
+            # the versions are bumped when the batch is written and again
+            # after the transaction of the batch is committed without any
+            # request
+            with self.mediator.batch():
+                self.mediator.viewer(user)
+            self.assert_(not getattr(cache._local, 'pending', None))
+            self.assertEqual(cache.get_shared_cache_entry(user, key)[1][0],
+                             version + 2)
+
+    def test_queryset_mediator_rollback(self):
+        users = [User.objects.create(username='rollback%d' % i)
+                 for i in range(3)]
+        mediator = QuerySetPermMediator(Group.objects.all(), chunk_size=1)
+        try:
+            with transaction.commit_on_success():
+                mediator.viewer(users[0])
+                raise ValueError
+        except ValueError:
+            pass
+        self.assert_(not User.objects.get(pk=users[0].pk).has_perm(
+            'auth.view_group', self.group))
+
+    def test_coalesce_updates_rollback(self):
+        from .. import autodiscover
+        from ..handlers import coalesce_updates
+        from ..models import get_object_permission_models
+        from testapp.models import Article
+        autodiscover()
+        bar = User.objects.get(username='bar')
+        ct = ContentType.objects.get_for_model(Article)
+        model = get_object_permission_models(Article)[0]
+        articles = Article.objects.count()
+        count = model.objects.filter(content_type=ct).count()
+        # the coalesced changes are written in the transaction of the caller
+        # thus they are rolled back with the transaction
+        try:
+            with transaction.commit_on_success():
+                with coalesce_updates():
+                    Article.objects.create(author=bar)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Article.objects.count(), articles)
+        self.assertEqual(model.objects.filter(content_type=ct).count(), count)
+
+    def test_build_grants_rollback(self):
+        from django.core.management import call_command
+        from ..models import ObjectPermissionGrant
+        from ..management.commands import build_object_permission_grants
+        call_command('build_object_permission_grants', verbosity=0)
+        count = ObjectPermissionGrant.objects.count()
+        self.assert_(count > 0)
+        command = build_object_permission_grants.Command
+        iter_grants = command._iter_grants
+        def _iter_grants(self, using):
+            for grant in iter_grants(self, using):
+                yield grant
+            raise ValueError
+        command._iter_grants = _iter_grants
+        try:
+            # the table is replaced in one transaction thus the old rows are
+            # kept when the rebuild fails
+            self.assertRaises(ValueError, call_command,
+                              'build_object_permission_grants', verbosity=0)
+        finally:
+            command._iter_grants = iter_grants
+        self.assertEqual(ObjectPermissionGrant.objects.count(), count)
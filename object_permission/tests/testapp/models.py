@@ -49,3 +49,9 @@ class Article(models.Model):
 
     def __unicode__(self):
         return self.title
+
+class Tag(models.Model):
+    slug = models.SlugField('slug', primary_key=True)
+
+    def __unicode__(self):
+        return self.slug
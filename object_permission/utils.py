@@ -26,11 +26,15 @@ License:
 __AUTHOR__ = "lambdalisue (lambdalisue@hashnote.net)"
 import time
 import datetime
+from contextlib import contextmanager
 
 from django.http import Http404
+from django.db import transaction
 from django.db.models.fields import DateTimeField
 from django.shortcuts import get_object_or_404
 
+from cache import flush_invalidations
+
 def get_perm_codename(perm):
     """get permission codename from django's standard permission format"""
     # Note:
@@ -44,12 +48,15 @@ def get_perm_codename(perm):
     return perm
 
 def get_perm_codename_with_suffix(perm, obj):
-    """get permission codename suffix"""
+    """get permission codename suffix
+
+    obj can be either a model instance or a model class
+    """
     perm_codename = get_perm_codename(perm)
     if hasattr(obj, 'object_permission_suffix'):
         suffix = getattr(obj, 'object_permission_suffix')
     else:
-        suffix = "_%s" % obj.__class__.__name__.lower()
+        suffix = "_%s" % obj._meta.object_name.lower()
     if perm_codename.endswith(suffix):
         return perm_codename
     return perm_codename + suffix
@@ -104,3 +111,62 @@ def _get_object_from_date_based_object_detail(
                 "Generic detail view must be called with either an "
                 "object_id or a slug/slug_field.")
     return get_object_or_404(queryset, **lookup_kwargs)
+
+def chunked(iterable, size):
+    """iterate lists of at most size items of iterable
+
+    Used for splitting large ``__in`` lookups since some databases (e.g.
+    sqlite) limit the number of variables of a query.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def chunked_pks(queryset, size):
+    """iterate pk lists of at most size objects of queryset
+
+    The queryset is paginated by pk (keyset pagination) thus only a chunk of
+    pks is loaded at once regardless of the database driver.
+    """
+    if not queryset.query.can_filter():
+        # sliced querysets cannot be paginated
+        for chunk in chunked(queryset.values_list('pk', flat=True), size):
+            yield chunk
+        return
+    qs = queryset.order_by('pk').values_list('pk', flat=True)
+    last = None
+    while True:
+        _qs = qs if last is None else qs.filter(pk__gt=last)
+        pks = list(_qs[:size])
+        if not pks:
+            return
+        yield pks
+        if len(pks) < size:
+            return
+        last = pks[-1]
+
+@contextmanager
+def commit_on_success_unless_managed(using=None):
+    """commit_on_success unless the caller manages the transaction
+
+    ``commit_on_success`` commits the transaction of the caller when it is
+    nested (e.g. in ``post_save`` of a model saved in a view) thus writes
+    are done in the transaction of the caller if it exists.
+
+    Cached object permissions invalidated in the transaction are invalidated
+    again when the transaction opened here is finished (see
+    ``cache.flush_invalidations``).
+    """
+    if transaction.is_managed(using=using):
+        yield
+        return
+    try:
+        with transaction.commit_on_success(using=using):
+            yield
+    finally:
+        flush_invalidations()
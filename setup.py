@@ -30,7 +30,7 @@ setup(
     install_requires=[
         'distribute',
         'setuptools-git',
-        'django>=1.3',
+        'django>=1.4',
         'django-observer>=0.3rc3',
     ],
     test_suite='runtests.runtests',